@@ -0,0 +1,420 @@
+"""Single-pass aggregation of parsed ticks into the metrics the graphs and API use.
+
+Ticks are reduced once to (bucket, token) cells holding an entry count and a
+quantity sum, using integer codes for both keys. Every hourly, per-token and
+top-K figure is then read off those cells instead of regrouping the rows.
+
+Coarser time buckets are rolled up from finer ones by summing cells, so one
+pass over the ticks at one-second resolution gives every view up to hourly.
+
+Trades (T rows) also get per-(bucket, token) price statistics: open, high,
+low and close price, quantity and notional (price x quantity), from which
+VWAP is notional / quantity. These roll up and merge the same way, taking
+the first open and the last close in time.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from patterns import match_pattern, parse_pattern, T_TO_NM
+from timestamps import EXCHANGE_TIMEZONE
+from topk import largest
+
+# Rollup pyramid, finest first; each level is summed from the one before it
+ROLLUP_BUCKETS = ["1s", "1min", "5min", "15min", "1h"]
+DEFAULT_BUCKET = "1h"
+
+# How each bucket width reads in chart titles ("Entries per Hour")
+BUCKET_LABELS = {"1s": "Second", "1min": "Minute", "5min": "5 Minutes", "15min": "15 Minutes", "1h": "Hour"}
+
+# Ticks from before a chunk needed to catch T->N/M combos that straddle its start
+CONTEXT_ROWS = len(parse_pattern(T_TO_NM)) - 1
+
+# Arrays of a trade cell: its bucket and token codes, then its price statistics
+TRADE_COLUMNS = ["bucket", "token", "open", "high", "low", "close", "quantity", "notional"]
+
+
+def _sum_cells(bucket_codes, token_codes, token_count, quantity, entries=None):
+    """Sum quantity (and count rows, or sum entries if given) per (bucket, token) code pair"""
+    keys = bucket_codes.astype("int64") * max(token_count, 1) + token_codes
+    cell_codes, cell_keys = pd.factorize(keys, sort=True)
+    if entries is None:
+        cell_entries = np.bincount(cell_codes, minlength=len(cell_keys))
+    else:
+        cell_entries = np.bincount(cell_codes, weights=entries, minlength=len(cell_keys))
+    cell_quantity = np.bincount(cell_codes, weights=quantity, minlength=len(cell_keys))
+    return (
+        cell_keys // max(token_count, 1), cell_keys % max(token_count, 1),
+        cell_entries.astype("int64"), cell_quantity
+    )
+
+
+def _combine_trades(keys, times, token_count, opens, highs, lows, closes, quantity, notional):
+    """Trade statistics per cell key: the open and close of the earliest and latest entry (by times), the
+    extreme high and low, and the summed quantity and notional"""
+    order = np.lexsort((times, keys))
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) else np.empty(0, dtype="int64")
+    ends = np.concatenate([starts[1:], [len(keys)]])[:len(starts)] - 1
+
+    def reduce(ufunc, values):
+        return ufunc.reduceat(values[order], starts) if len(starts) else np.empty(0)
+
+    return {
+        "bucket": keys[starts] // max(token_count, 1), "token": keys[starts] % max(token_count, 1),
+        "open": opens[order][starts], "high": reduce(np.maximum, highs), "low": reduce(np.minimum, lows),
+        "close": closes[order][ends], "quantity": reduce(np.add, quantity), "notional": reduce(np.add, notional),
+    }
+
+
+class TickAggregates:
+    """Per-(bucket, token) entry counts and quantity sums plus T->N/M combos per bucket.
+
+    bucket is the bucket width as a pandas frequency ("1s" ... "1h"),
+    buckets the sorted bucket start times (named "hour" at every width, which
+    the chart labels rely on) and tokens the token names in sorted order. token_first_seen gives, for each token, the position it
+    first appeared at in the upload, so rankings break ties the way
+    value_counts does. The cell_* arrays list every non-empty (bucket, token)
+    cell, sorted by bucket and then token. trades holds the TRADE_COLUMNS
+    arrays of every cell with trades in it, in the same order.
+    """
+
+    def __init__(self, bucket, buckets, tokens, token_first_seen, cell_buckets, cell_tokens,
+                 cell_entries, cell_quantity, combos, trades):
+        self.bucket = bucket
+        self.buckets = buckets
+        self.tokens = tokens
+        self.token_first_seen = token_first_seen
+        self.cell_buckets = cell_buckets
+        self.cell_tokens = cell_tokens
+        self.cell_entries = cell_entries
+        self.cell_quantity = cell_quantity
+        self.combos = combos
+        self.trades = trades
+        self._token_cells = None
+
+    @classmethod
+    def from_ticks(cls, df, bucket=DEFAULT_BUCKET, context=None):
+        """Aggregate a tick frame.
+
+        context, if given, is the last CONTEXT_ROWS ticks before df, which
+        are already counted elsewhere (e.g. the earlier part of a growing
+        file). They only contribute the T->N/M combos that start in them and
+        finish in df.
+        """
+        times, actions = df["adjusted_time"], df["action"]
+        context_rows = 0 if context is None else len(context)
+        if context_rows:
+            times = pd.concat([context["adjusted_time"], times], ignore_index=True)
+            actions = pd.concat([context["action"].astype(str), actions.astype(str)], ignore_index=True)
+        all_bucket_codes, buckets = pd.factorize(times.dt.floor(bucket), sort=True)
+        bucket_codes = all_bucket_codes[context_rows:]
+        buckets = pd.DatetimeIndex(buckets, name="hour")
+
+        # Codes in first-seen order, then renumbered so tokens sort like a groupby would
+        seen_codes, seen_tokens = pd.factorize(df["token"])
+        seen_tokens = np.asarray(seen_tokens, dtype=object)
+        lexical = np.argsort(seen_tokens, kind="stable")
+        rank = np.empty(len(lexical), dtype="int64")
+        rank[lexical] = np.arange(len(lexical))
+        token_codes = rank[seen_codes]
+        tokens = pd.Index(seen_tokens[lexical], name="token")
+
+        # One pass over the rows: bucket/token codes combined into a single cell key
+        cells = _sum_cells(bucket_codes, token_codes, len(tokens), df["order_quantity"].to_numpy())
+
+        starts = match_pattern(actions, T_TO_NM)
+        combos = np.bincount(all_bucket_codes[starts], minlength=len(buckets))
+
+        is_trade = (df["action"] == "T").to_numpy()
+        price = df["price"].to_numpy()[is_trade]
+        quantity = df["order_quantity"].to_numpy()[is_trade]
+        trades = _combine_trades(
+            bucket_codes[is_trade].astype("int64") * max(len(tokens), 1) + token_codes[is_trade],
+            df["adjusted_time"].array.asi8[is_trade], len(tokens), price, price, price, price, quantity, price * quantity
+        )
+
+        return cls(bucket, buckets, tokens, lexical, *cells, combos.astype("int64"), trades)
+
+    @classmethod
+    def merge(cls, parts):
+        """Add several aggregates (e.g. one per session file) into one"""
+        cells = pd.concat([part.cells() for part in parts])
+        cells = cells.groupby(["hour", "token"]).sum()
+        first_seen = list(pd.unique(pd.concat([part.tokens_in_first_seen_order() for part in parts])))
+        combos = pd.concat([part.combos_per_bucket() for part in parts]).groupby(level=0).sum()
+        # Parts are in time order, so a cell's open is from the first part that traded in it
+        trades = pd.concat([part.trade_cells() for part in parts]).groupby(["hour", "token"]).agg(
+            open=("open", "first"), high=("high", "max"), low=("low", "min"), close=("close", "last"),
+            quantity=("quantity", "sum"), notional=("notional", "sum")
+        )
+
+        buckets = cells.index.levels[0]
+        tokens = cells.index.levels[1]
+        first_seen_position = pd.Series(np.arange(len(first_seen)), index=first_seen)
+        return cls(
+            parts[0].bucket, pd.DatetimeIndex(buckets, name="hour"), pd.Index(tokens, name="token"),
+            first_seen_position.reindex(tokens).to_numpy(),
+            cells.index.codes[0].astype("int64"), cells.index.codes[1].astype("int64"),
+            cells["entries"].to_numpy(), cells["order_quantity"].to_numpy(),
+            combos.reindex(buckets, fill_value=0).to_numpy(),
+            {
+                "bucket": buckets.get_indexer(trades.index.get_level_values("hour")).astype("int64"),
+                "token": tokens.get_indexer(trades.index.get_level_values("token")).astype("int64"),
+                **{name: trades[name].to_numpy() for name in TRADE_COLUMNS[2:]}
+            }
+        )
+
+    def rollup(self, bucket):
+        """The same aggregates over wider buckets, summed from these cells without the ticks"""
+        bucket_codes, buckets = pd.factorize(self.buckets.floor(bucket), sort=True)
+        cells = _sum_cells(bucket_codes[self.cell_buckets], self.cell_tokens, len(self.tokens),
+                           self.cell_quantity, self.cell_entries)
+        combos = np.bincount(bucket_codes, weights=self.combos, minlength=len(buckets))
+        trade_buckets = np.asarray(self.trades["bucket"])
+        trades = _combine_trades(
+            bucket_codes[trade_buckets].astype("int64") * max(len(self.tokens), 1) + self.trades["token"],
+            trade_buckets, len(self.tokens), *(np.asarray(self.trades[name]) for name in TRADE_COLUMNS[2:])
+        )
+        return TickAggregates(
+            bucket, pd.DatetimeIndex(buckets, name="hour"), self.tokens, self.token_first_seen,
+            *cells, combos.astype("int64"), trades
+        )
+
+    def between(self, start=None, end=None):
+        """Only the buckets starting in [start, end), with just the tokens that have ticks in them"""
+        first = 0 if start is None else self.buckets.searchsorted(start)
+        last = len(self.buckets) if end is None else self.buckets.searchsorted(end)
+        cell_first, cell_last = np.searchsorted(self.cell_buckets, [first, last])
+        used_tokens, cell_tokens = np.unique(self.cell_tokens[cell_first:cell_last], return_inverse=True)
+        trade_first, trade_last = np.searchsorted(self.trades["bucket"], [first, last])
+        trades = {name: np.asarray(values[trade_first:trade_last]) for name, values in self.trades.items()}
+        trades["bucket"] = trades["bucket"] - first
+        # Every trade cell is also a cell, so its token is among the used ones
+        trades["token"] = np.searchsorted(used_tokens, trades["token"]).astype("int64")
+        return TickAggregates(
+            self.bucket, self.buckets[first:last], self.tokens[used_tokens],
+            np.asarray(self.token_first_seen)[used_tokens],
+            np.asarray(self.cell_buckets[cell_first:cell_last]) - first, cell_tokens.astype("int64"),
+            np.asarray(self.cell_entries[cell_first:cell_last]), np.asarray(self.cell_quantity[cell_first:cell_last]),
+            np.asarray(self.combos[first:last]), trades
+        )
+
+    def save(self, directory):
+        os.makedirs(directory)
+        np.save(os.path.join(directory, "buckets.npy"), self.buckets.asi8)
+        for name in ["token_first_seen", "cell_buckets", "cell_tokens", "cell_entries", "cell_quantity", "combos"]:
+            np.save(os.path.join(directory, f"{name}.npy"), np.asarray(getattr(self, name)))
+        for name in TRADE_COLUMNS:
+            np.save(os.path.join(directory, f"trade_{name}.npy"), np.asarray(self.trades[name]))
+        with open(os.path.join(directory, "aggregates.json"), "w") as info_file:
+            json.dump({"bucket": self.bucket, "tokens": [str(token) for token in self.tokens]}, info_file)
+
+    @classmethod
+    def load(cls, directory):
+        """Read aggregates written by save, memory-mapping the cell arrays"""
+        with open(os.path.join(directory, "aggregates.json")) as info_file:
+            info = json.load(info_file)
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in ["buckets", "token_first_seen", "cell_buckets", "cell_tokens",
+                         "cell_entries", "cell_quantity", "combos"]
+        }
+        buckets = pd.DatetimeIndex(np.asarray(arrays.pop("buckets")).view("datetime64[ns]"), name="hour")
+        trades = {name: np.load(os.path.join(directory, f"trade_{name}.npy"), mmap_mode="r") for name in TRADE_COLUMNS}
+        return cls(
+            info["bucket"], buckets.tz_localize("UTC").tz_convert(EXCHANGE_TIMEZONE),
+            pd.Index(info["tokens"], dtype=object, name="token"), **arrays, trades=trades
+        )
+
+    def cells(self):
+        """Non-empty (hour, token) cells as a frame, for merging and inspection"""
+        return pd.DataFrame({
+            "hour": self.buckets[self.cell_buckets],
+            "token": self.tokens[self.cell_tokens],
+            "entries": self.cell_entries,
+            "order_quantity": self.cell_quantity,
+        })
+
+    def trade_cells(self):
+        """Per-(hour, token) trade statistics as a frame, with VWAP, for merging and inspection"""
+        trades = pd.DataFrame({
+            "hour": self.buckets[np.asarray(self.trades["bucket"])],
+            "token": self.tokens[np.asarray(self.trades["token"])],
+            **{name: np.asarray(self.trades[name]) for name in TRADE_COLUMNS[2:]}
+        })
+        trades["vwap"] = trades["notional"] / trades["quantity"]
+        return trades
+
+    def tokens_in_first_seen_order(self):
+        return pd.Series(self.tokens[np.argsort(self.token_first_seen)])
+
+    def entries_per_bucket(self):
+        totals = np.bincount(self.cell_buckets, weights=self.cell_entries, minlength=len(self.buckets))
+        return pd.Series(totals.astype("int64"), index=self.buckets)
+
+    def quantity_per_bucket(self):
+        totals = np.bincount(self.cell_buckets, weights=self.cell_quantity, minlength=len(self.buckets))
+        return pd.Series(totals, index=self.buckets)
+
+    def combos_per_bucket(self):
+        """T->N/M combination count per bucket, only for buckets that have any"""
+        combos = pd.Series(self.combos, index=self.buckets)
+        return combos[combos > 0]
+
+    def entries_per_token(self):
+        """Entry count per token, largest first (same order as value_counts)"""
+        totals = np.bincount(self.cell_tokens, weights=self.cell_entries, minlength=len(self.tokens))
+        order = np.argsort(self.token_first_seen)
+        counts = pd.Series(totals[order].astype("int64"), index=self.tokens[order], name="count")
+        return counts.sort_values(ascending=False)
+
+    def quantity_per_token(self):
+        """Quantity sum per token, in token order"""
+        totals = np.bincount(self.cell_tokens, weights=self.cell_quantity, minlength=len(self.tokens))
+        return pd.Series(totals, index=self.tokens, name="order_quantity")
+
+    def notional_per_bucket(self):
+        """Traded notional (price x quantity of T rows) per bucket"""
+        totals = np.bincount(self.trades["bucket"], weights=self.trades["notional"], minlength=len(self.buckets))
+        return pd.Series(totals, index=self.buckets, name="notional")
+
+    def notional_per_token(self):
+        """Traded notional per token, in token order"""
+        totals = np.bincount(self.trades["token"], weights=self.trades["notional"], minlength=len(self.tokens))
+        return pd.Series(totals, index=self.tokens, name="notional")
+
+    def vwap_per_token(self):
+        """Volume-weighted average trade price of each token that traded"""
+        notional = np.bincount(self.trades["token"], weights=self.trades["notional"], minlength=len(self.tokens))
+        quantity = np.bincount(self.trades["token"], weights=self.trades["quantity"], minlength=len(self.tokens))
+        traded = quantity > 0
+        return pd.Series(notional[traded] / quantity[traded], index=self.tokens[traded], name="vwap")
+
+    def ohlc(self, token):
+        """One token's open, high, low, close, VWAP, quantity and notional per bucket it traded in"""
+        selected = np.asarray(self.trades["token"]) == self.tokens.get_loc(token)
+        trades = pd.DataFrame(
+            {name: np.asarray(self.trades[name])[selected] for name in TRADE_COLUMNS[2:]},
+            index=self.buckets[np.asarray(self.trades["bucket"])[selected]]
+        )
+        trades["vwap"] = trades["notional"] / trades["quantity"]
+        return trades
+
+    def trade_metrics(self):
+        """Notional per bucket and token, VWAP per token and OHLC per token and bucket, as plain JSON values"""
+        trades = self.trade_cells()
+        notional_per_token = self.notional_per_token()
+        notional_per_token = notional_per_token[self.tokens[np.unique(self.trades["token"])]]
+        ohlc_per_token = {}
+        for token, cells in trades.groupby("token", sort=False):
+            ohlc_per_token[str(token)] = {
+                str(hour): {name: float(value) for name, value in zip(["open", "high", "low", "close", "vwap"], values)}
+                for hour, *values in cells[["hour", "open", "high", "low", "close", "vwap"]].itertuples(index=False)
+            }
+        return {
+            "notional_per_hour": {str(k): float(v) for k, v in self.notional_per_bucket().items()},
+            "notional_per_token": {str(k): float(v) for k, v in notional_per_token.sort_values(ascending=False).items()},
+            "vwap_per_token": {str(k): float(v) for k, v in self.vwap_per_token().items()},
+            "ohlc_per_token": ohlc_per_token,
+        }
+
+    def top_tokens_by_notional(self, k=5):
+        """The k tokens with the most traded notional, among those that traded"""
+        traded = np.unique(self.trades["token"])
+        notional = np.bincount(self.trades["token"], weights=self.trades["notional"], minlength=len(self.tokens))
+        return self.tokens[traded[largest(notional[traded], k)]].tolist()
+
+    def top_tokens_by_entries(self, k=5):
+        """The k tokens with most entries, ties going to the one seen first (as in value_counts)"""
+        totals = np.bincount(self.cell_tokens, weights=self.cell_entries, minlength=len(self.tokens))
+        return self.tokens[largest(totals, k, self.token_first_seen)].tolist()
+
+    def top_tokens_by_quantity(self, k=5):
+        """The k tokens with the largest quantity sum, ties going to the first in token order (as in nlargest)"""
+        totals = np.bincount(self.cell_tokens, weights=self.cell_quantity, minlength=len(self.tokens))
+        return self.tokens[largest(totals, k)].tolist()
+
+    def token_cells(self, token_code):
+        """Positions of one token's cells, in bucket order.
+
+        The cells are grouped by token once (an order plus per-token
+        offsets), after which each token's cells are a slice of that order.
+        """
+        if self._token_cells is None:
+            order = np.argsort(self.cell_tokens, kind="stable")
+            offsets = np.searchsorted(np.asarray(self.cell_tokens)[order], np.arange(len(self.tokens) + 1))
+            self._token_cells = order, offsets
+        order, offsets = self._token_cells
+        return order[offsets[token_code]:offsets[token_code + 1]]
+
+    def bucket_token_matrix(self, tokens, values="entries", all_buckets=True):
+        """Bucket x token table of entries or quantity for the given tokens.
+
+        With all_buckets False, only buckets where at least one of the tokens
+        has ticks are kept.
+        """
+        token_codes = np.sort(self.tokens.get_indexer(tokens))
+        token_codes = token_codes[token_codes >= 0]
+        cell_values = self.cell_entries if values == "entries" else self.cell_quantity
+
+        matrix = np.zeros((len(self.buckets), len(token_codes)), dtype=cell_values.dtype)
+        selected_buckets = []
+        for column, token_code in enumerate(token_codes):
+            cells = self.token_cells(token_code)
+            matrix[self.cell_buckets[cells], column] = cell_values[cells]
+            selected_buckets.append(self.cell_buckets[cells])
+
+        frame = pd.DataFrame(matrix, index=self.buckets, columns=self.tokens[token_codes])
+        if not all_buckets:
+            frame = frame.iloc[np.unique(np.concatenate(selected_buckets or [np.empty(0, dtype="int64")]))]
+        return frame
+
+
+def build_rollups(df, buckets=ROLLUP_BUCKETS, context=None):
+    """Aggregate the ticks at the finest bucket, then roll each coarser bucket up from the previous one"""
+    rollups = {buckets[0]: TickAggregates.from_ticks(df, buckets[0], context)}
+    for finer, coarser in zip(buckets, buckets[1:]):
+        rollups[coarser] = rollups[finer].rollup(coarser)
+    return rollups
+
+
+class RollupBuilder:
+    """build_rollups over tick frames added one at a time in file order, holding none of them.
+
+    Each frame is aggregated at the finest bucket width, with the rows before
+    it as context so T->N/M combos across frames are counted once. The
+    partial aggregates are merged pairwise as they arrive, like the carries
+    of a binary counter, so only a handful are held at once and each is
+    merged a logarithmic number of times; the coarser widths are rolled up
+    when rollups() is asked for.
+    """
+
+    def __init__(self, buckets=ROLLUP_BUCKETS, context=None):
+        self.buckets = buckets
+        self.context = context
+        # (number of frames merged into it, aggregates), in file order with the sizes decreasing
+        self.parts = []
+
+    def add(self, ticks):
+        if not len(ticks):
+            return
+        frames, part = 1, TickAggregates.from_ticks(ticks, self.buckets[0], self.context)
+        while self.parts and self.parts[-1][0] == frames:
+            earlier_frames, earlier = self.parts.pop()
+            frames, part = earlier_frames + frames, TickAggregates.merge([earlier, part])
+        self.parts.append((frames, part))
+        context = ticks if self.context is None else pd.concat([self.context, ticks], ignore_index=True)
+        self.context = context.tail(CONTEXT_ROWS).reset_index(drop=True)
+
+    def rollups(self):
+        """{bucket: TickAggregates} of everything added, or None if no rows were"""
+        if not self.parts:
+            return None
+        parts = [part for _, part in self.parts]
+        rollups = {self.buckets[0]: parts[0] if len(parts) == 1 else TickAggregates.merge(parts)}
+        for finer, coarser in zip(self.buckets, self.buckets[1:]):
+            rollups[coarser] = rollups[finer].rollup(coarser)
+        return rollups
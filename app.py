@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, render_template, request, jsonify, redirect, url_for, Response, send_from_directory
 import os
 import pandas as pd
 import matplotlib
@@ -13,9 +13,47 @@ from pytz import timezone
 import plotly.graph_objects as go
 import plotly.express as px
 from collections import OrderedDict
+import logging
+import shutil
+import json
+import queue
+import live
+from tick_cache import load_rollup, cached_dir, clear_cache, complete_last_line, content_id, iter_cached_ticks, CHUNK_ROWS
+from jobs import submit_job, get_job
+from patterns import PatternCounter, T_TO_NM
+from aggregates import ROLLUP_BUCKETS, DEFAULT_BUCKET, BUCKET_LABELS
+from render import render_figure
+from wire import pack_aggregates, PACKED_MIMETYPE
+from export import export_chunks, EXPORT_FORMATS
+from tick_query import filters_from_args, query_aggregates, LIST_FILTERS
+from decimate import decimate, merge_bars, merge_candles
+from figure_cache import figure_key, cached_figure
+from lifecycle import load_lifecycles, LATENCIES, LATENCY_BIN_EDGES
+from topk import largest
+from tick_store import store_upload, select_dates, history_aggregates, stored_date_info
+
+# Pipeline logging stays quiet unless TICK_LOG_LEVEL is set (INFO for per-upload counters,
+# DEBUG for sampled rejected rows and intermediate frames)
+logging.basicConfig(
+    level=os.environ.get("TICK_LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
 
 # Add a lock for matplotlib operations
 matplotlib_lock = threading.Lock()
+# Share of a job's progress bar spent parsing, the rest is aggregating (charts render on first view)
+PARSE_SHARE = 0.9
+
+# Points per chart series when the request gives no viewport width, and the range it may ask for
+DEFAULT_POINTS = 1000
+MIN_POINTS = 10
+MAX_POINTS = 20000
+# Series longer than this are drawn without a value label on every point
+LABELLED_POINTS = 50
+
+# An idle /stream connection gets a comment line this often so proxies keep it open
+STREAM_KEEPALIVE_SECONDS = 15
 
 app = Flask(__name__)
 
@@ -37,6 +75,7 @@ def reset_app():
             file_path = os.path.join(folder, f)
             if os.path.isfile(file_path):
                 os.remove(file_path)
+    clear_cache()
     return redirect("/")
 
 @app.route("/upload", methods=["POST"])
@@ -50,28 +89,126 @@ def upload_file():
 
     file_path = os.path.join(app.config["UPLOAD_FOLDER"], file.filename)
     file.save(file_path)
-
-    try:
-        process_file_and_generate_graphs(file_path)
-        return jsonify({"success": True, "message": "File processed successfully."}), 200
-    except Exception as e:
-        print(f"Exception occurred: {e}")
-        return jsonify({"success": False, "message": f"Error processing file: {str(e)}"}), 500
+    complete_last_line(file_path)
+
+    # Parsing and rendering run on the job pool, the browser polls /jobs/<id> for progress
+    job = submit_job(file.filename, process_file_and_generate_graphs, file_path)
+    return jsonify({
+        "success": True,
+        "message": "File queued for processing.",
+        "job_id": job.id,
+        "files": [file.filename]
+    }), 202
+
+@app.route("/uploads/<filename>/append", methods=["POST"])
+def append_upload(filename):
+    # A capture still writing the file posts the lines written since its last call (as a "file"
+    # part or the raw body); only those get parsed and merged into the upload's aggregates
+    if filename not in os.listdir(app.config["UPLOAD_FOLDER"]):
+        return jsonify({"success": False, "message": "File not found."}), 404
+
+    stream = request.files["file"].stream if "file" in request.files else request.stream
+    file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    with open(file_path, "ab") as upload:
+        shutil.copyfileobj(stream, upload)
+
+    job = submit_job(filename, process_file_and_generate_graphs, file_path)
+    return jsonify({
+        "success": True,
+        "message": "Appended data queued for processing.",
+        "job_id": job.id,
+        "files": [filename]
+    }), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "Job not found."}), 404
+    return jsonify({"success": True, "job": job.to_dict()}), 200
+
+def find_upload(filename=None):
+    """Path of the named upload, or of the first one if no name is given; None if there is no such file"""
+    uploads = os.listdir(UPLOAD_FOLDER)
+    if not filename:
+        filename = uploads[0] if uploads else None
+    if not filename or filename not in uploads:
+        return None
+    return os.path.join(UPLOAD_FOLDER, filename)
 
 @app.route("/graphs")
 def show_graphs():
     try:
-        graph_files = sorted(
-            [f for f in os.listdir(GRAPH_FOLDER) if f.endswith(".png")]
-        )
-        graph_urls = [url_for('static', filename=f'graphs/{f}') for f in graph_files]
-        print("Graph Files:", graph_files)  # Debug
-        print("Graph URLs:", graph_urls)  # Debug
-        return render_template("graphs.html", graph_urls=graph_urls)
+        # The page only links the charts; the browser fetches each figure's JSON and draws it
+        # with plotly.js when its slide is first shown
+        file_path = find_upload(request.args.get("file"))
+        charts = []
+        if file_path:
+            filename = os.path.basename(file_path)
+            charts = [{
+                "name": chart,
+                "figure_url": url_for("get_figure", chart=chart, file=filename),
+                "image_url": url_for("chart_image", chart=chart, fmt="png", file=filename)
+            } for chart in sorted(available_charts(load_rollup(file_path))) + available_lifecycle_charts(file_path)]
+        logger.debug("Charts: %s", charts)
+        return render_template("graphs.html", charts=charts, buckets=ROLLUP_BUCKETS[::-1], default_bucket=DEFAULT_BUCKET)
     except Exception as e:
-        print(f"Error in /graphs route: {e}")
+        logger.error("Error in /graphs route: %s", e)
         return jsonify({"success": False, "message": str(e)})
 
+@app.route("/charts/<chart>.<any(png, html):fmt>", methods=["GET"])
+def chart_image(chart, fmt):
+    # e.g. /charts/entries_per_hour.png?file=ticks.txt&bucket=5min (see figure_params), rendered on
+    # the first request and then served from the figure cache until the upload changes
+    if chart not in CHARTS and chart not in LIFECYCLE_CHARTS:
+        return jsonify({"success": False, "message": f"Unknown chart {chart!r}."}), 404
+    try:
+        params = figure_params(request.args)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    file_path = find_upload(request.args.get("file"))
+    if not file_path:
+        return jsonify({"success": False, "message": "No uploaded file found."}), 404
+
+    try:
+        file_name = chart_file(file_path, chart, fmt, params)
+    except LookupError as e:
+        return jsonify({"success": False, "message": str(e)}), 404
+    except Exception as e:
+        logger.error("Error rendering %s: %s", chart, e)
+        return jsonify({"success": False, "message": str(e)}), 500
+    return send_from_directory(GRAPH_FOLDER, file_name, max_age=0)
+
+@app.route("/api/figure/<chart>", methods=["GET"])
+def get_figure(chart):
+    # e.g. /api/figure/entries_per_hour?file=ticks.txt&bucket=1s&points=800&start=2025-01-02T10:00:00
+    # (see figure_params): just the figure's data and layout, for plotly.js to draw in the browser;
+    # built from the cached aggregates on each call. Zooming in asks again for the visible window
+    if chart not in CHARTS and chart not in LIFECYCLE_CHARTS:
+        return jsonify({"success": False, "message": f"Unknown chart {chart!r}."}), 404
+    try:
+        params = figure_params(request.args)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    file_path = find_upload(request.args.get("file"))
+    if not file_path:
+        return jsonify({"success": False, "message": "No uploaded file found."}), 404
+
+    try:
+        # Same key as the rendered files, so an unchanged upload is answered with 304 Not Modified
+        key = figure_key(content_id(file_path), chart, params)
+        if request.if_none_match.contains(key):
+            return Response(status=304, headers={"ETag": f'"{key}"'})
+        fig = build_chart(file_path, chart, params)
+        if fig is None:
+            return jsonify({"success": False, "message": f"Nothing to plot for {chart}."}), 404
+        response = jsonify({"success": True, "chart": chart, "params": params, "figure": json.loads(fig.to_json())})
+        response.set_etag(key)
+        return response
+    except Exception as e:
+        logger.error("Error in /api/figure/%s: %s", chart, e)
+        return jsonify({"success": False, "message": str(e)}), 500
+
 @app.route("/delete_uploads", methods=["POST"])
 def delete_uploads():
     try:
@@ -80,114 +217,182 @@ def delete_uploads():
                 file_path = os.path.join(folder, file)
                 if os.path.isfile(file_path):
                     os.remove(file_path)
+        clear_cache()
         return jsonify({"success": True, "message": "Uploads and graphs deleted successfully"})
     except Exception as e:
-        print(f"Error deleting files: {str(e)}")
+        logger.error("Error deleting files: %s", e)
         return jsonify({"success": False, "message": f"Error deleting files: {str(e)}"})
 
+def graph_data(aggregates):
+    """The /api/graph-data fields of an aggregates object"""
+    entries_per_hour = aggregates.entries_per_bucket().to_dict()
+    quantity_per_hour = aggregates.quantity_per_bucket().sort_values(ascending=False).to_dict()
+    quantity_per_token = aggregates.quantity_per_token().sort_values(ascending=False).to_dict()
+    # 🆕 New logic: Count number of orders per token
+    token_counts = aggregates.entries_per_token().to_dict()
+
+    # Prepare response data
+    return {
+        "bucket": aggregates.bucket,
+        "entries_per_hour": {str(k): v for k, v in entries_per_hour.items()},
+        "quantity_per_hour": {str(k): v for k, v in quantity_per_hour.items()},
+        "quantity_per_token": quantity_per_token,
+        "token_counts": token_counts,  # ✅ Included new field
+        # Trades only: notional (price x quantity), VWAP and open/high/low/close per bucket
+        **aggregates.trade_metrics()
+    }
+
 @app.route("/api/graph-data", methods=["GET"])
 def get_graph_data():
+    # e.g. /api/graph-data?bucket=5min; the *_per_hour fields then hold 5-minute buckets
+    bucket = request.args.get("bucket", DEFAULT_BUCKET)
+    if bucket not in ROLLUP_BUCKETS:
+        return jsonify({"success": False, "message": f"Unknown bucket {bucket!r}, expected one of {', '.join(ROLLUP_BUCKETS)}."}), 400
+    # e.g. &token=12863&action=T&start=2025-01-02T09:15&end=2025-01-02T10:00 (see tick_query)
     try:
-        # Load the processed data from the latest uploaded file
-        file_path = None
-        for file in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, file)
-            break
-
-        if not file_path or not os.path.exists(file_path):
+        filters = filters_from_args(request.args)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    try:
+        file_path = find_upload(request.args.get("file"))
+        if not file_path:
             return jsonify({"success": False, "message": "No uploaded file found."}), 404
 
-        adjusted_times, tokens, order_quantities, actions = [], [], [], []
+        aggregates = query_aggregates(file_path, bucket, **filters)
 
-        with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-            for line_num, line in enumerate(file, 1):
-                columns = line.strip().split(",")
-                if len(columns) < 8:
-                    continue
-                try:
-                    raw_epoch_time = int(columns[5])
-                    if raw_epoch_time > 1e18:
-                        epoch_time = (raw_epoch_time + 315532800000000000) / 1e9
-                    elif raw_epoch_time > 1e15:
-                        epoch_time = (raw_epoch_time + 315532800000000) / 1e6
-                    elif raw_epoch_time > 1e12:
-                        epoch_time = (raw_epoch_time + 315532800000) / 1e3
-                    else:
-                        epoch_time = raw_epoch_time + 315532800
-
-                    adjusted_time = pd.to_datetime(epoch_time, unit="s", origin="unix", utc=True)
-                    adjusted_time = adjusted_time.tz_convert("Asia/Calcutta")
-                except (ValueError, IndexError):
-                    continue
+        # Clients that send Accept: application/vnd.tick-columns get typed columns instead of JSON
+        if request.accept_mimetypes.best_match(["application/json", PACKED_MIMETYPE]) == PACKED_MIMETYPE:
+            return Response(pack_aggregates(aggregates), mimetype=PACKED_MIMETYPE, headers={"Vary": "Accept"})
 
-                token = columns[1].strip()
-                try:
-                    order_quantity = float(columns[-1].strip())
-                except ValueError:
-                    continue
-                action = columns[0].strip()
-
-                adjusted_times.append(adjusted_time)
-                tokens.append(token)
-                order_quantities.append(order_quantity)
-                actions.append(action)
-
-        df = pd.DataFrame({
-            "adjusted_time": adjusted_times,
-            "token": tokens,
-            "order_quantity": order_quantities,
-            "action": actions
-        })
-
-        df["token"] = df["token"].astype(str).str.strip()
-        df["order_quantity"] = pd.to_numeric(df["order_quantity"], errors="coerce")
-        df.dropna(subset=["order_quantity", "adjusted_time"], inplace=True)
-        df["adjusted_time"] = pd.to_datetime(df["adjusted_time"], errors="coerce")
-        df.dropna(subset=["adjusted_time"], inplace=True)
-        df["hour"] = df["adjusted_time"].dt.floor("H")
-
-        entries_per_hour = (
-            df.groupby("hour")
-            .size()
-            .sort_index()
-            .to_dict()
-        )
+        response = jsonify({"success": True, "data": graph_data(aggregates)})
+        response.headers["Vary"] = "Accept"
+        return response, 200
 
-        quantity_per_hour = (
-            df.groupby("hour")["order_quantity"]
-            .sum()
-            .sort_values(ascending=False)
-            .to_dict()
-        )
-
-        quantity_per_token = (
-            df.groupby("token")["order_quantity"]
-            .sum()
-            .sort_values(ascending=False)
-            .to_dict()
-        )
+    except Exception as e:
+        logger.error("Error in /api/graph-data: %s", e)
+        return jsonify({"success": False, "message": str(e)}), 500
+     
 
-        # 🆕 New logic: Count number of orders per token
-        token_counts = (
-            df["token"]
-            .value_counts()
-            .to_dict()
-        )
+@app.route("/api/history", methods=["GET"])
+def get_history():
+    # e.g. /api/history?token=12863&sessions=20 (orders per hour for a token over the last 20 stored
+    # trading dates) or ?from=2025-03-01&to=2025-03-31&bucket=15min&action=T; the same fields as
+    # /api/graph-data (or packed columns), over the dates of the persistent store
+    bucket = request.args.get("bucket", DEFAULT_BUCKET)
+    if bucket not in ROLLUP_BUCKETS:
+        return jsonify({"success": False, "message": f"Unknown bucket {bucket!r}, expected one of {', '.join(ROLLUP_BUCKETS)}."}), 400
+    try:
+        sessions = int(request.args["sessions"]) if request.args.get("sessions") else None
+        filters = {name: values for name, values in filters_from_args(request.args).items() if name not in ["start", "end"]}
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    try:
+        dates = select_dates(sessions, request.args.get("from"), request.args.get("to"))
+        aggregates = history_aggregates(bucket, dates, **filters)
+        if aggregates is None:
+            return jsonify({"success": False, "message": "No stored ticks match."}), 404
+
+        if request.accept_mimetypes.best_match(["application/json", PACKED_MIMETYPE]) == PACKED_MIMETYPE:
+            return Response(pack_aggregates(aggregates), mimetype=PACKED_MIMETYPE, headers={"Vary": "Accept"})
+        response = jsonify({"success": True, "data": {"dates": dates, **graph_data(aggregates)}})
+        response.headers["Vary"] = "Accept"
+        return response, 200
+    except Exception as e:
+        logger.error("Error in /api/history: %s", e)
+        return jsonify({"success": False, "message": str(e)}), 500
 
-        # Prepare response data
-        graph_data = {
-            "entries_per_hour": {str(k): v for k, v in entries_per_hour.items()},
-            "quantity_per_hour": {str(k): v for k, v in quantity_per_hour.items()},
-            "quantity_per_token": quantity_per_token,
-            "token_counts": token_counts  # ✅ Included new field
-        }
+@app.route("/api/history/dates", methods=["GET"])
+def get_history_dates():
+    # Every trading date in the persistent store, with the upload it came from and its row count
+    dates = [{name: info[name] for name in ["date", "upload", "rows"]} for info in stored_date_info()]
+    return jsonify({"success": True, "dates": dates}), 200
+
+@app.route("/api/pattern-counts", methods=["GET"])
+def get_pattern_counts():
+    # e.g. /api/pattern-counts?pattern=N->M->X&per_token=1
+    pattern = request.args.get("pattern", T_TO_NM)
+    per_token = request.args.get("per_token", "").lower() in ["1", "true", "yes"]
+    try:
+        file_path = find_upload(request.args.get("file"))
+        if not file_path:
+            return jsonify({"success": False, "message": "No uploaded file found."}), 404
+        # Matched a chunk at a time, carrying the rows a match can straddle the next chunk with
+        counter = PatternCounter(pattern, by=["hour", "token"], per_token=per_token)
+        for ticks in iter_cached_ticks(cached_dir(file_path), CHUNK_ROWS, ["action", "token", "adjusted_time"]):
+            counter.add(ticks.assign(hour=ticks["adjusted_time"].dt.floor("h")))
+        counts_per_hour = counter.counts("hour")
+        counts_per_token = counter.counts("token")
+
+        return jsonify({"success": True, "data": {
+            "pattern": pattern,
+            "per_token": per_token,
+            "counts_per_hour": {str(k): int(v) for k, v in counts_per_hour.items()},
+            "counts_per_token": {str(k): int(v) for k, v in counts_per_token.items() if v}
+        }}), 200
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    except Exception as e:
+        logger.error("Error in /api/pattern-counts: %s", e)
+        return jsonify({"success": False, "message": str(e)}), 500
 
-        return jsonify({"success": True, "data": graph_data}), 200
+@app.route("/api/order-latency", methods=["GET"])
+def get_order_latency():
+    # e.g. /api/order-latency?latency=to_fill&by=token&token=12863 or ?latency=to_cancel&bucket=15min
+    # (percentiles in seconds, by bucket of the time the order was placed, or by token)
+    latency = request.args.get("latency", "to_fill")
+    if latency not in LATENCIES:
+        return jsonify({"success": False, "message": f"Unknown latency {latency!r}, expected one of {', '.join(LATENCIES)}."}), 400
+    by = request.args.get("by", "hour")
+    bucket = request.args.get("bucket", DEFAULT_BUCKET)
+    if bucket not in ROLLUP_BUCKETS:
+        return jsonify({"success": False, "message": f"Unknown bucket {bucket!r}, expected one of {', '.join(ROLLUP_BUCKETS)}."}), 400
+    try:
+        filters = filters_from_args(request.args)
+        file_path = find_upload(request.args.get("file"))
+        if not file_path:
+            return jsonify({"success": False, "message": "No uploaded file found."}), 404
 
+        lifecycles = load_lifecycles(file_path).select(**filters)
+        percentiles = lifecycles.percentiles(latency, by=by, bucket=bucket)
+        return jsonify({"success": True, "data": {
+            "latency": latency,
+            "by": by,
+            "orders": len(lifecycles),
+            "percentiles": {str(k): row for k, row in percentiles.to_dict("index").items()}
+        }}), 200
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
     except Exception as e:
-        print(f"Error in /api/graph-data: {e}")
+        logger.error("Error in /api/order-latency: %s", e)
         return jsonify({"success": False, "message": str(e)}), 500
-     
+
+@app.route("/stream", methods=["GET"])
+def stream_live_data():
+    # EventSource("/stream?file=ticks.txt"): a "snapshot" event with the hourly and per-token
+    # totals so far, then a "delta" event to add on each time new lines reach the file (or pipe)
+    filename = request.args.get("file")
+    if not filename:
+        for file in os.listdir(UPLOAD_FOLDER):
+            filename = file
+            break
+    if not filename or filename not in os.listdir(UPLOAD_FOLDER):
+        return jsonify({"success": False, "message": "No uploaded file found."}), 404
+
+    tail, subscriber = live.subscribe(os.path.join(UPLOAD_FOLDER, filename))
+
+    def events():
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            live.unsubscribe(tail, subscriber)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 def create_plot(df, x_data, y_data, title, xlabel, ylabel, filename, color='#1f77b4', marker='o', 
                 linewidth=2, label=None, legend_needed=False, more_series=None):
@@ -224,15 +429,13 @@ def create_plot(df, x_data, y_data, title, xlabel, ylabel, filename, color='#1f7
         x_data = pd.to_datetime(x_data).tz_convert("Asia/Calcutta")
         
         # Debug: Print the x-axis data after localization
-        print("X-Axis Data (Localized to IST):")
-        print(x_data)
+        logger.debug("X-Axis Data (Localized to IST):\n%s", x_data)
         
         # Set x-ticks to the actual time values from the data
         unique_hours = sorted(x_data.unique())
         
         # Debug: Print the unique hours
-        print("Unique hours (x-axis tick values):")
-        print(unique_hours)
+        logger.debug("Unique hours (x-axis tick values):\n%s", unique_hours)
         
         ax.set_xticks(unique_hours)  # Set the x-ticks to unique_hours
         ax.set_xticklabels([hour.strftime('%H:%M') for hour in unique_hours])  # Use unique_hours as labels
@@ -262,190 +465,119 @@ def create_plot(df, x_data, y_data, title, xlabel, ylabel, filename, color='#1f7
         plt.savefig(os.path.join(GRAPH_FOLDER, filename), dpi=100)
         plt.close()  # Important: close plot to free memory
 
-def process_file_and_generate_graphs(file_path):
+def process_file_and_generate_graphs(file_path, progress=None):
     start_time = time.time()
-    adjusted_times, tokens, order_quantities, actions = [], [], [], []
-
-    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-        for line_num, line in enumerate(file, 1):
-            print(f"Line {line_num}: {line.strip()}")  # Debug: Print each line
-            columns = line.strip().split(",")
-            if len(columns) < 8:
-                print(f"Skipping line {line_num}: Not enough columns")
-                continue
-            try:
-                raw_epoch_time = int(columns[5])
-                token = columns[1].strip()
-                order_quantity = float(columns[-1].strip())
-                action = columns[0].strip()
-            except (ValueError, IndexError) as e:
-                print(f"Skipping line {line_num}: {e}")
-                continue
-            try:
-                print(f"Columns: {columns}")  # Debug: Print split columns
-                print(f"Raw Epoch Time: {raw_epoch_time}")  # Debug: Print raw epoch time
-                if raw_epoch_time > 1e18:
-                    epoch_time = (raw_epoch_time + 315532800000000000) / 1e9
-                elif raw_epoch_time > 1e15:
-                    epoch_time = (raw_epoch_time + 315532800000000) / 1e6
-                elif raw_epoch_time > 1e12:
-                    epoch_time = (raw_epoch_time + 315532800000) / 1e3
-                else:
-                    epoch_time = raw_epoch_time + 315532800
-
-                adjusted_time = pd.to_datetime(epoch_time, unit="s", origin="unix", utc=True)
-                adjusted_time = adjusted_time.tz_convert("Asia/Calcutta")
-                print(f"Adjusted Time: {adjusted_time}")  # Debug: Print adjusted time
-
-                print(f"Token: {token}")  # Debug
-
-                print(f"Order Quantity: {order_quantity}")  # Debug
-
-                print(f"Action: {action}")  # Debug
-
-                adjusted_times.append(adjusted_time)
-                tokens.append(token)
-                order_quantities.append(order_quantity)
-                actions.append(action)
-            except (ValueError, IndexError) as e:
-                print(f"Error processing line: {e}")  # Debug
-                continue
-
-    if not adjusted_times:
-        print("Adjusted Times list is empty!")
-    if not tokens:
-        print("Tokens list is empty!")
-    if not order_quantities:
-        print("Order Quantities list is empty!")
-    if not actions:
-        print("Actions list is empty!")
-
-    print("Adjusted Times:", adjusted_times[:10])  # Print the first 10 entries
-    print("Tokens:", tokens[:10])  # Print the first 10 entries
-    print("Order Quantities:", order_quantities[:10])  # Print the first 10 entries
-    print("Actions:", actions[:10])  # Print the first 10 entries
-
-    df = pd.DataFrame({
-        "adjusted_time": adjusted_times,
-        "token": tokens,
-        "order_quantity": order_quantities,
-        "action": actions
-    })
-
-    df["token"] = df["token"].astype(str).str.strip()
-    df["order_quantity"] = pd.to_numeric(df["order_quantity"], errors="coerce")
-    print("Order Quantity Conversion:\n", df["order_quantity"].head())  # Debug: Check order_quantity column
-    df.dropna(subset=["order_quantity"], inplace=True)
-    print("DataFrame After Order Quantity Filtering:\n", df.head())  # Debug: Check DataFrame after filtering
-    df["adjusted_time"] = pd.to_datetime(df["adjusted_time"], errors="coerce")
-    print("Adjusted Time Conversion:\n", df["adjusted_time"].head())  # Debug: Check adjusted_time column
-    df.dropna(subset=["adjusted_time"], inplace=True)
-    print("DataFrame After Adjusted Time Filtering:\n", df.head())  # Debug: Check DataFrame after filtering
-    df["hour"] = df["adjusted_time"].dt.floor("H")
-
-    df["hour"] = pd.to_datetime(df["hour"], errors="coerce")
-    df["order_quantity"] = pd.to_numeric(df["order_quantity"], errors="coerce")
-    df.dropna(subset=["hour", "order_quantity"], inplace=True)
-
-    entries_per_hour = df.groupby("hour").size()
-    print("Entries Per Hour:\n", entries_per_hour)  # Debug: Print entries per hour
-
-    quantity_per_hour = df.groupby("hour")["order_quantity"].sum()
-    print("Quantity Per Hour:\n", quantity_per_hour)  # Debug: Print quantity per hour
+    parse_progress = None
+    if progress:
+        parse_progress = lambda done, total, rows: progress("parsing", PARSE_SHARE * done / max(total, 1), rows)
+    # Parses only what was added to the file since it was last read, and keeps every bucket
+    # width of its rollup pyramid up to date. Charts are rendered later, when first asked for
+    aggregates = load_rollup(file_path, progress=parse_progress)
+    rows = int(aggregates.cell_entries.sum())
+    if progress:
+        progress("aggregating", PARSE_SHARE, rows)
+    # Order lifecycles too, which the graphs page needs to know whether to list the latency charts
+    load_lifecycles(file_path)
+    # Then each trading date goes into the persistent store, which outlives the upload. That is a
+    # job of its own, so the upload is reported done as soon as its charts can be drawn
+    submit_job(os.path.basename(file_path), store_upload, file_path)
+
+    if not rows:
+        logger.warning("No valid rows parsed from %s", file_path)
+
+    logger.info("File processing completed in %.2f seconds.", time.time() - start_time)
+
+def entries_per_hour_figure(aggregates, points=None):
+    entries_per_hour = decimate(aggregates.entries_per_bucket(), points)
+    labelled = len(entries_per_hour) <= LABELLED_POINTS
+    logger.debug("Entries Per Hour:\n%s", entries_per_hour)
 
     # Graph 1: Number of Entries per Hour
-    entries_per_hour = df.groupby("hour").size()
     fig = go.Figure()
     fig.add_trace(go.Scatter(
         x=entries_per_hour.index,
         y=entries_per_hour.values,
-        mode='lines+markers+text',
+        mode='lines+markers+text' if labelled else 'lines',
         name='Entries',
-        text=entries_per_hour.values,
+        text=entries_per_hour.values if labelled else None,
         textposition="top center"
     ))
-    fig.update_layout(title="Number of Entries per Hour", xaxis_title="Time", yaxis_title="Number of Entries")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "entries_per_hour.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "entries_per_hour.png"))
+    fig.update_layout(title=f"Number of Entries per {BUCKET_LABELS[aggregates.bucket]}", xaxis_title="Time", yaxis_title="Number of Entries")
+    return fig
+
+def order_quantity_per_hour_figure(aggregates, points=None):
+    quantity_per_hour = decimate(aggregates.quantity_per_bucket(), points)
+    labelled = len(quantity_per_hour) <= LABELLED_POINTS
+    logger.debug("Quantity Per Hour:\n%s", quantity_per_hour)
 
     # Graph 2: Total Order Quantity per Hour
-    quantity_per_hour = df.groupby("hour")["order_quantity"].sum()
     fig = go.Figure()
     fig.add_trace(go.Scatter(
         x=quantity_per_hour.index,
         y=quantity_per_hour.values,
-        mode='lines+markers+text',
+        mode='lines+markers+text' if labelled else 'lines',
         name='Quantity',
-        text=quantity_per_hour.values,
+        text=quantity_per_hour.values if labelled else None,
         textposition="top center"
     ))
-    fig.update_layout(title="Total Order Quantity per Hour", xaxis_title="Time", yaxis_title="Total Order Quantity")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "order_quantity_per_hour.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "order_quantity_per_hour.png"))
+    fig.update_layout(title=f"Total Order Quantity per {BUCKET_LABELS[aggregates.bucket]}", xaxis_title="Time", yaxis_title="Total Order Quantity")
+    return fig
 
+def t_nm_combo_count_per_hour_figure(aggregates, points=None):
     # Graph 3: T to N/M Combination Count per Hour
-    combo_hours = []
-    for i in range(len(df) - 1):
-        if df.iloc[i]["action"] == "T" and df.iloc[i + 1]["action"] in ["N", "M"]:
-            combo_hours.append(df.iloc[i]["hour"])
-    if combo_hours:
-        combo_series = pd.Series(combo_hours).value_counts().sort_index()
-        fig = go.Figure()
-        fig.add_trace(go.Bar(
-            x=combo_series.index,
-            y=combo_series.values,
-            name='T to N/M Combinations',
-            text=combo_series.values,
-            textposition="outside"
-        ))
-        fig.update_layout(title="T to N/M Combination Count per Hour", xaxis_title="Time", yaxis_title="T to N/M Combinations")
-        fig.write_html(os.path.join(GRAPH_FOLDER, "t_nm_combo_count_per_hour.html"))
-        fig.write_image(os.path.join(GRAPH_FOLDER, "t_nm_combo_count_per_hour.png"))
+    combo_series = merge_bars(aggregates.combos_per_bucket(), points)
+    if combo_series.empty:
+        return None
+    labelled = len(combo_series) <= LABELLED_POINTS
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=combo_series.index,
+        y=combo_series.values,
+        name='T to N/M Combinations',
+        text=combo_series.values if labelled else None,
+        textposition="outside"
+    ))
+    fig.update_layout(title=f"T to N/M Combination Count per {BUCKET_LABELS[aggregates.bucket]}", xaxis_title="Time", yaxis_title="T to N/M Combinations")
+    return fig
 
+def top_5_tokens_orders_per_hour_figure(aggregates, points=None):
     # Graph 4: Top 5 Tokens by Number of Orders Per Hour
-    top_5_tokens = df["token"].value_counts().head(5).index.tolist()
-    df_top_tokens = df[df["token"].isin(top_5_tokens)]
-    if not df_top_tokens.empty:
-        orders_per_hour = df_top_tokens.groupby(["hour", "token"]).size().unstack(fill_value=0).sort_index()
-        fig = px.line(
-            orders_per_hour,
+    top_5_tokens = aggregates.top_tokens_by_entries(5)
+    if not top_5_tokens:
+        return None
+    # Only the hours in which one of the top tokens traded
+    orders_per_hour = decimate(aggregates.bucket_token_matrix(top_5_tokens, "entries", all_buckets=False), points)
+    fig = px.line(
+        orders_per_hour,
+        x=orders_per_hour.index,
+        y=orders_per_hour.columns,
+        title=f"Top 5 Tokens by Number of Orders Per {BUCKET_LABELS[aggregates.bucket]}"
+    )
+    # Annotate values, unless there are too many to read
+    for token in orders_per_hour.columns if len(orders_per_hour) <= LABELLED_POINTS else []:
+        fig.add_scatter(
             x=orders_per_hour.index,
-            y=orders_per_hour.columns,
-            title="Top 5 Tokens by Number of Orders Per Hour"
+            y=orders_per_hour[token],
+            mode="text",
+            text=orders_per_hour[token],
+            textposition="top center",
+            showlegend=False
         )
-        # Annotate values
-        for token in orders_per_hour.columns:
-            fig.add_scatter(
-                x=orders_per_hour.index,
-                y=orders_per_hour[token],
-                mode="text",
-                text=orders_per_hour[token],
-                textposition="top center",
-                showlegend=False
-            )
-        fig.update_layout(xaxis_title="Time", yaxis_title="Number of Orders")
-        fig.write_html(os.path.join(GRAPH_FOLDER, "top_5_tokens_orders_per_hour.html"))
-        fig.write_image(os.path.join(GRAPH_FOLDER, "top_5_tokens_orders_per_hour.png"))
+    fig.update_layout(xaxis_title="Time", yaxis_title="Number of Orders")
+    return fig
 
+def top_5_tokens_quantity_per_hour_figure(aggregates, points=None):
     # Graph 5: Top 5 Tokens by Quantity Traded per Hour (with zeros for missing)
-    top_5_qty_tokens = df.groupby("token")["order_quantity"].sum().nlargest(5).index.tolist()
-    df_top_qty = df[df["token"].isin(top_5_qty_tokens)]
-    all_hours = df["hour"].sort_values().unique()
-    multi_index = pd.MultiIndex.from_product([all_hours, top_5_qty_tokens], names=["hour", "token"])
-    qty_per_hour = (
-        df_top_qty.groupby(["hour", "token"])["order_quantity"].sum()
-        .reindex(multi_index, fill_value=0)
-        .unstack(fill_value=0)
-        .sort_index()
-    )
+    top_5_qty_tokens = aggregates.top_tokens_by_quantity(5)
+    qty_per_hour = decimate(aggregates.bucket_token_matrix(top_5_qty_tokens, "order_quantity"), points)
     fig = px.line(
         qty_per_hour,
         x=qty_per_hour.index,
         y=qty_per_hour.columns,
-        title="Top 5 Tokens by Total Quantity Per Hour"
+        title=f"Top 5 Tokens by Total Quantity Per {BUCKET_LABELS[aggregates.bucket]}"
     )
-    # Annotate values
-    for token in qty_per_hour.columns:
+    # Annotate values, unless there are too many to read
+    for token in qty_per_hour.columns if len(qty_per_hour) <= LABELLED_POINTS else []:
         fig.add_scatter(
             x=qty_per_hour.index,
             y=qty_per_hour[token],
@@ -455,19 +587,19 @@ def process_file_and_generate_graphs(file_path):
             showlegend=False
         )
     fig.update_layout(xaxis_title="Time", yaxis_title="Total Quantity")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "top_5_tokens_quantity_per_hour.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "top_5_tokens_quantity_per_hour.png"))
+    return fig
 
+def entries_per_token_pie_figure(aggregates, points=None):
     # Graph 6: Pie Chart of Number of Entries for Each Unique Token
-    entries_per_token = df["token"].value_counts()
-    print("Entries Per Token Before Grouping:\n", entries_per_token)  # Debug: Check raw data
+    entries_per_token = aggregates.entries_per_token()
+    logger.debug("Entries Per Token Before Grouping:\n%s", entries_per_token)
 
     # Calculate the total number of entries
     total_entries = entries_per_token.sum()
 
     # Calculate percentages
     percentages = (entries_per_token / total_entries) * 100
-    print("Percentages Per Token:\n", percentages)  # Debug: Check percentages
+    logger.debug("Percentages Per Token:\n%s", percentages)
 
     # Separate tokens below 1% into "Others"
     above_threshold = percentages[percentages >= 1]
@@ -483,23 +615,22 @@ def process_file_and_generate_graphs(file_path):
     final_names = above_threshold.index
 
     # Debug: Check final values and names
-    print("Final Values for Pie Chart:\n", final_values)
-    print("Final Names for Pie Chart:\n", final_names)
+    logger.debug("Final Values for Pie Chart:\n%s", final_values)
+    logger.debug("Final Names for Pie Chart:\n%s", final_names)
 
     # Create the pie chart
-    fig = px.pie(values=final_values, names=final_names, title="Number of Entries for Each Unique Token (with Others)")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "entries_per_token_pie.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "entries_per_token_pie.png"))
+    return px.pie(values=final_values, names=final_names, title="Number of Entries for Each Unique Token (with Others)")
 
+def total_quantity_per_token_pie_figure(aggregates, points=None):
     # Graph 7: Pie Chart of Total Quantity Traded for Each Unique Token
-    quantity_per_token = df.groupby("token")["order_quantity"].sum().sort_values(ascending=False)
+    quantity_per_token = aggregates.quantity_per_token().sort_values(ascending=False)
 
     # Calculate the total quantity
     total_quantity = quantity_per_token.sum()
 
     # Calculate percentages
     percentages = (quantity_per_token / total_quantity) * 100
-    print("Percentages:\n", percentages)  # Debug: Check percentages
+    logger.debug("Percentages:\n%s", percentages)
 
     # Separate tokens below 1% into "Others"
     above_threshold = percentages[percentages >= 1]
@@ -515,82 +646,196 @@ def process_file_and_generate_graphs(file_path):
     final_names = above_threshold.index
 
     # Debug: Check final values and names
-    print("Final Values for Pie Chart:\n", final_values)
-    print("Final Names for Pie Chart:\n", final_names)
+    logger.debug("Final Values for Pie Chart:\n%s", final_values)
+    logger.debug("Final Names for Pie Chart:\n%s", final_names)
 
     # Create the pie chart
-    fig = px.pie(values=final_values, names=final_names, title="Total Quantity Traded for Each Unique Token (with Others)")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "total_quantity_per_token_pie.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "total_quantity_per_token_pie.png"))
+    return px.pie(values=final_values, names=final_names, title="Total Quantity Traded for Each Unique Token (with Others)")
 
-    print(f"\n✅ File processing completed in {time.time() - start_time:.2f} seconds.")
+def notional_turnover_per_hour_figure(aggregates, points=None):
+    # Traded value (price x quantity of the T rows) per bucket
+    notional_per_hour = merge_bars(aggregates.notional_per_bucket(), points)
+    if not notional_per_hour.any():
+        return None
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=notional_per_hour.index, y=notional_per_hour.values, name='Notional'))
+    fig.update_layout(title=f"Notional Turnover per {BUCKET_LABELS[aggregates.bucket]}", xaxis_title="Time", yaxis_title="Notional (Price x Quantity)")
+    return fig
+
+def ohlc_candlestick_figure(aggregates, points=None):
+    # Candlesticks with VWAP for the token with the most traded notional (or the one filtered to)
+    top_token = aggregates.top_tokens_by_notional(1)
+    if not top_token:
+        return None
+    ohlc = merge_candles(aggregates.ohlc(top_token[0]), points)
+    fig = go.Figure()
+    fig.add_trace(go.Candlestick(
+        x=ohlc.index, open=ohlc["open"], high=ohlc["high"], low=ohlc["low"], close=ohlc["close"], name='OHLC'
+    ))
+    fig.add_trace(go.Scatter(x=ohlc.index, y=ohlc["vwap"], mode='lines', name='VWAP'))
+    fig.update_layout(
+        title=f"Token {top_token[0]} Trade Price per {BUCKET_LABELS[aggregates.bucket]} (OHLC and VWAP)",
+        xaxis_title="Time", yaxis_title="Price", xaxis_rangeslider_visible=False
+    )
+    return fig
+
+def order_latency_histogram_figure(lifecycles, bucket=DEFAULT_BUCKET, points=None):
+    # Distribution of the time from placing an order to its first modify, cancel and fill
+    centers = np.sqrt(LATENCY_BIN_EDGES[:-1] * LATENCY_BIN_EDGES[1:])
+    fig = go.Figure()
+    for name, (_, label) in LATENCIES.items():
+        counts = lifecycles.histogram(name)
+        if counts.any():
+            fig.add_trace(go.Bar(x=centers, y=counts, name=label))
+    if not fig.data:
+        return None
+    fig.update_layout(title="Order Latency Distribution", xaxis_title="Seconds after the Order was Placed",
+                      yaxis_title="Number of Orders", barmode="overlay", xaxis_type="log")
+    fig.update_traces(opacity=0.6)
+    return fig
+
+def order_latency_percentiles_per_hour_figure(lifecycles, bucket=DEFAULT_BUCKET, points=None):
+    # Median and 90th percentile latency of the orders placed in each bucket
+    fig = go.Figure()
+    for name, (_, label) in LATENCIES.items():
+        percentiles = decimate(lifecycles.percentiles(name, bucket=bucket)[["p50", "p90"]], points)
+        for column, dash in [("p50", "solid"), ("p90", "dash")]:
+            fig.add_trace(go.Scatter(
+                x=percentiles.index,
+                y=percentiles[column],
+                mode="lines+markers" if len(percentiles) <= LABELLED_POINTS else "lines",
+                name=f"{label} ({column})",
+                line={"dash": dash}
+            ))
+    if not any(len(trace.x) for trace in fig.data):
+        return None
+    fig.update_layout(title=f"Order Latency Percentiles per {BUCKET_LABELS[bucket]}", xaxis_title="Time of Order",
+                      yaxis_title="Seconds", yaxis_type="log")
+    return fig
+
+def order_latency_per_token_figure(lifecycles, bucket=DEFAULT_BUCKET, points=None):
+    # Median latency of the 10 tokens with the most orders placed
+    orders_per_token = np.bincount(lifecycles.token_codes, minlength=len(lifecycles.tokens))
+    tokens = lifecycles.tokens[largest(orders_per_token, 10)]
+    fig = go.Figure()
+    for name, (_, label) in LATENCIES.items():
+        percentiles = lifecycles.percentiles(name, by="token").reindex(tokens)
+        fig.add_trace(go.Bar(
+            x=tokens.astype(str),
+            y=percentiles["p50"],
+            name=label,
+            customdata=percentiles[["p90", "orders"]].fillna(0),
+            hovertemplate="%{x}: median %{y:.3g}s, p90 %{customdata[0]:.3g}s over %{customdata[1]} orders"
+        ))
+    if not any(np.isfinite(trace.y.astype(float)).any() for trace in fig.data):
+        return None
+    fig.update_layout(title="Median Order Latency for the Top 10 Tokens by Orders Placed", xaxis_title="Token",
+                      yaxis_title="Seconds", barmode="group", xaxis_type="category")
+    return fig
+
+# Chart name -> function building its figure from the upload's aggregates, with each time series
+# drawn with at most points points: lines decimated, bars and candles merged (None if there is nothing to plot)
+CHARTS = OrderedDict([
+    ("entries_per_hour", entries_per_hour_figure),
+    ("order_quantity_per_hour", order_quantity_per_hour_figure),
+    ("t_nm_combo_count_per_hour", t_nm_combo_count_per_hour_figure),
+    ("top_5_tokens_orders_per_hour", top_5_tokens_orders_per_hour_figure),
+    ("top_5_tokens_quantity_per_hour", top_5_tokens_quantity_per_hour_figure),
+    ("entries_per_token_pie", entries_per_token_pie_figure),
+    ("total_quantity_per_token_pie", total_quantity_per_token_pie_figure),
+    ("notional_turnover_per_hour", notional_turnover_per_hour_figure),
+    ("ohlc_candlestick", ohlc_candlestick_figure),
+])
+
+# Chart name -> function building its figure from the upload's order lifecycles at a bucket width
+LIFECYCLE_CHARTS = OrderedDict([
+    ("order_latency_histogram", order_latency_histogram_figure),
+    ("order_latency_percentiles_per_hour", order_latency_percentiles_per_hour_figure),
+    ("order_latency_per_token", order_latency_per_token_figure),
+])
+
+def available_charts(aggregates):
+    """Charts with something to plot, without building their figures"""
+    charts = list(CHARTS)
+    if aggregates.combos_per_bucket().empty:
+        charts.remove("t_nm_combo_count_per_hour")
+    if not aggregates.top_tokens_by_entries(5):
+        charts.remove("top_5_tokens_orders_per_hour")
+    if not aggregates.top_tokens_by_notional(1):
+        charts.remove("notional_turnover_per_hour")
+        charts.remove("ohlc_candlestick")
+    return charts
+
+def available_lifecycle_charts(file_path):
+    """Order latency charts, if any order in the upload was modified, cancelled or filled"""
+    lifecycles = load_lifecycles(file_path)
+    if not any((~np.isnan(lifecycles.latencies[name])).any() for name in LATENCIES):
+        return []
+    return list(LIFECYCLE_CHARTS)
+
+def figure_params(args):
+    """Bucket width, filters and points per series asked for in a chart request's query string.
+
+    The filters (token, action, side, start and end) are those of
+    tick_query; points is the most points each time series is drawn with,
+    normally the chart's width in pixels. All are returned as plain JSON
+    values, ready to key the figure cache. Raises ValueError if any of them
+    is invalid.
+
+    A zoomed window is widened to whole buckets (start floored, end
+    ceiled), so it is cut from the rollup instead of re-aggregating ticks.
+    """
+    bucket = args.get("bucket", DEFAULT_BUCKET)
+    if bucket not in ROLLUP_BUCKETS:
+        raise ValueError(f"Unknown bucket {bucket!r}, expected one of {', '.join(ROLLUP_BUCKETS)}.")
+    params = {"bucket": bucket, "points": min(max(int(args.get("points", DEFAULT_POINTS)), MIN_POINTS), MAX_POINTS)}
+    for name, value in filters_from_args(args).items():
+        if name == "start":
+            params[name] = value.floor(bucket).isoformat()
+        elif name == "end":
+            params[name] = value.ceil(bucket).isoformat()
+        else:
+            params[name] = sorted(set(value))
+    return params
+
+def build_chart(file_path, chart, params):
+    filters = {name: params[name] for name, _ in LIST_FILTERS if name in params}
+    filters.update({name: pd.Timestamp(params[name]) for name in ["start", "end"] if name in params})
+    if chart in LIFECYCLE_CHARTS:
+        return LIFECYCLE_CHARTS[chart](load_lifecycles(file_path).select(**filters), params["bucket"], params["points"])
+    return CHARTS[chart](query_aggregates(file_path, params["bucket"], **filters), params["points"])
+
+def chart_file(file_path, chart, fmt, params):
+    """Name of the rendered chart in GRAPH_FOLDER, rendering it now if it is not cached yet"""
+    key = figure_key(content_id(file_path), chart, params)
+
+    def render(path):
+        fig = build_chart(file_path, chart, params)
+        if fig is None:
+            raise LookupError(f"Nothing to plot for {chart}.")
+        render_figure(fig, path)
+
+    return cached_figure(GRAPH_FOLDER, chart, key, fmt, render)
 
 @app.route("/export-processed-data", methods=["GET"])
 def export_processed_data():
-    # Find the latest uploaded file
-    file_path = None
-    for file in os.listdir(UPLOAD_FOLDER):
-        file_path = os.path.join(UPLOAD_FOLDER, file)
-        break
-
+    # e.g. ?file=ticks.txt&format=csv.gz&token=NIFTY,BANKNIFTY&action=T&start=2025-01-02T10:00
+    # Streamed from the cached columns a chunk at a time, so even a very large upload is never
+    # held in memory as a whole
+    file_path = find_upload(request.args.get("file"))
     if not file_path or not os.path.exists(file_path):
         return "No processed data available.", 404
 
-    # Re-process the file to ensure it's clean (or load from where you save processed data)
-    adjusted_times, tokens, order_quantities, actions = [], [], [], []
-    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-        for line_num, line in enumerate(file, 1):
-            columns = line.strip().split(",")
-            if len(columns) < 8:
-                continue
-            try:
-                raw_epoch_time = int(columns[5])
-                if raw_epoch_time > 1e18:
-                    epoch_time = (raw_epoch_time + 315532800000000000) / 1e9
-                elif raw_epoch_time > 1e15:
-                    epoch_time = (raw_epoch_time + 315532800000000) / 1e6
-                elif raw_epoch_time > 1e12:
-                    epoch_time = (raw_epoch_time + 315532800000) / 1e3
-                else:
-                    epoch_time = raw_epoch_time + 315532800
-                adjusted_time = pd.to_datetime(epoch_time, unit="s", origin="unix", utc=True)
-                adjusted_time = adjusted_time.tz_convert("Asia/Calcutta")
-            except (ValueError, IndexError):
-                continue
-
-            token = columns[1].strip()
-            try:
-                order_quantity = float(columns[-1].strip())
-            except ValueError:
-                continue
-            action = columns[0].strip()
-
-            adjusted_times.append(adjusted_time)
-            tokens.append(token)
-            order_quantities.append(order_quantity)
-            actions.append(action)
-
-    df = pd.DataFrame({
-        "adjusted_time": adjusted_times,
-        "token": tokens,
-        "order_quantity": order_quantities,
-        "action": actions
+    export_format = request.args.get("format", "csv")
+    try:
+        chunks = export_chunks(file_path, export_format, **filters_from_args(request.args))
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    return Response(chunks, mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename=processed_data.{extension}"
     })
-    df["hour"] = df["adjusted_time"].dt.floor("H")
-
-    # Export as CSV
-    from io import StringIO
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-    csv_buffer.seek(0)
-    return (
-        csv_buffer.getvalue(),
-        200,
-        {
-            "Content-Type": "text/csv",
-            "Content-Disposition": "attachment; filename=processed_data.csv"
-        }
-    )
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
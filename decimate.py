@@ -0,0 +1,97 @@
+"""Downsampling of long time series for charting.
+
+Largest-Triangle-Three-Buckets (LTTB) keeps the first and last point and,
+from each of points - 2 equal buckets in between, the one point that forms
+the largest triangle with the point kept before it and the mean of the next
+bucket. Spikes and dips survive, which plain striding would drop.
+
+LTTB is only for lines. Candlesticks and bars are not sampled but merged:
+runs of neighbouring candles become one, so no high or low is lost, and
+runs of neighbouring bars become one bar of their total, so no bar's
+count goes missing.
+"""
+import numpy as np
+import pandas as pd
+
+
+def lttb_indices(x, y, points):
+    """Positions of the points LTTB keeps to draw x/y (both numeric) with at most points points"""
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    # Bucket edges over the points between the first and the last
+    edges = np.linspace(1, n - 1, points - 1).astype("int64")
+
+    kept = np.empty(points, dtype="int64")
+    kept[0], kept[-1] = 0, n - 1
+    previous = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # Twice the triangle area, which ranks the candidates just the same
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(areas.argmax())
+        kept[i + 1] = previous
+    return kept
+
+
+def decimate(data, points):
+    """Rows of a time-indexed Series or DataFrame that LTTB keeps for each column, in index order.
+
+    For a frame, each column picks an equal share of the points and the
+    rows kept for any one column are kept for all of them, so every column
+    stays drawn at its own peaks.
+    """
+    columns = [data] if isinstance(data, pd.Series) else [data[column] for column in data.columns]
+    if points is None or len(data) <= points or not columns:
+        return data
+    x = data.index.asi8 if isinstance(data.index, pd.DatetimeIndex) else np.arange(len(data))
+    share = max(points // len(columns), 3)
+    kept = np.unique(np.concatenate([lttb_indices(x, column.to_numpy(), share) for column in columns]))
+    return data.iloc[kept]
+
+
+def _runs(length, points):
+    """Group number of each of length rows, cut into at most points runs of neighbouring rows"""
+    return np.arange(length) // -(-length // points)
+
+
+def merge_bars(data, points):
+    """At most points bars from a Series or DataFrame of per-bucket totals, summing runs of neighbouring rows.
+
+    Each merged bar is indexed by the first row of its run.
+    """
+    if points is None or len(data) <= points:
+        return data
+    groups = _runs(len(data), points)
+    merged = data.groupby(groups).sum()
+    merged.index = data.index[np.flatnonzero(np.diff(groups, prepend=-1))]
+    return merged
+
+
+def merge_candles(ohlc, points):
+    """At most points candles from an open/high/low/close frame, merging runs of neighbouring rows.
+
+    Each merged candle is indexed by its first row and takes that row's
+    open, the last row's close and the extreme high and low; quantity and
+    notional (if present) are summed and vwap recomputed from them.
+    """
+    if points is None or len(ohlc) <= points:
+        return ohlc
+    groups = _runs(len(ohlc), points)
+    spec = {"open": "first", "high": "max", "low": "min", "close": "last", "quantity": "sum", "notional": "sum"}
+    merged = ohlc.groupby(groups).agg({column: how for column, how in spec.items() if column in ohlc.columns})
+    merged.index = ohlc.index[np.flatnonzero(np.diff(groups, prepend=-1))]
+    if "vwap" in ohlc.columns:
+        merged["vwap"] = merged["notional"] / merged["quantity"]
+    return merged
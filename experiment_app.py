@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, render_template, request, jsonify, redirect, url_for, Response
 import os
 import pandas as pd
 import matplotlib
@@ -13,8 +13,29 @@ from pytz import timezone
 import plotly.graph_objects as go
 import plotly.express as px
 from collections import OrderedDict
+import logging
+from tick_cache import load_rollup, clear_cache, complete_last_line
+from aggregates import TickAggregates, ROLLUP_BUCKETS, DEFAULT_BUCKET
+from render import render_figure, RENDER_PROCESSES
+from wire import pack_aggregates, PACKED_MIMETYPE
+from export import export_chunks, EXPORT_FORMATS
+from tick_query import filters_from_args, query_aggregates
 from werkzeug.utils import secure_filename
 import uuid
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import json
+import queue
+import live
+
+# Pipeline logging stays quiet unless TICK_LOG_LEVEL is set (INFO for per-upload counters,
+# DEBUG for sampled rejected rows and intermediate frames)
+logging.basicConfig(
+    level=os.environ.get("TICK_LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
 
 # Add a lock for matplotlib operations
 matplotlib_lock = threading.Lock()
@@ -28,6 +49,25 @@ os.makedirs(GRAPH_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["GRAPH_FOLDER"] = GRAPH_FOLDER
 
+# An idle /stream connection gets a comment line this often so proxies keep it open
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Worker processes for multi-file uploads, created on first use
+MAX_UPLOAD_PROCESSES = min(4, os.cpu_count() or 1)
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Spawned rather than forked, so workers never inherit Flask threads or held locks
+            _process_pool = ProcessPoolExecutor(
+                max_workers=MAX_UPLOAD_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -39,11 +79,15 @@ def reset_app():
             file_path = os.path.join(folder, f)
             if os.path.isfile(file_path):
                 os.remove(file_path)
+            elif os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+    clear_cache()
     return redirect("/")
 
 @app.route("/upload", methods=["POST"])
 def upload_files():
     uploaded_files = request.files.getlist("file")
+    merge = request.form.get("merge", "").lower() in ["1", "true", "on", "yes"]
     saved_files = []
     for file in uploaded_files:
         if file and file.filename:
@@ -51,22 +95,45 @@ def upload_files():
             unique_name = f"{uuid.uuid4()}_{filename}"
             file_path = os.path.join(UPLOAD_FOLDER, unique_name)
             file.save(file_path)
-            process_file_and_generate_graphs(file_path)
+            complete_last_line(file_path)
             saved_files.append(unique_name)
-    return jsonify({"success": True, "files": saved_files})
+
+    # Each file is parsed and aggregated in its own process; the charts then export on the
+    # renderer pool, into static/graphs/<upload name>/
+    pool = get_process_pool()
+    futures = [pool.submit(load_rollup, os.path.join(UPLOAD_FOLDER, name)) for name in saved_files]
+    aggregates = [future.result() for future in futures]
+    for name, file_aggregates in zip(saved_files, aggregates):
+        render_graphs(file_aggregates, os.path.join(GRAPH_FOLDER, name))
+
+    response = {"success": True, "files": saved_files}
+    if merge and aggregates:
+        # The "all files" view is drawn from the per-file aggregates, nothing is parsed again
+        merged_name = f"all_files_{uuid.uuid4()}"
+        render_graphs(TickAggregates.merge(aggregates), os.path.join(GRAPH_FOLDER, merged_name))
+        response["merged"] = merged_name
+    return jsonify(response)
 
 @app.route("/graphs")
 def show_graphs():
     try:
+        # Uploads draw into their own sub-folder, fall back to the shared folder otherwise
+        graph_subdir = secure_filename(request.args.get("file", ""))
+        graph_dir = os.path.join(GRAPH_FOLDER, graph_subdir)
+        if not graph_subdir or not os.path.isdir(graph_dir):
+            graph_subdir, graph_dir = "", GRAPH_FOLDER
         graph_files = sorted(
-            [f for f in os.listdir(GRAPH_FOLDER) if f.endswith(".png")]
+            [f for f in os.listdir(graph_dir) if f.endswith(".png")]
         )
-        graph_urls = [url_for('static', filename=f'graphs/{f}') for f in graph_files]
-        print("Graph Files:", graph_files)  # Debug
-        print("Graph URLs:", graph_urls)  # Debug
-        return render_template("graphs.html", graph_urls=graph_urls)
+        charts = [{
+            "name": f[:-len(".png")],
+            "image_url": url_for('static', filename=f'graphs/{graph_subdir}/{f}' if graph_subdir else f'graphs/{f}')
+        } for f in graph_files]
+        logger.debug("Graph Files: %s", graph_files)
+        logger.debug("Charts: %s", charts)
+        return render_template("graphs.html", charts=charts)
     except Exception as e:
-        print(f"Error in /graphs route: {e}")
+        logger.error("Error in /graphs route: %s", e)
         return jsonify({"success": False, "message": str(e)})
 
 @app.route("/delete_uploads", methods=["POST"])
@@ -77,9 +144,12 @@ def delete_uploads():
                 file_path = os.path.join(folder, file)
                 if os.path.isfile(file_path):
                     os.remove(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+        clear_cache()
         return jsonify({"success": True, "message": "Uploads and graphs deleted successfully"})
     except Exception as e:
-        print(f"Error deleting files: {str(e)}")
+        logger.error("Error deleting files: %s", e)
         return jsonify({"success": False, "message": f"Error deleting files: {str(e)}"})
 
 @app.route("/api/graph-data", methods=["GET"])
@@ -90,100 +160,74 @@ def get_graph_data():
     file_path = os.path.join(UPLOAD_FOLDER, filename)
     if not os.path.exists(file_path):
         return jsonify({"success": False, "message": "File not found."}), 404
+    # e.g. &bucket=5min; the *_per_hour fields then hold 5-minute buckets
+    bucket = request.args.get("bucket", DEFAULT_BUCKET)
+    if bucket not in ROLLUP_BUCKETS:
+        return jsonify({"success": False, "message": f"Unknown bucket {bucket!r}, expected one of {', '.join(ROLLUP_BUCKETS)}."}), 400
+    # e.g. &token=12863&action=T&start=2025-01-02T09:15&end=2025-01-02T10:00 (see tick_query)
     try:
-        # Load the processed data from the latest uploaded file
-        adjusted_times, tokens, order_quantities, actions = [], [], [], []
-
-        with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-            for line_num, line in enumerate(file, 1):
-                columns = line.strip().split(",")
-                if len(columns) < 8:
-                    continue
-                try:
-                    raw_epoch_time = int(columns[5])
-                    if raw_epoch_time > 1e18:
-                        epoch_time = (raw_epoch_time + 315532800000000000) / 1e9
-                    elif raw_epoch_time > 1e15:
-                        epoch_time = (raw_epoch_time + 315532800000000) / 1e6
-                    elif raw_epoch_time > 1e12:
-                        epoch_time = (raw_epoch_time + 315532800000) / 1e3
-                    else:
-                        epoch_time = raw_epoch_time + 315532800
-
-                    adjusted_time = pd.to_datetime(epoch_time, unit="s", origin="unix", utc=True)
-                    adjusted_time = adjusted_time.tz_convert("Asia/Calcutta")
-                except (ValueError, IndexError):
-                    continue
-
-                token = columns[1].strip()
-                try:
-                    order_quantity = float(columns[-1].strip())
-                except ValueError:
-                    continue
-                action = columns[0].strip()
-
-                adjusted_times.append(adjusted_time)
-                tokens.append(token)
-                order_quantities.append(order_quantity)
-                actions.append(action)
-
-        df = pd.DataFrame({
-            "adjusted_time": adjusted_times,
-            "token": tokens,
-            "order_quantity": order_quantities,
-            "action": actions
-        })
-
-        df["token"] = df["token"].astype(str).str.strip()
-        df["order_quantity"] = pd.to_numeric(df["order_quantity"], errors="coerce")
-        df.dropna(subset=["order_quantity", "adjusted_time"], inplace=True)
-        df["adjusted_time"] = pd.to_datetime(df["adjusted_time"], errors="coerce")
-        df.dropna(subset=["adjusted_time"], inplace=True)
-        df["hour"] = df["adjusted_time"].dt.floor("H")
-
-        entries_per_hour = (
-            df.groupby("hour")
-            .size()
-            .sort_index()
-            .to_dict()
-        )
-
-        quantity_per_hour = (
-            df.groupby("hour")["order_quantity"]
-            .sum()
-            .sort_values(ascending=False)
-            .to_dict()
-        )
+        filters = filters_from_args(request.args)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    try:
+        aggregates = query_aggregates(file_path, bucket, **filters)
 
-        quantity_per_token = (
-            df.groupby("token")["order_quantity"]
-            .sum()
-            .sort_values(ascending=False)
-            .to_dict()
-        )
+        # Clients that send Accept: application/vnd.tick-columns get typed columns instead of JSON
+        if request.accept_mimetypes.best_match(["application/json", PACKED_MIMETYPE]) == PACKED_MIMETYPE:
+            return Response(pack_aggregates(aggregates), mimetype=PACKED_MIMETYPE, headers={"Vary": "Accept"})
 
+        entries_per_hour = aggregates.entries_per_bucket().to_dict()
+        quantity_per_hour = aggregates.quantity_per_bucket().sort_values(ascending=False).to_dict()
+        quantity_per_token = aggregates.quantity_per_token().sort_values(ascending=False).to_dict()
         # 🆕 New logic: Count number of orders per token
-        token_counts = (
-            df["token"]
-            .value_counts()
-            .to_dict()
-        )
+        token_counts = aggregates.entries_per_token().to_dict()
 
         # Prepare response data
         graph_data = {
+            "bucket": bucket,
             "entries_per_hour": {str(k): v for k, v in entries_per_hour.items()},
             "quantity_per_hour": {str(k): v for k, v in quantity_per_hour.items()},
             "quantity_per_token": quantity_per_token,
-            "token_counts": token_counts  # ✅ Included new field
+            "token_counts": token_counts,  # ✅ Included new field
+            # Trades only: notional (price x quantity), VWAP and open/high/low/close per bucket
+            **aggregates.trade_metrics()
         }
 
-        return jsonify({"success": True, "data": graph_data}), 200
+        response = jsonify({"success": True, "data": graph_data})
+        response.headers["Vary"] = "Accept"
+        return response, 200
 
     except Exception as e:
-        print(f"Error in /api/graph-data: {e}")
+        logger.error("Error in /api/graph-data: %s", e)
         return jsonify({"success": False, "message": str(e)}), 500
      
 
+@app.route("/stream", methods=["GET"])
+def stream_live_data():
+    # EventSource("/stream?file=<upload>"): a "snapshot" event with the hourly and per-token
+    # totals so far, then a "delta" event to add on each time new lines reach the file (or pipe)
+    filename = request.args.get("file")
+    if not filename:
+        return jsonify({"success": False, "message": "No file specified."}), 400
+    if filename not in os.listdir(UPLOAD_FOLDER):
+        return jsonify({"success": False, "message": "File not found."}), 404
+
+    tail, subscriber = live.subscribe(os.path.join(UPLOAD_FOLDER, filename))
+
+    def events():
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            live.unsubscribe(tail, subscriber)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 def create_plot(df, x_data, y_data, title, xlabel, ylabel, filename, color='#1f77b4', marker='o', 
                 linewidth=2, label=None, legend_needed=False, more_series=None):
     """Thread-safe function to create a single plot and save it to disk with exact time labels"""
@@ -219,15 +263,13 @@ def create_plot(df, x_data, y_data, title, xlabel, ylabel, filename, color='#1f7
         x_data = pd.to_datetime(x_data).tz_convert("Asia/Calcutta")
         
         # Debug: Print the x-axis data after localization
-        print("X-Axis Data (Localized to IST):")
-        print(x_data)
+        logger.debug("X-Axis Data (Localized to IST):\n%s", x_data)
         
         # Set x-ticks to the actual time values from the data
         unique_hours = sorted(x_data.unique())
         
         # Debug: Print the unique hours
-        print("Unique hours (x-axis tick values):")
-        print(unique_hours)
+        logger.debug("Unique hours (x-axis tick values):\n%s", unique_hours)
         
         ax.set_xticks(unique_hours)  # Set the x-ticks to unique_hours
         ax.set_xticklabels([hour.strftime('%H:%M') for hour in unique_hours])  # Use unique_hours as labels
@@ -257,155 +299,59 @@ def create_plot(df, x_data, y_data, title, xlabel, ylabel, filename, color='#1f7
         plt.savefig(os.path.join(GRAPH_FOLDER, filename), dpi=100)
         plt.close()  # Important: close plot to free memory
 
-def process_file_and_generate_graphs(file_path):
-    start_time = time.time()
-    adjusted_times, tokens, order_quantities, actions = [], [], [], []
-
-    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-        for line_num, line in enumerate(file, 1):
-            print(f"Line {line_num}: {line.strip()}")  # Debug: Print each line
-            columns = line.strip().split(",")
-            if len(columns) < 8:
-                print(f"Skipping line {line_num}: Not enough columns")
-                continue
-            try:
-                raw_epoch_time = int(columns[5])
-                token = columns[1].strip()
-                order_quantity = float(columns[-1].strip())
-                action = columns[0].strip()
-            except (ValueError, IndexError) as e:
-                print(f"Skipping line {line_num}: {e}")
-                continue
-            try:
-                print(f"Columns: {columns}")  # Debug: Print split columns
-                print(f"Raw Epoch Time: {raw_epoch_time}")  # Debug: Print raw epoch time
-                if raw_epoch_time > 1e18:
-                    epoch_time = (raw_epoch_time + 315532800000000000) / 1e9
-                elif raw_epoch_time > 1e15:
-                    epoch_time = (raw_epoch_time + 315532800000000) / 1e6
-                elif raw_epoch_time > 1e12:
-                    epoch_time = (raw_epoch_time + 315532800000) / 1e3
-                else:
-                    epoch_time = raw_epoch_time + 315532800
-
-                adjusted_time = pd.to_datetime(epoch_time, unit="s", origin="unix", utc=True)
-                adjusted_time = adjusted_time.tz_convert("Asia/Calcutta")
-                print(f"Adjusted Time: {adjusted_time}")  # Debug: Print adjusted time
-
-                print(f"Token: {token}")  # Debug
-
-                print(f"Order Quantity: {order_quantity}")  # Debug
-
-                print(f"Action: {action}")  # Debug
-
-                adjusted_times.append(adjusted_time)
-                tokens.append(token)
-                order_quantities.append(order_quantity)
-                actions.append(action)
-            except (ValueError, IndexError) as e:
-                print(f"Error processing line: {e}")  # Debug
-                continue
-
-    if not adjusted_times:
-        print("Adjusted Times list is empty!")
-    if not tokens:
-        print("Tokens list is empty!")
-    if not order_quantities:
-        print("Order Quantities list is empty!")
-    if not actions:
-        print("Actions list is empty!")
-
-    print("Adjusted Times:", adjusted_times[:10])  # Print the first 10 entries
-    print("Tokens:", tokens[:10])  # Print the first 10 entries
-    print("Order Quantities:", order_quantities[:10])  # Print the first 10 entries
-    print("Actions:", actions[:10])  # Print the first 10 entries
-
-    df = pd.DataFrame({
-        "adjusted_time": adjusted_times,
-        "token": tokens,
-        "order_quantity": order_quantities,
-        "action": actions
-    })
-
-    df["token"] = df["token"].astype(str).str.strip()
-    df["order_quantity"] = pd.to_numeric(df["order_quantity"], errors="coerce")
-    print("Order Quantity Conversion:\n", df["order_quantity"].head())  # Debug: Check order_quantity column
-    df.dropna(subset=["order_quantity"], inplace=True)
-    print("DataFrame After Order Quantity Filtering:\n", df.head())  # Debug: Check DataFrame after filtering
-    df["adjusted_time"] = pd.to_datetime(df["adjusted_time"], errors="coerce")
-    print("Adjusted Time Conversion:\n", df["adjusted_time"].head())  # Debug: Check adjusted_time column
-    df.dropna(subset=["adjusted_time"], inplace=True)
-    print("DataFrame After Adjusted Time Filtering:\n", df.head())  # Debug: Check DataFrame after filtering
-    df["hour"] = df["adjusted_time"].dt.floor("H")
+def render_figures(figures, graph_dir):
+    """Write each (name, figure) pair as <graph_dir>/<name>.html and .png, as many at once as there are renderers"""
+    paths = [(fig, os.path.join(graph_dir, f"{name}.{extension}")) for name, fig in figures for extension in ["html", "png"]]
+    with ThreadPoolExecutor(max_workers=RENDER_PROCESSES) as threads:
+        list(threads.map(lambda item: render_figure(*item), paths))
 
-    df["hour"] = pd.to_datetime(df["hour"], errors="coerce")
-    df["order_quantity"] = pd.to_numeric(df["order_quantity"], errors="coerce")
-    df.dropna(subset=["hour", "order_quantity"], inplace=True)
-
-    entries_per_hour = df.groupby("hour").size()
-    print("Entries Per Hour:\n", entries_per_hour)  # Debug: Print entries per hour
-
-    quantity_per_hour = df.groupby("hour")["order_quantity"].sum()
-    print("Quantity Per Hour:\n", quantity_per_hour)  # Debug: Print quantity per hour
+def render_graphs(aggregates, graph_dir=GRAPH_FOLDER):
+    os.makedirs(graph_dir, exist_ok=True)
+    # (name, figure) pairs, exported together once all are built
+    figures = []
 
     # Graph 1: Number of Entries per Hour
-    entries_per_hour = df.groupby("hour").size()
+    entries_per_hour = aggregates.entries_per_bucket()
+    logger.debug("Entries Per Hour:\n%s", entries_per_hour)
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=entries_per_hour.index, y=entries_per_hour.values, mode='lines+markers', name='Entries'))
     fig.update_layout(title="Number of Entries per Hour", xaxis_title="Time", yaxis_title="Number of Entries")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "entries_per_hour.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "entries_per_hour.png"))
+    figures.append(("entries_per_hour", fig))
 
     # Graph 2: Total Order Quantity per Hour
-    quantity_per_hour = df.groupby("hour")["order_quantity"].sum()
+    quantity_per_hour = aggregates.quantity_per_bucket()
+    logger.debug("Quantity Per Hour:\n%s", quantity_per_hour)
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=quantity_per_hour.index, y=quantity_per_hour.values, mode='lines+markers', name='Quantity'))
     fig.update_layout(title="Total Order Quantity per Hour", xaxis_title="Time", yaxis_title="Total Order Quantity")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "order_quantity_per_hour.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "order_quantity_per_hour.png"))
+    figures.append(("order_quantity_per_hour", fig))
 
     # Graph 3: T to N/M Combination Count per Hour
-    combo_hours = []
-    for i in range(len(df) - 1):
-        if df.iloc[i]["action"] == "T" and df.iloc[i + 1]["action"] in ["N", "M"]:
-            combo_hours.append(df.iloc[i]["hour"])
-    if combo_hours:
-        combo_series = pd.Series(combo_hours).value_counts().sort_index()
+    combo_series = aggregates.combos_per_bucket()
+    if not combo_series.empty:
         fig = go.Figure()
         fig.add_trace(go.Bar(x=combo_series.index, y=combo_series.values, name='T to N/M Combinations'))
         fig.update_layout(title="T to N/M Combination Count per Hour", xaxis_title="Time", yaxis_title="T to N/M Combinations")
-        fig.write_html(os.path.join(GRAPH_FOLDER, "t_nm_combo_count_per_hour.html"))
-        fig.write_image(os.path.join(GRAPH_FOLDER, "t_nm_combo_count_per_hour.png"))
+        figures.append(("t_nm_combo_count_per_hour", fig))
 
     # Graph 4: Top 5 Tokens by Number of Orders Per Hour
-    top_5_tokens = df["token"].value_counts().head(5).index.tolist()
-    df_top_tokens = df[df["token"].isin(top_5_tokens)]
-    if not df_top_tokens.empty:
-        orders_per_hour = df_top_tokens.groupby(["hour", "token"]).size().unstack(fill_value=0).sort_index()
+    entries_per_token = aggregates.entries_per_token()
+    top_5_tokens = aggregates.top_tokens_by_entries(5)
+    if top_5_tokens:
+        orders_per_hour = aggregates.bucket_token_matrix(top_5_tokens, "entries", all_buckets=False)
         fig = px.line(orders_per_hour, x=orders_per_hour.index, y=orders_per_hour.columns, title="Top 5 Tokens by Number of Orders Per Hour")
         fig.update_layout(xaxis_title="Time", yaxis_title="Number of Orders")
-        fig.write_html(os.path.join(GRAPH_FOLDER, "top_5_tokens_orders_per_hour.html"))
-        fig.write_image(os.path.join(GRAPH_FOLDER, "top_5_tokens_orders_per_hour.png"))
+        figures.append(("top_5_tokens_orders_per_hour", fig))
 
     # Graph 5: Top 5 Tokens by Quantity Traded per Hour (with zeros for missing)
-    top_5_qty_tokens = df.groupby("token")["order_quantity"].sum().nlargest(5).index.tolist()
-    df_top_qty = df[df["token"].isin(top_5_qty_tokens)]
-
-    # Get all unique hours in the dataset
-    all_hours = df["hour"].sort_values().unique()
-    # Build a MultiIndex of all hour/token combinations
-    multi_index = pd.MultiIndex.from_product([all_hours, top_5_qty_tokens], names=["hour", "token"])
-
-    # Group and reindex to fill missing hour/token combos with 0
-    qty_per_hour = (
-        df_top_qty.groupby(["hour", "token"])["order_quantity"].sum()
-        .reindex(multi_index, fill_value=0)
-        .unstack(fill_value=0)
-        .sort_index()
-    )
+    quantity_per_token = aggregates.quantity_per_token()
+    top_5_qty_tokens = aggregates.top_tokens_by_quantity(5)
 
-    print("qty_per_hour shape:", qty_per_hour.shape)
-    print("qty_per_hour head:\n", qty_per_hour.head())
+    # Every hour in the dataset, with zeros where a token has no ticks
+    qty_per_hour = aggregates.bucket_token_matrix(top_5_qty_tokens, "order_quantity")
+
+    logger.debug("qty_per_hour shape: %s", qty_per_hour.shape)
+    logger.debug("qty_per_hour head:\n%s", qty_per_hour.head())
 
     fig = px.line(
         qty_per_hour,
@@ -414,19 +360,17 @@ def process_file_and_generate_graphs(file_path):
         title="Top 5 Tokens by Total Quantity Per Hour"
     )
     fig.update_layout(xaxis_title="Time", yaxis_title="Total Quantity")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "top_5_tokens_quantity_per_hour.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "top_5_tokens_quantity_per_hour.png"))
+    figures.append(("top_5_tokens_quantity_per_hour", fig))
 
     # Graph 6: Pie Chart of Number of Entries for Each Unique Token
-    entries_per_token = df["token"].value_counts()
-    print("Entries Per Token Before Grouping:\n", entries_per_token)  # Debug: Check raw data
+    logger.debug("Entries Per Token Before Grouping:\n%s", entries_per_token)
 
     # Calculate the total number of entries
     total_entries = entries_per_token.sum()
 
     # Calculate percentages
     percentages = (entries_per_token / total_entries) * 100
-    print("Percentages Per Token:\n", percentages)  # Debug: Check percentages
+    logger.debug("Percentages Per Token:\n%s", percentages)
 
     # Separate tokens below 1% into "Others"
     above_threshold = percentages[percentages >= 1]
@@ -442,23 +386,22 @@ def process_file_and_generate_graphs(file_path):
     final_names = above_threshold.index
 
     # Debug: Check final values and names
-    print("Final Values for Pie Chart:\n", final_values)
-    print("Final Names for Pie Chart:\n", final_names)
+    logger.debug("Final Values for Pie Chart:\n%s", final_values)
+    logger.debug("Final Names for Pie Chart:\n%s", final_names)
 
     # Create the pie chart
     fig = px.pie(values=final_values, names=final_names, title="Number of Entries for Each Unique Token (with Others)")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "entries_per_token_pie.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "entries_per_token_pie.png"))
+    figures.append(("entries_per_token_pie", fig))
 
     # Graph 7: Pie Chart of Total Quantity Traded for Each Unique Token
-    quantity_per_token = df.groupby("token")["order_quantity"].sum().sort_values(ascending=False)
+    quantity_per_token = quantity_per_token.sort_values(ascending=False)
 
     # Calculate the total quantity
     total_quantity = quantity_per_token.sum()
 
     # Calculate percentages
     percentages = (quantity_per_token / total_quantity) * 100
-    print("Percentages:\n", percentages)  # Debug: Check percentages
+    logger.debug("Percentages:\n%s", percentages)
 
     # Separate tokens below 1% into "Others"
     above_threshold = percentages[percentages >= 1]
@@ -474,82 +417,40 @@ def process_file_and_generate_graphs(file_path):
     final_names = above_threshold.index
 
     # Debug: Check final values and names
-    print("Final Values for Pie Chart:\n", final_values)
-    print("Final Names for Pie Chart:\n", final_names)
+    logger.debug("Final Values for Pie Chart:\n%s", final_values)
+    logger.debug("Final Names for Pie Chart:\n%s", final_names)
 
     # Create the pie chart
     fig = px.pie(values=final_values, names=final_names, title="Total Quantity Traded for Each Unique Token (with Others)")
-    fig.write_html(os.path.join(GRAPH_FOLDER, "total_quantity_per_token_pie.html"))
-    fig.write_image(os.path.join(GRAPH_FOLDER, "total_quantity_per_token_pie.png"))
+    figures.append(("total_quantity_per_token_pie", fig))
 
-    print(f"\n✅ File processing completed in {time.time() - start_time:.2f} seconds.")
+    render_figures(figures, graph_dir)
 
 @app.route("/export-processed-data", methods=["GET"])
 def export_processed_data():
-    # Find the latest uploaded file
+    # e.g. ?file=ticks.txt&format=csv.gz&token=NIFTY,BANKNIFTY&action=T&start=2025-01-02T10:00
+    # Streamed from the cached columns a chunk at a time, so even a very large upload is never
+    # held in memory as a whole. Without file=, the latest upload is exported
     file_path = None
+    filename = request.args.get("file")
     for file in os.listdir(UPLOAD_FOLDER):
-        file_path = os.path.join(UPLOAD_FOLDER, file)
-        break
+        if not filename or file == filename:
+            file_path = os.path.join(UPLOAD_FOLDER, file)
+            break
 
     if not file_path or not os.path.exists(file_path):
         return "No processed data available.", 404
 
-    # Re-process the file to ensure it's clean (or load from where you save processed data)
-    adjusted_times, tokens, order_quantities, actions = [], [], [], []
-    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-        for line_num, line in enumerate(file, 1):
-            columns = line.strip().split(",")
-            if len(columns) < 8:
-                continue
-            try:
-                raw_epoch_time = int(columns[5])
-                if raw_epoch_time > 1e18:
-                    epoch_time = (raw_epoch_time + 315532800000000000) / 1e9
-                elif raw_epoch_time > 1e15:
-                    epoch_time = (raw_epoch_time + 315532800000000) / 1e6
-                elif raw_epoch_time > 1e12:
-                    epoch_time = (raw_epoch_time + 315532800000) / 1e3
-                else:
-                    epoch_time = raw_epoch_time + 315532800
-                adjusted_time = pd.to_datetime(epoch_time, unit="s", origin="unix", utc=True)
-                adjusted_time = adjusted_time.tz_convert("Asia/Calcutta")
-            except (ValueError, IndexError):
-                continue
-
-            token = columns[1].strip()
-            try:
-                order_quantity = float(columns[-1].strip())
-            except ValueError:
-                continue
-            action = columns[0].strip()
-
-            adjusted_times.append(adjusted_time)
-            tokens.append(token)
-            order_quantities.append(order_quantity)
-            actions.append(action)
-
-    df = pd.DataFrame({
-        "adjusted_time": adjusted_times,
-        "token": tokens,
-        "order_quantity": order_quantities,
-        "action": actions
+    export_format = request.args.get("format", "csv")
+    try:
+        chunks = export_chunks(file_path, export_format, **filters_from_args(request.args))
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    return Response(chunks, mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename=processed_data.{extension}"
     })
-    df["hour"] = df["adjusted_time"].dt.floor("H")
-
-    # Export as CSV
-    from io import StringIO
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-    csv_buffer.seek(0)
-    return (
-        csv_buffer.getvalue(),
-        200,
-        {
-            "Content-Type": "text/csv",
-            "Content-Disposition": "attachment; filename=processed_data.csv"
-        }
-    )
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,122 @@
+"""Streaming export of an upload's parsed ticks as CSV, gzip CSV or Parquet.
+
+The cached columns are read, filtered and encoded one chunk at a time, so
+an export holds about EXPORT_CHUNK_ROWS rows in memory whatever the size
+of the upload, and the first bytes go out as soon as the first chunk is
+encoded.
+"""
+import gzip
+import importlib.util
+import io
+
+import pandas as pd
+
+from tick_cache import cached_dir
+from tick_query import iter_matching_ticks
+
+EXPORT_CHUNK_ROWS = 100_000
+
+EXPORT_COLUMNS = ["adjusted_time", "token", "order_quantity", "action"]
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "csv.gz": ("application/gzip", "csv.gz"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that collects what is written until it is drained"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_frames(cache_dir, **filters):
+    """The cached export columns plus "hour", filtered (see tick_query), one chunk at a time.
+
+    Token and time filters are looked up in the cache's index, so only the
+    matching rows are read.
+    """
+    for ticks in iter_matching_ticks(cache_dir, EXPORT_CHUNK_ROWS, **filters):
+        frame = ticks[EXPORT_COLUMNS]
+        if len(frame):
+            yield frame.assign(hour=frame["adjusted_time"].dt.floor("h"))
+
+
+def _csv_chunks(frames):
+    header = True
+    for frame in frames:
+        yield frame.to_csv(index=False, header=header).encode()
+        header = False
+    if header:
+        # Nothing matched, still send the column names
+        yield (",".join(EXPORT_COLUMNS + ["hour"]) + "\n").encode()
+
+
+def _gzip_chunks(frames):
+    sink = _ChunkSink()
+    with gzip.GzipFile(fileobj=sink, mode="wb") as compressed:
+        for data in _csv_chunks(frames):
+            compressed.write(data)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _parquet_chunks(frames):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = _ChunkSink()
+    writer = None
+    for frame in frames:
+        # Categories differ from one cached part to the next, plain strings keep one schema
+        table = pa.Table.from_pandas(frame.astype({"token": str, "action": str}), preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        # Each chunk becomes one row group
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is None:
+        # Nothing matched, still send a valid file with the column names
+        writer = pq.ParquetWriter(sink, pa.Table.from_pandas(pd.DataFrame(columns=EXPORT_COLUMNS + ["hour"])).schema)
+    writer.close()
+    yield sink.drain()
+
+
+def export_chunks(file_path, export_format="csv", **filters):
+    """Encoded bytes of the export, in pieces to stream as a response body.
+
+    Raises ValueError for an unknown format, or for Parquet without pyarrow
+    installed.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format {export_format!r}, expected one of {', '.join(EXPORT_FORMATS)}.")
+    if export_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        # Fails before the response starts rather than halfway through it
+        raise ValueError("Parquet export needs pyarrow installed.")
+    # Parsed (or brought up to date) now, so that errors are reported before any bytes are sent
+    frames = export_frames(cached_dir(file_path), **filters)
+    if export_format == "parquet":
+        return _parquet_chunks(frames)
+    if export_format == "csv.gz":
+        return _gzip_chunks(frames)
+    return _csv_chunks(frames)
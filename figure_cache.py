@@ -0,0 +1,85 @@
+"""Content-addressed cache of rendered chart files.
+
+A chart is rendered the first time it is asked for and stored in the graph
+folder as <chart>-<key>.<png|html>, where the key is a hash of the upload's
+contents, the chart and its parameters. Later requests for the same key are
+served from disk. Once the cached files outgrow MAX_CACHE_BYTES the least
+recently used ones are deleted.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+# Only files named like this are managed (and evicted) by the cache
+CACHED_FILE_PATTERN = re.compile(r"^[a-z0-9_]+-[0-9a-f]{20}\.(png|html)$")
+
+_key_locks = {}
+_locks_lock = threading.Lock()
+
+
+def figure_key(content_id, chart, params=None):
+    """Cache key of one chart of one version of an upload"""
+    payload = json.dumps([content_id, chart, params or {}], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:20]
+
+
+def _key_lock(path):
+    with _locks_lock:
+        return _key_locks.setdefault(path, threading.Lock())
+
+
+def cached_figure(graph_dir, chart, key, fmt, render):
+    """Return the file name of the cached chart, calling render(path) to create it if missing.
+
+    Concurrent requests for the same file wait for a single render.
+    """
+    file_name = f"{chart}-{key}.{fmt}"
+    path = os.path.join(graph_dir, file_name)
+    with _key_lock(path):
+        if os.path.exists(path):
+            # The modification time doubles as the last-used time for eviction
+            os.utime(path)
+            return file_name
+        # Rendered under a temporary name so a failed export never leaves a half-written file to serve
+        tmp_path = os.path.join(graph_dir, f".{uuid.uuid4().hex}.{fmt}")
+        try:
+            render(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    evict(graph_dir)
+    return file_name
+
+
+def evict(graph_dir, max_bytes=MAX_CACHE_BYTES):
+    """Delete least recently used cached charts until they fit in max_bytes"""
+    cached = []
+    for file_name in os.listdir(graph_dir):
+        if CACHED_FILE_PATTERN.match(file_name):
+            try:
+                stat = os.stat(os.path.join(graph_dir, file_name))
+            except OSError:
+                continue
+            cached.append((stat.st_mtime_ns, stat.st_size, file_name))
+
+    total = sum(size for _, size, _ in cached)
+    for _, size, file_name in sorted(cached):
+        if total <= max_bytes:
+            break
+        path = os.path.join(graph_dir, file_name)
+        with _key_lock(path):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        total -= size
+        logger.debug("Evicted %s from the figure cache", file_name)
@@ -0,0 +1,350 @@
+"""Bulk reader for the N/M/X/T order/trade upload format.
+
+The upload is memory-mapped and handed to the CSV tokenizer one block at a
+time straight from the mapping, without reading it into Python bytes first.
+The text columns (action, token, side) come out as categoricals, so each
+distinct value is decoded once rather than once per row. split_ranges cuts
+a file into line-aligned byte ranges that separate processes can parse at
+the same time from their own mappings of it.
+"""
+import csv
+import io
+import logging
+import mmap
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from timestamps import to_exchange_times
+
+logger = logging.getLogger(__name__)
+
+# action, token, order id, matched order id, sequence no, exchange timestamp, side, price, quantity
+TICK_COLUMNS = [
+    "action", "token", "order_id", "other_order_id", "seq",
+    "exchange_time", "side", "price", "order_quantity"
+]
+
+TICK_DTYPES = {
+    "action": "category",
+    "token": "category",
+    "order_id": "float64",
+    "other_order_id": "float64",
+    "seq": "int64",
+    "exchange_time": "int64",
+    "side": "category",
+    "price": "float64",
+    "order_quantity": "float64",
+}
+
+TEXT_COLUMNS = ["action", "token", "side"]
+
+
+# Memory a parse may use, in bytes (TICK_MEMORY_BUDGET). Uploads are parsed, cached and
+# aggregated a block at a time, so this bounds memory whatever the size of the upload
+MEMORY_BUDGET = int(os.environ.get("TICK_MEMORY_BUDGET", 512 * 1024 * 1024))
+
+# Peak memory of parsing and aggregating a block, per byte of its text (about 5x measured, with headroom)
+BLOCK_MEMORY_FACTOR = 8
+
+# Uploads are parsed in blocks of about this many bytes, cut at line ends
+BLOCK_SIZE = max(MEMORY_BUDGET // BLOCK_MEMORY_FACTOR, 1024 * 1024)
+
+# How many rejected rows per upload are kept (and logged at DEBUG) with their reason
+REJECT_SAMPLE_SIZE = 20
+
+
+class IngestStats:
+    """Counters for one upload plus the first few rejected rows, for tracing bad input"""
+
+    def __init__(self, sample_size=REJECT_SAMPLE_SIZE):
+        self.lines_read = 0
+        self.rows_seen = 0
+        self.accepted = 0
+        self.rejected = Counter()
+        self.samples = []
+        self.sample_size = sample_size
+
+    def record_block(self, lines, raw, reasons):
+        self.lines_read += lines
+
+        rejected = reasons.dropna()
+        self.rejected.update(rejected.value_counts().to_dict())
+        self.accepted += len(raw) - len(rejected)
+        for row, reason in rejected.head(self.sample_size - len(self.samples)).items():
+            text = ",".join(str(value) for value in raw.loc[row, TICK_COLUMNS])
+            self.samples.append((self.rows_seen + row + 1, reason, text))
+        self.rows_seen += len(raw)
+
+    def add(self, other):
+        """Add the counters of the block range parsed after this one (e.g. by another process)"""
+        self.lines_read += other.lines_read
+        self.accepted += other.accepted
+        self.rejected.update(other.rejected)
+        self.samples.extend((self.rows_seen + row, reason, text)
+                            for row, reason, text in other.samples[:self.sample_size - len(self.samples)])
+        self.rows_seen += other.rows_seen
+
+    def to_dict(self):
+        return {
+            "lines_read": self.lines_read,
+            "accepted": self.accepted,
+            "rejected": dict(self.rejected),
+            "samples": [{"row": row, "reason": reason, "text": text} for row, reason, text in self.samples],
+        }
+
+
+def _count_lines(block):
+    """Lines in a block (the last may lack its newline), and how many of them are blank"""
+    data = np.frombuffer(block, dtype="uint8")
+    ends = np.flatnonzero(data == ord("\n"))
+    starts = np.concatenate([[0], ends + 1])[:len(ends)]
+    lengths = ends - starts
+    blank = (lengths == 0) | ((lengths == 1) & (data[np.minimum(starts, len(data) - 1)] == ord("\r")))
+    return len(ends) + int(bool(len(data)) and data[-1] != ord("\n")), int(blank.sum())
+
+
+def _field_counts(block):
+    """Number of fields on each non-blank line of a block, in order, as read_csv sees the rows"""
+    data = np.frombuffer(block, dtype="uint8")
+    if not len(data):
+        return np.empty(0, dtype="int64")
+    starts = np.concatenate([[0], np.flatnonzero(data == ord("\n")) + 1])
+    starts = starts[starts < len(data)]
+    ends = np.append(starts[1:], len(data))
+    ends = ends - (data[ends - 1] == ord("\n"))
+    ends = ends - ((ends > starts) & (data[np.maximum(ends - 1, 0)] == ord("\r")))
+    commas = np.add.reduceat(data == ord(","), starts, dtype="int64")
+    return commas[ends > starts] + 1
+
+
+def _fold_extra_fields(block):
+    """The block with every row of more than nine fields cut to its first eight plus its last.
+
+    The line-by-line parser took the quantity from a row's last field, so
+    such rows are kept that way rather than dropped by read_csv. A block
+    without any is returned as it is.
+    """
+    data = np.frombuffer(block, dtype="uint8")
+    if not len(data):
+        return block
+    starts = np.concatenate([[0], np.flatnonzero(data == ord("\n")) + 1])
+    starts = starts[starts < len(data)]
+    commas = np.add.reduceat(data == ord(","), starts, dtype="int64")
+    long_lines = np.flatnonzero(commas > len(TICK_COLUMNS) - 1)
+    if not len(long_lines):
+        return block
+
+    ends = np.append(starts[1:], len(data))
+    pieces, position = [], 0
+    for line in long_lines:
+        fields = bytes(block[starts[line]:ends[line]]).split(b",")
+        # The last field keeps the line's newline
+        pieces += [bytes(block[position:starts[line]]), b",".join(fields[:len(TICK_COLUMNS) - 1] + fields[-1:])]
+        position = ends[line]
+    pieces.append(bytes(block[position:]))
+    return b"".join(pieces)
+
+
+class _BufferReader(io.RawIOBase):
+    """Binary file over a buffer (a slice of a memory map), read from in place instead of copied whole"""
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        size = min(len(target), len(self.view) - self.position)
+        target[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+def _read_raw(block, dtype):
+    try:
+        return pd.read_csv(
+            _BufferReader(block),
+            header=None,
+            names=TICK_COLUMNS,
+            dtype=dtype,
+            index_col=False,
+            keep_default_na=False,
+            quoting=csv.QUOTE_NONE,
+            on_bad_lines="skip",
+            encoding="utf-8",
+            encoding_errors="replace",
+        )
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame({column: pd.Series(dtype=dtype if dtype is str else TICK_DTYPES[column])
+                             for column in TICK_COLUMNS})
+
+
+def _coerce_ticks(raw, fields):
+    """Convert an all-text frame to the typed columns, leaving NaN where a field is unusable.
+
+    fields is the number of fields each row had. Also returns the reason
+    each unusable row will be rejected for (None for good rows).
+    """
+    ticks = pd.DataFrame({"action": raw["action"], "token": raw["token"], "side": raw["side"]})
+    for column in ["order_id", "other_order_id", "price", "order_quantity"]:
+        ticks[column] = pd.to_numeric(raw[column].str.strip(), errors="coerce")
+    ticks["seq"] = pd.to_numeric(raw["seq"].str.strip(), errors="coerce").fillna(-1).astype("int64")
+
+    # Timestamps must stay exact integers, so only whole-number text that fits int64 is converted
+    stamps = raw["exchange_time"].str.strip()
+    whole = stamps.str.fullmatch(r"[+-]?\d{1,19}").fillna(False).astype(bool)
+    whole &= pd.to_numeric(stamps.where(whole), errors="coerce").abs() < 2 ** 63
+    ticks["exchange_time"] = 0
+    ticks.loc[whole, "exchange_time"] = stamps[whole].astype("int64")
+    ticks["exchange_time"] = ticks["exchange_time"].astype("int64")
+
+    # The field count decides first, since a field the row did not have reads as empty. A row of
+    # eight takes its quantity from the last field as the line-by-line loop did
+    eight = fields == len(TICK_COLUMNS) - 1
+    ticks.loc[eight, "order_quantity"] = ticks.loc[eight, "price"]
+    ticks.loc[eight, "price"] = np.nan
+    short = fields < len(TICK_COLUMNS) - 1
+    reasons = pd.Series(None, index=raw.index, dtype=object)
+    reasons[short] = "short_row"
+    reasons[~short & ~whole] = "bad_timestamp"
+    reasons[~short & whole & ticks["order_quantity"].isna()] = "bad_quantity"
+
+    ticks.loc[~whole, "order_quantity"] = np.nan
+    return ticks[TICK_COLUMNS], reasons
+
+
+def _strip_categories(values):
+    """A text column as a categorical with surrounding whitespace stripped, by stripping its categories"""
+    values = pd.Categorical(values)
+    codes, uniques = pd.factorize(values.categories.str.strip())
+    codes = np.append(codes, -1)[values.codes]
+    return pd.Categorical.from_codes(codes, uniques)
+
+
+def _line_end(mapped, position, end):
+    """Position just after the first newline at or after position (or end if there is none before it)"""
+    cut = mapped.find(b"\n", position, end)
+    return end if cut < 0 else cut + 1
+
+
+def iter_blocks(file_path, block_size=BLOCK_SIZE, start=0, end=None):
+    """Yield the file's bytes from start to end in blocks that each end on a line boundary.
+
+    The blocks are memoryviews of a read-only memory map of the file, valid
+    until the next block is asked for.
+    """
+    end = os.path.getsize(file_path) if end is None else end
+    if end <= start:
+        return
+    with open(file_path, "rb") as file, mmap.mmap(file.fileno(), end, access=mmap.ACCESS_READ) as mapped:
+        position = start
+        while position < end:
+            cut = _line_end(mapped, min(position + block_size, end) - 1, end)
+            block = memoryview(mapped)[position:cut]
+            yield block
+            # Released, so the map can be closed once the file is done
+            block.release()
+            position = cut
+
+
+def split_ranges(file_path, parts, start=0, end=None):
+    """Cut the bytes from start to end into up to parts (start, end) ranges of about equal size, at line ends"""
+    end = os.path.getsize(file_path) if end is None else end
+    if end <= start:
+        return []
+    with open(file_path, "rb") as file, mmap.mmap(file.fileno(), end, access=mmap.ACCESS_READ) as mapped:
+        cuts = [start]
+        for part in range(1, parts):
+            cut = _line_end(mapped, max(start + (end - start) * part // parts, cuts[-1]) - 1, end)
+            if cuts[-1] < cut < end:
+                cuts.append(cut)
+    return list(zip(cuts, cuts[1:] + [end]))
+
+
+def parse_tick_block(block, stats=None):
+    """Parse a block of complete lines into typed columns, dropping unusable rows.
+
+    Rows with fewer than eight fields, a non-integer timestamp or a non-numeric
+    quantity are dropped, the same rows the old line-by-line loop skipped.
+    Rows with eight fields or more than nine take their quantity from the
+    last field, as it did; an eight-field row has no price. Counts and samples
+    of what was dropped go to stats, if given.
+    """
+    lines, blank = _count_lines(block)
+    try:
+        raw = _read_raw(block, TICK_DTYPES)
+        if raw["order_quantity"].isna().any():
+            # A missing quantity field reads as NaN too, so the text path tells short rows apart
+            raise ValueError("missing order quantity")
+        ticks, reasons = raw, pd.Series(None, index=raw.index, dtype=object)
+    except (ValueError, OverflowError):
+        # Some row does not fit the typed columns, parse as text and coerce column by column
+        raw = _read_raw(block, str)
+        fields = _field_counts(block)
+        if len(fields) != len(raw):
+            # Rows with too many fields were skipped, the block is read again below with them cut down
+            fields = np.full(len(raw), len(TICK_COLUMNS))
+        ticks, reasons = _coerce_ticks(raw, fields)
+    if lines - blank > len(raw):
+        # read_csv skipped rows with too many fields, read the block again with them cut down
+        folded = _fold_extra_fields(block)
+        if folded is not block:
+            return parse_tick_block(folded, stats)
+
+    ticks["action"] = _strip_categories(ticks["action"])
+    ticks["token"] = _strip_categories(ticks["token"])
+    ticks["side"] = pd.Categorical(ticks["side"])
+    ticks["adjusted_time"] = to_exchange_times(ticks["exchange_time"].to_numpy())
+    reasons[ticks["adjusted_time"].isna() & reasons.isna()] = "bad_timestamp"
+
+    if stats is not None:
+        stats.record_block(lines, raw, reasons)
+    ticks = ticks[reasons.isna()].reset_index(drop=True)
+    for column in TEXT_COLUMNS:
+        # Values only rejected rows had are dropped from the categories too
+        ticks[column] = ticks[column].cat.remove_unused_categories()
+    return ticks
+
+
+def iter_tick_blocks(file_path, progress=None, stats=None, start=0, end=None, block_size=BLOCK_SIZE):
+    """Parse an upload one block (block_size bytes) at a time, yielding a typed DataFrame per block.
+
+    Only one block's rows are held at a time. start and end limit the parse
+    to that byte range, which must begin and end on line boundaries.
+    progress, if given, is called after every block as
+    progress(bytes_read, total_bytes, rows_parsed). Line and rejection
+    counters are collected into stats (a fresh IngestStats if none is
+    passed) and logged once the file is done.
+    """
+    if stats is None:
+        stats = IngestStats()
+    total_bytes = (os.path.getsize(file_path) if end is None else end) - start
+    bytes_read, rows_parsed = 0, 0
+    for block in iter_blocks(file_path, block_size, start=start, end=end):
+        ticks = parse_tick_block(block, stats)
+        bytes_read += len(block)
+        rows_parsed += len(ticks)
+        if progress:
+            progress(bytes_read, total_bytes, rows_parsed)
+        yield ticks
+    log_stats(file_path, stats)
+
+
+def log_stats(file_path, stats):
+    logger.info("Parsed %s: %d lines read, %d accepted, rejected %s",
+                os.path.basename(file_path), stats.lines_read, stats.accepted, dict(stats.rejected))
+    for row, reason, text in stats.samples:
+        logger.debug("Rejected row %d (%s): %s", row, reason, text)
+
+
+def read_tick_file(file_path, progress=None, stats=None, start=0, end=None):
+    """Parse an upload into a typed DataFrame with one row per usable tick (see iter_tick_blocks)"""
+    blocks = list(iter_tick_blocks(file_path, progress, stats, start, end))
+    if not blocks:
+        return parse_tick_block(b"")
+    return pd.concat(blocks, ignore_index=True)
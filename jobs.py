@@ -0,0 +1,99 @@
+"""Background job queue for upload processing.
+
+Jobs run on a small fixed pool of worker threads so a burst of uploads
+queues up instead of tying up Flask request threads. Each job records its
+current stage and progress, which /jobs/<id> reports back to the browser.
+"""
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 2
+
+# Finished jobs are forgotten after this many seconds
+JOB_RETENTION = 3600
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="upload-job")
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class Job:
+    def __init__(self, file_name):
+        self.id = uuid.uuid4().hex
+        self.file_name = file_name
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = 0.0
+        self.rows_processed = 0
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def update(self, stage, progress=None, rows_processed=None):
+        """Progress callback handed to the processing function"""
+        self.stage = stage
+        if progress is not None:
+            self.progress = min(max(progress, 0.0), 1.0)
+        if rows_processed is not None:
+            self.rows_processed = rows_processed
+
+    def eta_seconds(self):
+        if self.status != "running" or self.progress <= 0:
+            return None
+        elapsed = time.time() - self.started_at
+        return elapsed / self.progress * (1 - self.progress)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "file": self.file_name,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 3),
+            "rows_processed": self.rows_processed,
+            "eta_seconds": self.eta_seconds(),
+            "error": self.error,
+        }
+
+
+def _run(job, func, args):
+    job.status = "running"
+    job.started_at = time.time()
+    try:
+        func(*args, progress=job.update)
+        job.status = "done"
+        job.update("done", progress=1.0)
+    except Exception as e:
+        logger.exception("Job %s for %s failed", job.id, job.file_name)
+        job.status = "failed"
+        job.error = str(e)
+    finally:
+        job.finished_at = time.time()
+
+
+def _forget_old_jobs():
+    cutoff = time.time() - JOB_RETENTION
+    for job_id, job in list(_jobs.items()):
+        if job.finished_at and job.finished_at < cutoff:
+            del _jobs[job_id]
+
+
+def submit_job(file_name, func, *args):
+    """Queue func(*args, progress=...) on the worker pool and return its Job"""
+    job = Job(file_name)
+    with _jobs_lock:
+        _forget_old_jobs()
+        _jobs[job.id] = job
+    _executor.submit(_run, job, func, args)
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
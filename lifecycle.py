@@ -0,0 +1,366 @@
+"""Order lifecycles: how long after it was placed each order was modified, cancelled or filled.
+
+N, M and X rows carry the order they act on in order_id; a T row names
+both matched orders, in order_id and other_order_id. Every such reference
+becomes an (order, action, time) event. One sort by order, action and time
+puts each order's events of every kind next to each other; those before
+the order's N event are dropped, found by binary search against the
+orders' N events, and the latencies are read off the first that remain,
+with no per-order Python loop.
+
+The events are read from the cached ticks a chunk at a time. If there are
+more than fit in the memory budget, they are split into groups by order id
+range (from a histogram of the ids), spilled to disk by group, and each
+group's orders are worked out in turn and written after the previous ones.
+
+Orders that were never placed in the upload (no N row) have no lifecycle,
+and a latency is missing (NaN) when the order never reached that stage.
+The lifecycles are stored with the upload's cache, in lifecycles-<rows>/,
+so they are built once per upload (and again only if the file grows).
+"""
+import json
+import os
+import re
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from ingest import MEMORY_BUDGET
+from tick_cache import cached_dir, cached_row_count, iter_cached_ticks, take_cached_ticks, CHUNK_ROWS
+from timestamps import EXCHANGE_TIMEZONE
+
+LIFECYCLE_FOLDER = "lifecycles"
+
+# Latency name -> (action that ends it, label)
+LATENCIES = {
+    "to_modify": ("M", "Order to Modify"),
+    "to_cancel": ("X", "Order to Cancel"),
+    "to_fill": ("T", "Order to Fill"),
+}
+
+# Histogram bin edges in seconds, log-spaced from a microsecond to over a day
+LATENCY_BIN_EDGES = 10.0 ** np.arange(-6, 5.01, 0.2)
+
+DEFAULT_PERCENTILES = [50, 90, 99]
+
+# Event actions, coded by position: placement first, then the end of each latency
+EVENT_ACTIONS = ["N"] + [action for action, _ in LATENCIES.values()]
+
+# Arrays of an event and their types, as spilled to disk
+EVENT_ARRAYS = [("ids", "float64"), ("action_codes", "int8"), ("times", "int64"), ("rows", "int64")]
+
+# Peak bytes per event while lifecycles are worked out (its arrays, the sort and the copies)
+EVENT_MEMORY_BYTES = 160
+
+# Bins of the order id histogram that events are split into groups by
+ID_BINS = 1 << 16
+
+
+def _order_events(ticks, first_row=0):
+    """(order id, action code, epoch ns, row) of every reference to an order, T rows counting for both sides.
+
+    first_row is the position of the frame's first row in the upload.
+    """
+    actions = ticks["action"].astype(str).to_numpy()
+    times = ticks["adjusted_time"].array.asi8
+    rows = np.arange(first_row, first_row + len(ticks))
+    own = np.isin(actions, EVENT_ACTIONS)
+    trades = actions == "T"
+    ids = np.concatenate([ticks["order_id"].to_numpy()[own], ticks["other_order_id"].to_numpy()[trades]])
+    action_codes = pd.Categorical(np.concatenate([actions[own], actions[trades]]), categories=EVENT_ACTIONS).codes
+    events = (ids, action_codes, np.concatenate([times[own], times[trades]]), np.concatenate([rows[own], rows[trades]]))
+    # A missing or zero id refers to no order
+    keep = np.isfinite(ids) & (ids != 0)
+    return [values[keep] for values in events]
+
+
+def _placed_latencies(ids, action_codes, times, rows):
+    """Order ids, placement times, placement rows and latencies from every event of the orders involved"""
+    order = np.lexsort((times, action_codes, ids))
+    ids, action_codes, times, rows = ids[order], action_codes[order], times[order], rows[order]
+
+    # Each order is placed at its first N event
+    placed_event = action_codes == 0
+    placed_event[1:] &= (ids[1:] != ids[:-1]) | ~placed_event[:-1]
+    order_ids, placed, placed_rows = ids[placed_event], times[placed_event], rows[placed_event]
+
+    # Other events count only if their order was placed, and only from then on (one before it
+    # belongs to an earlier order with the same id)
+    positions = np.searchsorted(order_ids, ids)
+    found = (positions < len(order_ids)) & ~placed_event
+    found[found] = order_ids[positions[found]] == ids[found]
+    found[found] = times[found] >= placed[positions[found]]
+    ids, action_codes, times, positions = ids[found], action_codes[found], times[found], positions[found]
+
+    # Then the first remaining event of each kind for each order
+    first = np.ones(len(ids), dtype=bool)
+    first[1:] = (ids[1:] != ids[:-1]) | (action_codes[1:] != action_codes[:-1])
+    latencies = {}
+    for code, name in enumerate(LATENCIES, start=1):
+        event = first & (action_codes == code)
+        seconds = np.full(len(order_ids), np.nan)
+        seconds[positions[event]] = (times[event] - placed[positions[event]]) / 1e9
+        latencies[name] = seconds
+    return order_ids, placed, placed_rows, latencies
+
+
+class OrderLifecycles:
+    """One entry per order placed in the upload, sorted by order id.
+
+    placed is the epoch ns of the order's first N event, token_codes and
+    side_codes index tokens and sides (taken from that N row), and
+    latencies maps each name in LATENCIES to seconds from placement to the
+    first event of that kind after it (NaN if there was none).
+    """
+
+    def __init__(self, order_ids, placed, tokens, token_codes, sides, side_codes, latencies):
+        self.order_ids = order_ids
+        self.placed = placed
+        self.tokens = tokens
+        self.token_codes = token_codes
+        self.sides = sides
+        self.side_codes = side_codes
+        self.latencies = latencies
+
+    @classmethod
+    def from_ticks(cls, ticks):
+        order_ids, placed, placed_rows, latencies = _placed_latencies(*_order_events(ticks))
+        return cls._labelled(order_ids, placed, ticks["token"].to_numpy()[placed_rows],
+                             ticks["side"].to_numpy()[placed_rows], latencies)
+
+    @classmethod
+    def _labelled(cls, order_ids, placed, tokens, sides, latencies):
+        # Token and side of each order, coded against their sorted values
+        tokens, sides = pd.Categorical(tokens), pd.Categorical(sides)
+        return cls(order_ids, placed, pd.Index(tokens.categories.astype(str), name="token"), tokens.codes,
+                   pd.Index(sides.categories.astype(str), name="side"), sides.codes, latencies)
+
+    def save(self, directory):
+        os.makedirs(directory)
+        for name in ["order_ids", "placed", "token_codes", "side_codes"]:
+            np.save(os.path.join(directory, f"{name}.npy"), np.asarray(getattr(self, name)))
+        for name, seconds in self.latencies.items():
+            np.save(os.path.join(directory, f"{name}.npy"), seconds)
+        with open(os.path.join(directory, "lifecycles.json"), "w") as info_file:
+            json.dump({"tokens": self.tokens.tolist(), "sides": self.sides.tolist()}, info_file)
+
+    @classmethod
+    def load(cls, directory):
+        """Read lifecycles written by save, memory-mapping the arrays"""
+        with open(os.path.join(directory, "lifecycles.json")) as info_file:
+            info = json.load(info_file)
+
+        def load_array(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+        return cls(
+            load_array("order_ids"), load_array("placed"), pd.Index(info["tokens"], name="token"),
+            load_array("token_codes"), pd.Index(info["sides"], name="side"), load_array("side_codes"),
+            {name: load_array(name) for name in LATENCIES}
+        )
+
+    def __len__(self):
+        return len(self.order_ids)
+
+    def select(self, tokens=None, sides=None, start=None, end=None, **ignored):
+        """Only the orders of the given tokens and sides, placed in [start, end).
+
+        Takes the tick_query filter keywords; actions make no sense for a
+        whole lifecycle and are ignored.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        for values, index, codes in [(tokens, self.tokens, self.token_codes), (sides, self.sides, self.side_codes)]:
+            if values:
+                wanted = index.get_indexer(values)
+                keep &= np.isin(codes, wanted[wanted >= 0])
+        if start is not None:
+            keep &= np.asarray(self.placed) >= start.value
+        if end is not None:
+            keep &= np.asarray(self.placed) < end.value
+        if keep.all():
+            return self
+        return OrderLifecycles(
+            np.asarray(self.order_ids)[keep], np.asarray(self.placed)[keep], self.tokens,
+            np.asarray(self.token_codes)[keep], self.sides, np.asarray(self.side_codes)[keep],
+            {name: np.asarray(seconds)[keep] for name, seconds in self.latencies.items()}
+        )
+
+    def placed_buckets(self, bucket):
+        """Bucket codes of each order's placement time, and the sorted bucket start times"""
+        placed = pd.DatetimeIndex(np.asarray(self.placed).view("datetime64[ns]")).tz_localize("UTC")
+        codes, buckets = pd.factorize(placed.tz_convert(EXCHANGE_TIMEZONE).floor(bucket), sort=True)
+        return codes, pd.DatetimeIndex(buckets, name="hour")
+
+    def histogram(self, name, edges=LATENCY_BIN_EDGES):
+        """Order count per latency bin (values outside the edges go in the first or last bin)"""
+        seconds = np.asarray(self.latencies[name])
+        seconds = np.clip(seconds[~np.isnan(seconds)], edges[0], edges[-1])
+        counts, _ = np.histogram(seconds, edges)
+        return counts
+
+    def percentiles(self, name, by="hour", bucket="1h", percentiles=DEFAULT_PERCENTILES):
+        """Latency percentiles (in seconds) and order count per bucket of placement time, or per token.
+
+        A frame indexed by bucket (or token) with one column per percentile
+        (p50, p90, ...) and "orders", the number of orders that reached the
+        stage; groups where none did are left out.
+        """
+        if by == "token":
+            groups, index = np.asarray(self.token_codes), self.tokens
+        elif by == "hour":
+            groups, index = self.placed_buckets(bucket)
+        else:
+            raise ValueError(f"Unknown grouping {by!r}, expected hour or token.")
+        values, counts = _grouped_percentiles(groups, np.asarray(self.latencies[name]), len(index), percentiles)
+        frame = pd.DataFrame(values, index=index, columns=[f"p{percentile:g}" for percentile in percentiles])
+        frame["orders"] = counts
+        return frame[counts > 0]
+
+
+def _grouped_percentiles(groups, values, group_count, percentiles):
+    """Percentiles of values within each group code, interpolated as np.percentile does, from one sort"""
+    known = ~np.isnan(values)
+    groups, values = groups[known], values[known]
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    starts = np.searchsorted(groups, np.arange(group_count))
+    counts = np.searchsorted(groups, np.arange(group_count), side="right") - starts
+
+    result = np.full((group_count, len(percentiles)), np.nan)
+    present = counts > 0
+    starts, last = starts[present], counts[present] - 1
+    for column, percentile in enumerate(percentiles):
+        position = last * percentile / 100
+        below = np.floor(position).astype("int64")
+        above = np.minimum(below + 1, last)
+        fraction = position - below
+        result[present, column] = values[starts + below] * (1 - fraction) + values[starts + above] * fraction
+    return result, counts
+
+
+def _event_chunks(cache_dir):
+    first_row = 0
+    for ticks in iter_cached_ticks(cache_dir, CHUNK_ROWS):
+        yield _order_events(ticks, first_row)
+        first_row += len(ticks)
+
+
+def _group_lifecycles(cache_dir, events):
+    """OrderLifecycles from a group of events holding every event of its orders, labelled from their N rows"""
+    order_ids, placed, placed_rows, latencies = _placed_latencies(*events)
+    # The N rows are read in file order, then put back in order id order
+    order = np.argsort(placed_rows)
+    placed_ticks = take_cached_ticks(cache_dir, placed_rows[order])
+    inverse = np.empty(len(order), dtype="int64")
+    inverse[order] = np.arange(len(order))
+    return OrderLifecycles._labelled(order_ids, placed, placed_ticks["token"].to_numpy()[inverse],
+                                     placed_ticks["side"].to_numpy()[inverse], latencies)
+
+
+def _id_boundaries(cache_dir, group_events):
+    """Order ids splitting the upload's events into groups of about group_events each, by id range"""
+    lowest, highest = np.inf, -np.inf
+    for ids, *_ in _event_chunks(cache_dir):
+        if len(ids):
+            lowest, highest = min(lowest, ids.min()), max(highest, ids.max())
+    if not lowest < highest:
+        return np.empty(0)
+    edges = np.linspace(lowest, highest, ID_BINS + 1)
+    counts = np.zeros(ID_BINS, dtype="int64")
+    for ids, *_ in _event_chunks(cache_dir):
+        counts += np.histogram(ids, edges)[0]
+    cumulative = np.cumsum(counts)
+    # A group ends with the bin its events reach the next multiple of group_events in
+    return edges[np.unique(np.searchsorted(cumulative, np.arange(group_events, cumulative[-1], group_events))) + 1]
+
+
+def _save_concatenated(parts, directory):
+    """Save lifecycles of increasing, disjoint order id ranges as one, writing each array a part at a time"""
+    os.makedirs(directory)
+    tokens = pd.Index(sorted(set().union(*[part.tokens for part in parts])), name="token")
+    sides = pd.Index(sorted(set().union(*[part.sides for part in parts])), name="side")
+
+    def write(name, dtype, values_of):
+        array = np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+", dtype=dtype,
+                                          shape=(sum(len(part) for part in parts),))
+        position = 0
+        for part in parts:
+            values = values_of(part)
+            array[position:position + len(values)] = values
+            position += len(values)
+        array.flush()
+
+    write("order_ids", "float64", lambda part: part.order_ids)
+    write("placed", "int64", lambda part: part.placed)
+    # Codes renumbered against the tokens and sides of all parts; a missing one stays -1
+    write("token_codes", "int32", lambda part: np.append(tokens.get_indexer(part.tokens), -1)[part.token_codes])
+    write("side_codes", "int32", lambda part: np.append(sides.get_indexer(part.sides), -1)[part.side_codes])
+    for name in LATENCIES:
+        write(name, "float64", lambda part: part.latencies[name])
+    with open(os.path.join(directory, "lifecycles.json"), "w") as info_file:
+        json.dump({"tokens": tokens.tolist(), "sides": sides.tolist()}, info_file)
+
+
+def build_lifecycles(cache_dir, directory):
+    """Work out the order lifecycles of a cache directory's ticks and save them to directory.
+
+    Events are gathered a chunk at a time. If there are more than
+    MEMORY_BUDGET allows at once, they are spilled to disk in order id
+    groups, and each group is worked out and saved in turn, then all of them
+    joined into one.
+    """
+    group_events = max(MEMORY_BUDGET // EVENT_MEMORY_BYTES, 1)
+    # At most two events per row (a T row refers to both orders)
+    if 2 * cached_row_count(cache_dir) <= group_events:
+        chunks = list(_event_chunks(cache_dir))
+        events = [np.concatenate(arrays) for arrays in zip(*chunks)] if chunks else [
+            np.empty(0, dtype=dtype) for _, dtype in EVENT_ARRAYS]
+        _group_lifecycles(cache_dir, events).save(directory)
+        return
+
+    boundaries = _id_boundaries(cache_dir, group_events)
+    scratch_dir = f"{directory}.scratch"
+    os.makedirs(scratch_dir)
+    try:
+        for events in _event_chunks(cache_dir):
+            groups = np.searchsorted(boundaries, events[0], side="right")
+            for group in np.unique(groups):
+                for (name, dtype), values in zip(EVENT_ARRAYS, events):
+                    with open(os.path.join(scratch_dir, f"{group}-{name}.bin"), "ab") as spill_file:
+                        values[groups == group].astype(dtype).tofile(spill_file)
+
+        parts = []
+        for group in range(len(boundaries) + 1):
+            paths = [os.path.join(scratch_dir, f"{group}-{name}.bin") for name, _ in EVENT_ARRAYS]
+            if not os.path.isfile(paths[0]):
+                continue
+            events = [np.fromfile(path, dtype=dtype) for path, (_, dtype) in zip(paths, EVENT_ARRAYS)]
+            group_dir = os.path.join(scratch_dir, f"group-{group}")
+            _group_lifecycles(cache_dir, events).save(group_dir)
+            del events
+            for path in paths:
+                os.remove(path)
+            parts.append(OrderLifecycles.load(group_dir))
+        _save_concatenated(parts, directory)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def load_lifecycles(file_path):
+    """The upload's order lifecycles, built now if the cache has grown since they were last built"""
+    cache_dir = cached_dir(file_path)
+    lifecycle_dir = os.path.join(cache_dir, f"{LIFECYCLE_FOLDER}-{cached_row_count(cache_dir)}")
+    if not os.path.isdir(lifecycle_dir):
+        tmp_dir = f"{lifecycle_dir}.{uuid.uuid4().hex}.tmp"
+        build_lifecycles(cache_dir, tmp_dir)
+        try:
+            os.replace(tmp_dir, lifecycle_dir)
+        except OSError:
+            # Another request built them first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        for name in os.listdir(cache_dir):
+            if re.fullmatch(rf"{LIFECYCLE_FOLDER}-\d+", name) and os.path.join(cache_dir, name) != lifecycle_dir:
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+    return OrderLifecycles.load(lifecycle_dir)
@@ -0,0 +1,241 @@
+"""Live tail of a tick file or named pipe, pushed to the browser as running aggregates.
+
+One reader thread per followed path parses new lines as they are written
+and keeps hourly and per-token totals in memory. Every subscriber gets a
+queue: first a snapshot of the totals so far, then a delta event for each
+batch of new lines, which /stream forwards as Server-Sent Events.
+
+The leading tokens are ranked by Space-Saving trackers (see topk) updated with
+each batch, so every event can carry the current top tokens without the
+full per-token table being regrouped.
+"""
+import logging
+import os
+import queue
+import stat
+import threading
+import time
+
+import numpy as np
+
+from aggregates import TickAggregates, DEFAULT_BUCKET, CONTEXT_ROWS
+from ingest import parse_tick_block
+from tick_cache import rollup_snapshot
+from topk import SpaceSaving
+
+logger = logging.getLogger(__name__)
+
+# How often an idle reader checks for new data, well inside the one-second target
+POLL_INTERVAL = 0.2
+
+# Most bytes parsed per delta, so a burst is sent as several events rather than one late one
+READ_SIZE = 4 * 1024 * 1024
+
+# Events a subscriber may fall behind by before its queue is replaced with a fresh snapshot
+MAX_PENDING_EVENTS = 500
+
+# Tokens in each live top list; their trackers are bounded since a followed file may run for days
+TOP_TOKENS = 5
+
+_tails = {}
+_tails_lock = threading.Lock()
+
+
+def summarize(aggregates):
+    """Hourly and per-token totals of an aggregates object as plain JSON types"""
+    combos = dict(zip(aggregates.buckets, aggregates.combos.tolist()))
+    hours = {
+        str(hour): {"entries": int(entries), "quantity": float(quantity), "combos": int(combos.get(hour, 0))}
+        for hour, entries, quantity in zip(
+            aggregates.buckets, aggregates.entries_per_bucket(), aggregates.quantity_per_bucket()
+        )
+    }
+    entries_per_token = aggregates.entries_per_token()
+    tokens = {
+        str(token): {"entries": int(entries_per_token[token]), "quantity": float(quantity)}
+        for token, quantity in aggregates.quantity_per_token().items()
+    }
+    return {"hours": hours, "tokens": tokens}
+
+
+def _add_summary(totals, delta):
+    """Add a summarize() of new ticks into running totals of the same shape, in place"""
+    for section, rows in delta.items():
+        running = totals[section]
+        for key, values in rows.items():
+            if key in running:
+                for name, value in values.items():
+                    running[key][name] += value
+            else:
+                running[key] = dict(values)
+
+
+def _token_totals(aggregates):
+    """Tokens in first-seen order with their entry counts and quantity sums"""
+    order = np.argsort(aggregates.token_first_seen)
+    entries = np.bincount(aggregates.cell_tokens, weights=aggregates.cell_entries, minlength=len(aggregates.tokens))
+    quantity = np.bincount(aggregates.cell_tokens, weights=aggregates.cell_quantity, minlength=len(aggregates.tokens))
+    return aggregates.tokens[order], entries[order], quantity[order]
+
+
+class LiveTail:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.running = True
+        # summarize() of everything read so far, kept up to date in place
+        self.totals = None
+        self.context = None
+        self.position = 0
+        self.top_entries = None
+        self.top_quantity = None
+
+    def _start(self):
+        """(Re)load the totals up to where the reader starts following the file"""
+        if stat.S_ISFIFO(os.stat(self.file_path).st_mode):
+            # A pipe has no history, the totals start from nothing
+            empty = parse_tick_block(b"")
+            aggregates, position, context = TickAggregates.from_ticks(empty, DEFAULT_BUCKET), 0, empty
+        else:
+            aggregates, position, context = rollup_snapshot(self.file_path, DEFAULT_BUCKET)
+        top_entries, top_quantity = SpaceSaving(), SpaceSaving()
+        tokens, entries, quantity = _token_totals(aggregates)
+        top_entries.update(tokens, entries)
+        top_quantity.update(tokens, quantity)
+        with self.lock:
+            self.totals, self.position, self.context = summarize(aggregates), position, context
+            self.top_entries, self.top_quantity = top_entries, top_quantity
+            for subscriber in self.subscribers:
+                self._reset(subscriber)
+
+    def _top_tokens(self):
+        """The tokens with most entries so far, each with its entries and quantity"""
+        return [
+            {"token": str(token), "entries": int(entries), "quantity": float(self.top_quantity.estimate(token))}
+            for token, entries in self.top_entries.top(TOP_TOKENS)
+        ]
+
+    def _snapshot_event(self):
+        # Copied, since the totals go on changing while the event waits in a queue
+        totals = {section: {key: dict(values) for key, values in rows.items()} for section, rows in self.totals.items()}
+        return {"type": "snapshot", "file": os.path.basename(self.file_path), "time": time.time(),
+                **totals, "top": self._top_tokens()}
+
+    def _clear(self, subscriber):
+        while True:
+            try:
+                subscriber.get_nowait()
+            except queue.Empty:
+                break
+
+    def _reset(self, subscriber):
+        self._clear(subscriber)
+        subscriber.put_nowait(self._snapshot_event())
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=MAX_PENDING_EVENTS)
+        with self.lock:
+            self.subscribers.append(subscriber)
+            if self.totals is not None:
+                subscriber.put_nowait(self._snapshot_event())
+        return subscriber
+
+    def _publish(self, ticks):
+        # Only the buckets and tokens of the new lines are summarized, sent and added to the totals
+        delta = TickAggregates.from_ticks(ticks, DEFAULT_BUCKET, context=self.context)
+        tokens, entries, quantity = _token_totals(delta)
+        delta_summary = summarize(delta)
+        with self.lock:
+            _add_summary(self.totals, delta_summary)
+            self.context = ticks.tail(CONTEXT_ROWS)
+            self.top_entries.update(tokens, entries)
+            self.top_quantity.update(tokens, quantity)
+            event = {
+                "type": "delta", "time": time.time(), "rows": len(ticks),
+                "actions": {str(action): int(count) for action, count in ticks["action"].value_counts().items()},
+                **delta_summary, "top": self._top_tokens()
+            }
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    # Too far behind to catch up on deltas, start it again from the totals
+                    self._reset(subscriber)
+
+    def _open(self):
+        fd = os.open(self.file_path, os.O_RDONLY | os.O_NONBLOCK)
+        if self.position:
+            os.lseek(fd, self.position, os.SEEK_SET)
+        return fd
+
+    def _follow(self):
+        fd = None
+        try:
+            self._start()
+            fd = self._open()
+            remainder = b""
+            while self._keep_running():
+                try:
+                    data = os.read(fd, READ_SIZE)
+                except BlockingIOError:
+                    data = b""
+                if not data:
+                    if os.path.isfile(self.file_path) and os.path.getsize(self.file_path) < self.position:
+                        # Rewritten rather than appended to, so start over from the new contents
+                        os.close(fd)
+                        fd = None
+                        self._start()
+                        fd = self._open()
+                        remainder = b""
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+                self.position += len(data)
+                data = remainder + data
+                cut = data.rfind(b"\n") + 1
+                remainder = data[cut:]
+                if cut:
+                    ticks = parse_tick_block(data[:cut])
+                    if len(ticks):
+                        self._publish(ticks)
+        except Exception as e:
+            logger.exception("Live tail of %s stopped", self.file_path)
+            with _tails_lock:
+                self._stop()
+            with self.lock:
+                for subscriber in self.subscribers:
+                    self._clear(subscriber)
+                    subscriber.put_nowait({"type": "error", "message": str(e)})
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _keep_running(self):
+        with _tails_lock:
+            if not self.subscribers:
+                self._stop()
+            return self.running
+
+    def _stop(self):
+        # Called with _tails_lock held
+        self.running = False
+        if _tails.get(self.file_path) is self:
+            del _tails[self.file_path]
+
+
+def subscribe(file_path):
+    """Queue of live events for a file, starting a reader for it if none is running"""
+    file_path = os.path.abspath(file_path)
+    with _tails_lock:
+        tail = _tails.get(file_path)
+        if tail is None:
+            tail = _tails[file_path] = LiveTail(file_path)
+            threading.Thread(target=tail._follow, name=f"live-{os.path.basename(file_path)}", daemon=True).start()
+        return tail, tail.subscribe()
+
+
+def unsubscribe(tail, subscriber):
+    with tail.lock:
+        if subscriber in tail.subscribers:
+            tail.subscribers.remove(subscriber)
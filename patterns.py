@@ -0,0 +1,111 @@
+"""Vectorised matching of action sequences such as T->N/M in the tick stream.
+
+A pattern is a list of steps and each step is a set of actions, so
+"N->M->X" is three single-action steps and "T->N/M" means a trade followed
+by either a new order or a modify. Matching compares shifted copies of the
+action codes instead of walking the rows one at a time.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+# Graph 3: a trade immediately followed by a new or modified order
+T_TO_NM = "T->N/M"
+
+
+def parse_pattern(pattern):
+    """Turn "T->N/M" (or a list like ["T", ["N", "M"]]) into a list of action sets"""
+    steps = pattern
+    if isinstance(pattern, str):
+        steps = [step for step in re.split(r"\s*(?:->|→|>|,)\s*", pattern.strip()) if step]
+        steps = [re.split(r"\s*[/|]\s*", step) for step in steps]
+    steps = [{step} if isinstance(step, str) else set(step) for step in steps]
+    if not steps or not all(steps):
+        raise ValueError(f"Invalid action pattern: {pattern!r}")
+    return steps
+
+
+def _codes(values):
+    categorical = values if isinstance(values, pd.Categorical) else pd.Categorical(values)
+    return np.asarray(categorical.codes), categorical.categories
+
+
+def match_pattern(actions, pattern, tokens=None):
+    """Boolean mask, True on each row where the pattern starts.
+
+    With tokens given, the pattern is matched within each token's own
+    sequence of events (in file order) rather than across neighbouring rows
+    of different tokens.
+    """
+    steps = parse_pattern(pattern)
+    codes, categories = _codes(pd.Series(actions).array)
+    size, length = len(codes), len(steps)
+
+    order = None
+    if tokens is not None:
+        token_codes, _ = _codes(pd.Series(tokens).array)
+        order = np.argsort(token_codes, kind="stable")
+        codes, token_codes = codes[order], token_codes[order]
+
+    starts = np.zeros(size, dtype=bool)
+    if size < length:
+        return starts
+
+    window = size - length + 1
+    matched = np.ones(window, dtype=bool)
+    for offset, step in enumerate(steps):
+        step_codes = categories.get_indexer(list(step))
+        matched &= np.isin(codes[offset:offset + window], step_codes[step_codes >= 0])
+        if order is not None and offset:
+            matched &= token_codes[offset:offset + window] == token_codes[:window]
+    starts[:window] = matched
+
+    if order is not None:
+        unsorted = np.zeros(size, dtype=bool)
+        unsorted[order] = starts
+        return unsorted
+    return starts
+
+
+def pattern_counts(df, pattern, by="hour", per_token=False):
+    """Number of pattern matches per value of `by`, counted on the row where each match starts"""
+    starts = match_pattern(df["action"], pattern, df["token"] if per_token else None)
+    return df.loc[starts, by].value_counts().sort_index()
+
+
+class PatternCounter:
+    """pattern_counts by each of several columns, over tick frames added one at a time in file order.
+
+    The last len(pattern) - 1 rows before each frame (of each token, when
+    matching per token) are matched along with it, so a match that straddles
+    two frames is counted once, on the row where it starts.
+    """
+
+    def __init__(self, pattern, by=("hour",), per_token=False):
+        self.pattern = pattern
+        self.by = list(by)
+        self.per_token = per_token
+        self.context_rows = len(parse_pattern(pattern)) - 1
+        self.context = None
+        self.parts = {column: [] for column in self.by}
+
+    def add(self, ticks):
+        ticks = ticks[list(dict.fromkeys(["action", "token"] + self.by))]
+        if self.context is not None:
+            ticks = pd.concat([self.context, ticks], ignore_index=True)
+        # Every match starting in the carried rows runs on into this frame, so none is counted twice
+        starts = match_pattern(ticks["action"], self.pattern, ticks["token"] if self.per_token else None)
+        for column in self.by:
+            self.parts[column].append(ticks.loc[starts, column].value_counts())
+        if self.per_token:
+            context = ticks.groupby("token", observed=True, sort=False).tail(self.context_rows)
+        else:
+            context = ticks.tail(self.context_rows)
+        self.context = context.reset_index(drop=True)
+
+    def counts(self, column="hour"):
+        """Number of matches per value of column, over every frame added"""
+        if not self.parts[column]:
+            return pd.Series(dtype="int64")
+        return pd.concat(self.parts[column]).groupby(level=0, observed=True).sum()
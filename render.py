@@ -0,0 +1,60 @@
+"""HTML/PNG export of Plotly figures on a pool of renderer processes.
+
+Figures are built where the data is and handed over as plain dict specs to
+the renderers. Each starts its own Kaleido (headless Chromium) once and keeps
+it warm, so charts asked for together export at the same time instead of one
+after another.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly.graph_objects as go
+import plotly.io as pio
+
+RENDER_PROCESSES = min(4, os.cpu_count() or 1)
+
+_pool = None
+_pool_lock = threading.Lock()
+# Kaleido is not safe to call from several threads of one process at once
+_inline_lock = threading.Lock()
+
+
+def _warm_up():
+    # The first export in a process starts Kaleido's browser, pay for that before any real chart
+    pio.to_image(go.Figure(), format="png")
+
+
+def get_render_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned rather than forked, so renderers never inherit Flask threads or held locks
+            _pool = ProcessPoolExecutor(
+                max_workers=RENDER_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up
+            )
+        return _pool
+
+
+def _write_figure(fig, path):
+    if path.endswith(".html"):
+        # Loads plotly.js from its CDN like the dashboard does, rather than embedding several MB of it
+        fig.write_html(path, include_plotlyjs="cdn")
+    else:
+        fig.write_image(path)
+
+
+def _export_spec(spec, path):
+    _write_figure(go.Figure(spec), path)
+
+
+def render_figure(fig, path):
+    """Write a single figure as HTML or an image, chosen by the extension of path"""
+    if RENDER_PROCESSES < 2:
+        with _inline_lock:
+            _write_figure(fig, path)
+        return
+    get_render_pool().submit(_export_spec, fig.to_dict(), path).result()
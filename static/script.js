@@ -87,6 +87,10 @@ document.addEventListener('DOMContentLoaded', () => {
             })
             .then(response => response.json())
             .then(data => {
+                if (data.success && data.job_id) {
+                    pollJob(data.job_id);
+                    return;
+                }
                 mainContainer.classList.remove('blur');
                 loadingOverlay.classList.add('hidden');
                 if (data.success && data.files && data.files.length > 0) {
@@ -104,6 +108,40 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // Poll a background upload job until it finishes, showing its stage in the overlay
+    function pollJob(jobId) {
+        const loadingStatus = document.getElementById('loadingStatus');
+        fetch(`/jobs/${jobId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message);
+                }
+                const job = data.job;
+                if (job.status === 'done') {
+                    window.location.href = `/graphs?file=${encodeURIComponent(job.file)}`;
+                    return;
+                }
+                if (job.status === 'failed') {
+                    mainContainer.classList.remove('blur');
+                    loadingOverlay.classList.add('hidden');
+                    alert(`Error processing file: ${job.error}`);
+                    return;
+                }
+                if (loadingStatus) {
+                    const eta = job.eta_seconds === null ? '' : ` - about ${Math.ceil(job.eta_seconds)}s left`;
+                    loadingStatus.textContent =
+                        `${job.stage} (${Math.round(job.progress * 100)}%, ${job.rows_processed} rows)${eta}`;
+                }
+                setTimeout(() => pollJob(jobId), 1000);
+            })
+            .catch(() => {
+                mainContainer.classList.remove('blur');
+                loadingOverlay.classList.add('hidden');
+                showToast("Lost track of the upload job.");
+            });
+    }
+
     // Reset Button Logic
     if (resetBtn) {
         resetBtn.addEventListener('click', () => {
@@ -213,12 +251,18 @@ document.addEventListener('DOMContentLoaded', () => {
             const files = document.getElementById('fileInput').files;
             const formData = new FormData();
             for (let file of files) formData.append('file', file);
+            const mergeInput = document.getElementById('mergeInput');
+            if (mergeInput && mergeInput.checked) formData.append('merge', '1');
             fetch('/upload', { method: 'POST', body: formData })
                 .then(res => res.json())
                 .then(data => {
                     hideLoading();
                     if (data.success) {
                         data.files.forEach(filename => renderFileComponent(filename));
+                        if (data.merged) {
+                            uploadForm.insertAdjacentHTML('afterend',
+                                `<a href="/graphs?file=${encodeURIComponent(data.merged)}" class="analyze-btn">View All Files Combined</a>`);
+                        }
                     }
                 })
                 .catch(() => hideLoading());
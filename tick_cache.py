@@ -0,0 +1,513 @@
+"""On-disk columnar cache of parsed uploads.
+
+Each upload is parsed once into a directory of .npy column files keyed by
+the upload name and a hash of its contents. Later reads memory-map those
+files instead of parsing the raw text again. The rollup pyramid of
+aggregates is stored alongside, in a rollups-v2-<offset>/ sub-directory.
+
+Uploads are parsed a block at a time (see ingest.MEMORY_BUDGET), each block
+stored as one part of the directory: the first in the directory itself, the
+rest in part-NNNNNN/ sub-directories. The pyramid is built by aggregating
+the cached ticks a chunk at a time and merging the chunks' aggregates, so
+neither step holds every row of a large upload at once.
+
+Files that keep growing (a capture still appending to them) are parsed
+incrementally: lines added since the last read are stored as further parts
+and their aggregates merged into the pyramid.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from aggregates import build_rollups, RollupBuilder, TickAggregates, DEFAULT_BUCKET, ROLLUP_BUCKETS, CONTEXT_ROWS
+from ingest import (
+    iter_tick_blocks, log_stats, parse_tick_block, split_ranges, IngestStats, BLOCK_SIZE, MEMORY_BUDGET
+)
+from timestamps import EXCHANGE_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+CACHE_FOLDER = "cache"
+# Versioned, so pyramids stored before the aggregates gained their trade statistics are rebuilt
+ROLLUP_FOLDER = "rollups-v2"
+
+# Bytes before the last read offset that must be unchanged for a file to count as appended to
+TAIL_CHECK_BYTES = 64 * 1024
+
+# Processes a large upload is parsed with, each taking one line-aligned byte range of it
+PARSE_PROCESSES = min(4, os.cpu_count() or 1)
+
+# Rows aggregated at a time when building the rollup pyramid
+CHUNK_ROWS = max(MEMORY_BUDGET // 1024, 10000)
+
+# Appended rows with a seq at or below the last one processed are dropped if it is among this many recent rows
+SEQ_WINDOW = 10000
+
+_file_locks = {}
+_locks_lock = threading.Lock()
+
+# Text columns are stored as dictionary codes plus a JSON list of categories
+CATEGORY_COLUMNS = ["action", "token", "side"]
+NUMERIC_COLUMNS = ["order_id", "other_order_id", "seq", "exchange_time", "price", "order_quantity"]
+
+
+def file_hash(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _entry_path(file_path):
+    return os.path.join(CACHE_FOLDER, os.path.basename(file_path) + ".json")
+
+
+def _read_entry(file_path):
+    try:
+        with open(_entry_path(file_path)) as entry_file:
+            return json.load(entry_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_entry(file_path, entry):
+    with open(_entry_path(file_path), "w") as entry_file:
+        json.dump(entry, entry_file)
+
+
+def save_ticks(ticks, cache_dir):
+    """Write a parsed tick frame as one .npy file per column"""
+    # Written under a private name first so concurrent uploads of the same file never see half a cache
+    tmp_dir = f"{cache_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+
+    categories = {}
+    for column in CATEGORY_COLUMNS:
+        codes, uniques = pd.factorize(ticks[column])
+        np.save(os.path.join(tmp_dir, f"{column}.npy"), codes.astype("int32"))
+        categories[column] = [str(value) for value in uniques]
+    for column in NUMERIC_COLUMNS:
+        np.save(os.path.join(tmp_dir, f"{column}.npy"), ticks[column].to_numpy())
+    epoch_ns = ticks["adjusted_time"].dt.tz_convert("UTC").dt.tz_localize(None).to_numpy().view("int64")
+    np.save(os.path.join(tmp_dir, "adjusted_time.npy"), epoch_ns)
+
+    with open(os.path.join(tmp_dir, "categories.json"), "w") as categories_file:
+        json.dump(categories, categories_file)
+
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # Another writer finished the same content first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _part_dirs(cache_dir):
+    """The cache directory itself, then the parts appended to it in order"""
+    parts = sorted(name for name in os.listdir(cache_dir) if re.fullmatch(r"part-\d{6}", name))
+    return [cache_dir] + [os.path.join(cache_dir, name) for name in parts]
+
+
+def _read_part(part_dir, rows=slice(None), columns=None):
+    with open(os.path.join(part_dir, "categories.json")) as categories_file:
+        categories = json.load(categories_file)
+
+    frame = {}
+    for column in CATEGORY_COLUMNS:
+        if columns is None or column in columns:
+            codes = np.load(os.path.join(part_dir, f"{column}.npy"), mmap_mode="r")[rows]
+            frame[column] = pd.Categorical.from_codes(codes, categories[column])
+    for column in NUMERIC_COLUMNS:
+        if columns is None or column in columns:
+            frame[column] = np.load(os.path.join(part_dir, f"{column}.npy"), mmap_mode="r")[rows]
+    if columns is None or "adjusted_time" in columns:
+        epoch_ns = np.load(os.path.join(part_dir, "adjusted_time.npy"), mmap_mode="r")[rows]
+        frame["adjusted_time"] = (
+            pd.DatetimeIndex(epoch_ns.view("datetime64[ns]")).tz_localize("UTC").tz_convert(EXCHANGE_TIMEZONE)
+        )
+    return pd.DataFrame(frame)
+
+
+def read_saved_ticks(directory, rows=slice(None)):
+    """Rows of a frame written by save_ticks, memory-mapped and read only where selected"""
+    return _read_part(directory, rows)
+
+
+def _parsed_parts(cache_dir):
+    """How many parts the upload was parsed into; any further parts were appended afterwards"""
+    try:
+        with open(os.path.join(cache_dir, "parse.json")) as parse_file:
+            return json.load(parse_file)["parts"]
+    except (OSError, ValueError):
+        # Cached before uploads were parsed in blocks
+        return 1
+
+
+def _parse_range(file_path, start, end, tmp_dir, block_size, progress=None):
+    """Parse one byte range of an upload a block at a time, each block saved to a directory under tmp_dir.
+
+    Runs in a parse process when the upload is split across several.
+    Returns the block directories in order and the range's IngestStats.
+    """
+    stats = IngestStats()
+    block_dirs = []
+    for ticks in iter_tick_blocks(file_path, progress, stats, start, end, block_size):
+        block_dirs.append(os.path.join(tmp_dir, f"range-{start}-{len(block_dirs):06d}"))
+        save_ticks(ticks, block_dirs[-1])
+    return block_dirs, stats
+
+
+def _parse_ranges(file_path, ranges, tmp_dir, progress=None):
+    """_parse_range over every range at once, one process each, splitting the memory budget between them"""
+    total_bytes = ranges[-1][1] - ranges[0][0]
+    results, bytes_read, rows_parsed = {}, 0, 0
+    # Spawned rather than forked, so the parsers never inherit Flask threads or held locks
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {
+            pool.submit(_parse_range, file_path, start, end, tmp_dir, max(BLOCK_SIZE // len(ranges), 1024 * 1024)): (start, end)
+            for start, end in ranges
+        }
+        for future in as_completed(futures):
+            start, end = futures[future]
+            results[start] = future.result()
+            bytes_read += end - start
+            rows_parsed += results[start][1].accepted
+            if progress:
+                progress(bytes_read, total_bytes, rows_parsed)
+
+    block_dirs, stats = [], IngestStats()
+    for start, _ in ranges:
+        block_dirs += results[start][0]
+        stats.add(results[start][1])
+    log_stats(file_path, stats)
+    return block_dirs
+
+
+def _save_parsed_ticks(file_path, end, cache_dir, progress=None):
+    """Parse a whole upload into the parts of a new cache directory, one block at a time.
+
+    Uploads of more than one block are split into PARSE_PROCESSES ranges at
+    line ends and parsed by that many processes, each reading its range
+    from its own memory map of the file.
+    """
+    tmp_dir = f"{cache_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    ranges = split_ranges(file_path, PARSE_PROCESSES if end > BLOCK_SIZE else 1, end=end)
+    if len(ranges) > 1:
+        block_dirs = _parse_ranges(file_path, ranges, tmp_dir, progress)
+    else:
+        block_dirs, _ = _parse_range(file_path, 0, end, tmp_dir, BLOCK_SIZE, progress)
+    if not block_dirs:
+        block_dirs = [os.path.join(tmp_dir, "range-empty")]
+        save_ticks(parse_tick_block(b""), block_dirs[0])
+
+    # The first block's columns go in the directory itself, the rest become its parts in file order
+    for name in os.listdir(block_dirs[0]):
+        os.replace(os.path.join(block_dirs[0], name), os.path.join(tmp_dir, name))
+    os.rmdir(block_dirs[0])
+    for part, block_dir in enumerate(block_dirs[1:], start=1):
+        os.replace(block_dir, os.path.join(tmp_dir, f"part-{part:06d}"))
+    with open(os.path.join(tmp_dir, "parse.json"), "w") as parse_file:
+        json.dump({"parts": len(block_dirs)}, parse_file)
+
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # Another writer finished the same content first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _part_rows(part_dir):
+    return len(np.load(os.path.join(part_dir, "seq.npy"), mmap_mode="r"))
+
+
+def _last_seq(part_dir):
+    """Largest seq in a part, or None if it is empty"""
+    seq = np.load(os.path.join(part_dir, "seq.npy"), mmap_mode="r")
+    return int(seq.max()) if len(seq) else None
+
+
+def _concat_parts(frames):
+    if len(frames) == 1:
+        return frames[0]
+
+    ticks = pd.concat(frames, ignore_index=True)
+    for column in [column for column in CATEGORY_COLUMNS if column in ticks]:
+        ticks[column] = union_categoricals([frame[column] for frame in frames])
+    return ticks
+
+
+def load_cached_ticks(cache_dir):
+    """Rebuild the tick frame from a cache directory, memory-mapping every column"""
+    return _concat_parts([_read_part(part_dir) for part_dir in _part_dirs(cache_dir)])
+
+
+def cached_row_count(cache_dir):
+    return sum(_part_rows(part_dir) for part_dir in _part_dirs(cache_dir))
+
+
+def take_cached_ticks(cache_dir, positions, columns=None):
+    """The cached ticks at the given sorted row positions (counted across all parts), reading only those rows.
+
+    columns, if given, limits the frame to those columns.
+    """
+    frames, first_row = [], 0
+    for part_dir in _part_dirs(cache_dir):
+        rows = _part_rows(part_dir)
+        first, last = np.searchsorted(positions, [first_row, first_row + rows])
+        if last > first or not frames:
+            frames.append(_read_part(part_dir, np.asarray(positions[first:last]) - first_row, columns))
+        first_row += rows
+    return _concat_parts(frames)
+
+
+def _iter_parts(part_dirs, chunk_rows, columns=None):
+    for part_dir in part_dirs:
+        rows = _part_rows(part_dir)
+        for start in range(0, rows, chunk_rows):
+            yield _read_part(part_dir, slice(start, start + chunk_rows), columns)
+
+
+def iter_cached_ticks(cache_dir, chunk_rows, columns=None):
+    """Yield the cached ticks as frames of at most chunk_rows rows, reading only one chunk at a time.
+
+    columns, if given, limits the frames to those columns.
+    """
+    return _iter_parts(_part_dirs(cache_dir), chunk_rows, columns)
+
+
+def cached_categories(cache_dir, column):
+    """Every value a text column takes in the cache, across all its parts, in sorted order"""
+    values = set()
+    for part_dir in _part_dirs(cache_dir):
+        with open(os.path.join(part_dir, "categories.json")) as categories_file:
+            values.update(json.load(categories_file)[column])
+    return sorted(values)
+
+
+def _fold_rollups(chunks, context=None):
+    """build_rollups over tick frames given in file order, aggregating one frame at a time (None if no rows)"""
+    builder = RollupBuilder(context=context)
+    for ticks in chunks:
+        builder.add(ticks)
+    return builder.rollups()
+
+
+def _last_rows(cache_dir, count):
+    """The last count cached ticks, read without loading the rest"""
+    frames = []
+    for part_dir in reversed(_part_dirs(cache_dir)):
+        frames.insert(0, _read_part(part_dir, slice(-count, None)))
+        count -= len(frames[0])
+        if count <= 0:
+            break
+    return pd.concat(frames, ignore_index=True)
+
+
+def _tail_digest(file_path, offset):
+    """Hash of the bytes just before offset, to tell an append from a rewrite"""
+    with open(file_path, "rb") as file:
+        file.seek(max(offset - TAIL_CHECK_BYTES, 0))
+        return hashlib.sha256(file.read(min(offset, TAIL_CHECK_BYTES))).hexdigest()
+
+
+def _last_line_end(file_path, start, end):
+    """Position just after the last newline between start and end, or start if there is none"""
+    with open(file_path, "rb") as file:
+        position = end
+        while position > start:
+            size = min(TAIL_CHECK_BYTES, position - start)
+            file.seek(position - size)
+            cut = file.read(size).rfind(b"\n")
+            if cut >= 0:
+                return position - size + cut + 1
+            position -= size
+    return start
+
+
+def complete_last_line(file_path):
+    """End a finished upload with a newline if it lacks one, so its last line counts as complete"""
+    with open(file_path, "rb+") as file:
+        if file.seek(0, os.SEEK_END):
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                file.write(b"\n")
+
+
+def _rollup_dir(entry):
+    # Named by the byte offset it covers, so a refreshed pyramid never overwrites one being read
+    return os.path.join(entry["cache_dir"], f"{ROLLUP_FOLDER}-{entry['offset']}")
+
+
+def _append_ticks(file_path, entry, stat, progress=None):
+    """Parse only the complete lines written after entry["offset"] and add them to the cache.
+
+    The new ticks are stored as further parts of the cache directory, one
+    per parsed block, and, if the rollup pyramid was already built, their
+    aggregates are merged into it. Appended rows whose seq was already
+    processed (a capture writing the same lines twice) are dropped.
+    """
+    cache_dir = entry["cache_dir"]
+    end = _last_line_end(file_path, entry["offset"], stat.st_size)
+    if end > entry["offset"]:
+        recent = _last_rows(cache_dir, max(SEQ_WINDOW, CONTEXT_ROWS))
+        first_part = len(_part_dirs(cache_dir))
+        for tail in iter_tick_blocks(file_path, progress, start=entry["offset"], end=end):
+            if entry["last_seq"] is not None:
+                replayed = (tail["seq"] <= entry["last_seq"]) & tail["seq"].isin(recent["seq"])
+                if replayed.any():
+                    logger.info("Dropped %d replayed rows from %s", replayed.sum(), os.path.basename(file_path))
+                    tail = tail[~replayed].reset_index(drop=True)
+            if len(tail):
+                save_ticks(tail, os.path.join(cache_dir, f"part-{len(_part_dirs(cache_dir)):06d}"))
+
+        new_parts = _part_dirs(cache_dir)[first_part:]
+        if new_parts:
+            rollup_dir = _rollup_dir(entry)
+            if os.path.isdir(rollup_dir):
+                tail_rollups = _fold_rollups(_iter_parts(new_parts, CHUNK_ROWS), context=recent.tail(CONTEXT_ROWS))
+                save_rollups({
+                    bucket: TickAggregates.merge([TickAggregates.load(os.path.join(rollup_dir, bucket)), tail_rollups[bucket]])
+                    for bucket in ROLLUP_BUCKETS
+                }, _rollup_dir({"cache_dir": cache_dir, "offset": end}))
+                shutil.rmtree(rollup_dir, ignore_errors=True)
+            entry["last_seq"] = max([_last_seq(part_dir) for part_dir in new_parts]
+                                    + [entry["last_seq"] if entry["last_seq"] is not None else -1])
+
+    entry.update({
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "offset": end,
+        "tail_sha256": _tail_digest(file_path, end),
+    })
+    return entry
+
+
+def _refresh(file_path, progress=None):
+    """Bring the cache entry for an upload up to date with the file and return it.
+
+    A size/mtime match against the last recorded entry skips reading the
+    file altogether. If the file only grew since then (the bytes before the
+    recorded offset are unchanged), just the new lines are parsed.
+    Otherwise the file is hashed and parsed in full, unless a cache
+    directory for that name and hash already exists. Either way only
+    complete lines are parsed: an unterminated last line is left for when
+    the rest of it has been written. progress is passed on to
+    iter_tick_blocks when a parse is needed.
+    """
+    stat = os.stat(file_path)
+    entry = _read_entry(file_path)
+    if entry and "offset" in entry and os.path.isdir(entry["cache_dir"]):
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry
+        if stat.st_size >= entry["offset"] and _tail_digest(file_path, entry["offset"]) == entry["tail_sha256"]:
+            entry = _append_ticks(file_path, entry, stat, progress)
+            _write_entry(file_path, entry)
+            return entry
+
+    digest = file_hash(file_path)
+    end = _last_line_end(file_path, 0, stat.st_size)
+    cache_dir = os.path.join(CACHE_FOLDER, f"{os.path.basename(file_path)}-{digest[:16]}")
+    if os.path.isdir(cache_dir) and len(_part_dirs(cache_dir)) > _parsed_parts(cache_dir):
+        # Holds rows appended after that content was cached, so it no longer matches the hash
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        _save_parsed_ticks(file_path, end, cache_dir, progress)
+    if entry and entry["cache_dir"] != cache_dir:
+        shutil.rmtree(entry["cache_dir"], ignore_errors=True)
+
+    last_seqs = [seq for seq in map(_last_seq, _part_dirs(cache_dir)) if seq is not None]
+    entry = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": digest,
+        "cache_dir": cache_dir,
+        "offset": end,
+        "tail_sha256": _tail_digest(file_path, end),
+        "last_seq": max(last_seqs) if last_seqs else None,
+    }
+    _write_entry(file_path, entry)
+    return entry
+
+
+def _file_lock(file_path):
+    with _locks_lock:
+        return _file_locks.setdefault(os.path.abspath(file_path), threading.Lock())
+
+
+def cached_dir(file_path, progress=None):
+    """Return the cache directory for an upload, parsing whatever is new in the file first"""
+    with _file_lock(file_path):
+        return _refresh(file_path, progress)["cache_dir"]
+
+
+def load_ticks(file_path, progress=None):
+    """Return the parsed ticks for an upload (see _refresh)"""
+    return load_cached_ticks(cached_dir(file_path, progress))
+
+
+def save_rollups(rollups, rollup_dir):
+    tmp_dir = f"{rollup_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    for bucket, aggregates in rollups.items():
+        aggregates.save(os.path.join(tmp_dir, bucket))
+    try:
+        os.replace(tmp_dir, rollup_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _refresh_rollups(file_path, progress=None):
+    entry = _refresh(file_path, progress)
+    rollup_dir = _rollup_dir(entry)
+    if not os.path.isdir(rollup_dir):
+        rollups = _fold_rollups(iter_cached_ticks(entry["cache_dir"], CHUNK_ROWS))
+        save_rollups(rollups or build_rollups(load_cached_ticks(entry["cache_dir"])), rollup_dir)
+    return entry
+
+
+def load_rollup(file_path, bucket=DEFAULT_BUCKET, progress=None):
+    """Return the upload's aggregates at one bucket width from its rollup pyramid.
+
+    The whole pyramid is built and stored with the cached ticks the first
+    time any width is asked for, and kept up to date as the file grows.
+    """
+    with _file_lock(file_path):
+        entry = _refresh_rollups(file_path, progress)
+        return TickAggregates.load(os.path.join(_rollup_dir(entry), bucket))
+
+
+def rollup_snapshot(file_path, bucket=DEFAULT_BUCKET):
+    """load_rollup plus the byte offset it covers and the last CONTEXT_ROWS ticks before it.
+
+    That is what a reader needs to carry on following the file from where
+    the cache stops.
+    """
+    with _file_lock(file_path):
+        entry = _refresh_rollups(file_path)
+        aggregates = TickAggregates.load(os.path.join(_rollup_dir(entry), bucket))
+        return aggregates, entry["offset"], _last_rows(entry["cache_dir"], CONTEXT_ROWS)
+
+
+def content_id(file_path):
+    """Identifies the upload contents the cache holds: the hash they were first parsed at and the offset read up to"""
+    with _file_lock(file_path):
+        entry = _refresh(file_path)
+        return f"{entry['sha256']}-{entry['offset']}"
+
+
+def clear_cache():
+    shutil.rmtree(CACHE_FOLDER, ignore_errors=True)
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
@@ -0,0 +1,310 @@
+"""Filtered queries over an upload's cached ticks.
+
+A filter picks rows by token, action, side and a [start, end) window of
+adjusted_time. Token and time filters are answered from an index stored
+with the cache (index-<rows>/ in the cache directory, built on first use):
+
+- the row positions sorted by time, to find a time window's rows with a
+  binary search;
+- the row positions grouped by token (tokens in sorted order, each one's
+  rows sorted by time, with their times) and an offsets table, so that
+  one token's rows, or one token's rows in a time window, are a single
+  contiguous slice.
+
+The index is .npy files, built a chunk at a time and memory-mapped, so it
+takes no more memory for a large upload than for a small one. A filtered
+query then reads just the matching rows from the memory-mapped columns,
+a chunk at a time, instead of scanning them all.
+"""
+import json
+import os
+import re
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from aggregates import RollupBuilder, TickAggregates
+from tick_cache import (
+    cached_categories, cached_dir, cached_row_count, iter_cached_ticks, load_rollup, read_saved_ticks,
+    take_cached_ticks, CHUNK_ROWS
+)
+from timestamps import parse_exchange_time
+
+INDEX_FOLDER = "index"
+BY_TOKEN_FOLDER = "by-token"
+
+# Keyword of each list filter and the query string argument it is read from
+LIST_FILTERS = [("tokens", "token"), ("actions", "action"), ("sides", "side")]
+
+
+def filters_from_args(args):
+    """Filter keywords from a query string: token, action and side (repeated or comma-separated), start and end.
+
+    Raises ValueError for a time that does not parse.
+    """
+    filters = {}
+    for name, arg in LIST_FILTERS:
+        values = [value for values in args.getlist(arg) for value in values.split(",") if value]
+        if values:
+            filters[name] = values
+    for name in ["start", "end"]:
+        if args.get(name):
+            filters[name] = parse_exchange_time(args[name])
+    return filters
+
+
+def filter_ticks(ticks, tokens=None, actions=None, sides=None, start=None, end=None):
+    """Rows of a tick frame that pass every given filter, by scanning it"""
+    conditions = []
+    for column, values in [("token", tokens), ("action", actions), ("side", sides)]:
+        if values:
+            conditions.append(ticks[column].isin(values))
+    if start is not None:
+        conditions.append(ticks["adjusted_time"] >= start)
+    if end is not None:
+        conditions.append(ticks["adjusted_time"] < end)
+    if not conditions:
+        return ticks
+    keep = conditions[0]
+    for condition in conditions[1:]:
+        keep = keep & condition
+    return ticks[keep.to_numpy()]
+
+
+class TickIndex:
+    """Time-sorted and token-grouped row positions of a cache directory's ticks.
+
+    tokens lists the token dictionary in sorted order; the rows of tokens[i]
+    are token_positions[token_offsets[i]:token_offsets[i + 1]], sorted by
+    time, with their times in the same slice of token_times.
+    """
+
+    def __init__(self, directory, time_order, sorted_times, tokens, token_offsets, token_positions, token_times):
+        self.directory = directory
+        self.time_order = time_order
+        self.sorted_times = sorted_times
+        self.tokens = tokens
+        self.token_offsets = token_offsets
+        self.token_positions = token_positions
+        self.token_times = token_times
+        self.token_codes = {token: code for code, token in enumerate(tokens)}
+
+    @staticmethod
+    def build(cache_dir, directory):
+        """Write the index's arrays, working through the ticks a chunk at a time"""
+        rows = cached_row_count(cache_dir)
+        tmp_dir = f"{directory}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(os.path.join(tmp_dir, BY_TOKEN_FOLDER))
+        time_order, sorted_times = _sort_times(cache_dir, tmp_dir, rows)
+
+        # Token codes renumbered against the tokens of every part, in sorted order
+        tokens = pd.Index(cached_categories(cache_dir, "token"))
+
+        def token_codes(ticks):
+            return tokens.get_indexer(ticks["token"].cat.categories)[ticks["token"].cat.codes.to_numpy()]
+
+        counts = np.zeros(len(tokens), dtype="int64")
+        for ticks in iter_cached_ticks(cache_dir, CHUNK_ROWS, ["token"]):
+            counts += np.bincount(token_codes(ticks), minlength=len(tokens))
+        token_offsets = np.concatenate([[0], np.cumsum(counts)])
+        np.save(os.path.join(tmp_dir, "token_offsets.npy"), token_offsets)
+
+        # Taken in time order, each row goes to the next free place in its token's range
+        token_positions = _open_array(os.path.join(tmp_dir, BY_TOKEN_FOLDER, "position.npy"), rows)
+        token_times = _open_array(os.path.join(tmp_dir, BY_TOKEN_FOLDER, "adjusted_time.npy"), rows)
+        free = token_offsets[:-1].copy()
+        for first in range(0, rows, CHUNK_ROWS):
+            positions = np.asarray(time_order[first:first + CHUNK_ROWS])
+            read_order = np.argsort(positions)
+            codes = np.empty(len(positions), dtype="int64")
+            codes[read_order] = token_codes(take_cached_ticks(cache_dir, positions[read_order], ["token"]))
+            order = np.argsort(codes, kind="stable")
+            block_counts = np.bincount(codes, minlength=len(tokens))
+            block_starts = np.cumsum(block_counts) - block_counts
+            places = free[codes[order]] + np.arange(len(order)) - block_starts[codes[order]]
+            token_positions[places] = positions[order]
+            token_times[places] = np.asarray(sorted_times[first:first + CHUNK_ROWS])[order]
+            free += block_counts
+        token_positions.flush()
+        token_times.flush()
+        del time_order, sorted_times, token_positions, token_times
+        with open(os.path.join(tmp_dir, "tokens.json"), "w") as tokens_file:
+            json.dump(tokens.tolist(), tokens_file)
+
+        try:
+            os.replace(tmp_dir, directory)
+        except OSError:
+            # Another request built the same index first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "tokens.json")) as tokens_file:
+            tokens = json.load(tokens_file)
+
+        def load_array(*path):
+            return np.load(os.path.join(directory, *path), mmap_mode="r")
+
+        return cls(
+            directory, load_array("time_order.npy"), load_array("sorted_times.npy"), tokens,
+            load_array("token_offsets.npy"), load_array(BY_TOKEN_FOLDER, "position.npy"),
+            load_array(BY_TOKEN_FOLDER, "adjusted_time.npy")
+        )
+
+    def rows_in_window(self, start=None, end=None):
+        """Sorted positions of the rows with adjusted_time in [start, end)"""
+        first = 0 if start is None else np.searchsorted(self.sorted_times, start.value)
+        last = len(self.sorted_times) if end is None else np.searchsorted(self.sorted_times, end.value)
+        return np.sort(self.time_order[first:last])
+
+    def token_slices(self, tokens, start=None, end=None):
+        """(first, last) ranges of token_positions holding the tokens' rows in [start, end)"""
+        slices = []
+        for code in sorted({self.token_codes[token] for token in tokens if token in self.token_codes}):
+            first, last = int(self.token_offsets[code]), int(self.token_offsets[code + 1])
+            # A token's rows are sorted by time, so a window within them is found by binary search
+            times = self.token_times[first:last]
+            if start is not None:
+                first += int(np.searchsorted(times, start.value))
+            if end is not None:
+                last -= len(times) - int(np.searchsorted(times, end.value))
+            if last > first:
+                slices.append((first, last))
+        return slices
+
+    def rows_for_tokens(self, tokens, start=None, end=None):
+        """Sorted positions of the rows of any of the tokens, within [start, end) if given"""
+        ranges = [self.token_positions[first:last] for first, last in self.token_slices(tokens, start, end)]
+        if not ranges:
+            return np.empty(0, dtype="int64")
+        return np.sort(np.concatenate(ranges))
+
+
+def _open_array(path, rows):
+    return np.lib.format.open_memmap(path, mode="w+", dtype="int64", shape=(rows,))
+
+
+def _merge_runs(source, target, first, middle, last):
+    """Merge the sorted runs [first, middle) and [middle, last) of source's (order, times) into target's.
+
+    Works a block of each run at a time: everything up to the smaller of the
+    two blocks' last times is final, so it is sorted in memory and written
+    out. Equal times keep the first run's rows first, which keeps the sort
+    stable.
+    """
+    (source_order, source_times), (target_order, target_times) = source, target
+    left, right, out = first, middle, first
+    while left < middle or right < last:
+        left_times = source_times[left:min(left + CHUNK_ROWS, middle)]
+        right_times = source_times[right:min(right + CHUNK_ROWS, last)]
+        if not len(right_times) or (len(left_times) and left_times[-1] <= right_times[-1]):
+            take_left = len(left_times)
+            take_right = int(np.searchsorted(right_times, left_times[-1], side="left")) if len(right_times) else 0
+        else:
+            take_left = int(np.searchsorted(left_times, right_times[-1], side="right")) if len(left_times) else 0
+            take_right = len(right_times)
+        times = np.concatenate([left_times[:take_left], right_times[:take_right]])
+        order = np.concatenate([source_order[left:left + take_left], source_order[right:right + take_right]])
+        merged = np.argsort(times, kind="stable")
+        target_times[out:out + len(times)] = times[merged]
+        target_order[out:out + len(times)] = order[merged]
+        left, right, out = left + take_left, right + take_right, out + len(times)
+
+
+def _sort_times(cache_dir, directory, rows):
+    """Stable sort of the cached times, written as time_order.npy and sorted_times.npy in directory.
+
+    Each chunk is sorted in memory, then neighbouring sorted runs are merged
+    pairwise, to and fro between those files and a scratch pair, until one
+    run is left. Returns the two arrays, memory-mapped.
+    """
+    arrays = [
+        (_open_array(os.path.join(directory, f"{prefix}time_order.npy"), rows),
+         _open_array(os.path.join(directory, f"{prefix}sorted_times.npy"), rows))
+        for prefix in ["", "scratch-"]
+    ]
+    bounds = [0]
+    for ticks in iter_cached_ticks(cache_dir, CHUNK_ROWS, ["adjusted_time"]):
+        epoch_ns = ticks["adjusted_time"].array.asi8
+        # Stable sort, so rows with equal times stay in file order; the times are nearly sorted already
+        order = np.argsort(epoch_ns, kind="stable")
+        arrays[0][0][bounds[-1]:bounds[-1] + len(order)] = order + bounds[-1]
+        arrays[0][1][bounds[-1]:bounds[-1] + len(order)] = epoch_ns[order]
+        bounds.append(bounds[-1] + len(order))
+
+    current = 0
+    while len(bounds) > 2:
+        runs = len(bounds) - 1
+        for run in range(0, runs, 2):
+            _merge_runs(arrays[current], arrays[1 - current], bounds[run], bounds[run + 1], bounds[min(run + 2, runs)])
+        bounds = bounds[::2] + ([bounds[-1]] if runs % 2 else [])
+        current = 1 - current
+    for array in [array for pair in arrays for array in pair]:
+        array.flush()
+    del arrays
+    for name in ["time_order.npy", "sorted_times.npy"]:
+        if current:
+            os.replace(os.path.join(directory, f"scratch-{name}"), os.path.join(directory, name))
+        else:
+            os.remove(os.path.join(directory, f"scratch-{name}"))
+    return (np.load(os.path.join(directory, "time_order.npy"), mmap_mode="r"),
+            np.load(os.path.join(directory, "sorted_times.npy"), mmap_mode="r"))
+
+
+def load_index(cache_dir):
+    """The index of a cache directory, built now if the cache has grown since it was last built"""
+    index_dir = os.path.join(cache_dir, f"{INDEX_FOLDER}-{cached_row_count(cache_dir)}")
+    if not os.path.isdir(index_dir):
+        TickIndex.build(cache_dir, index_dir)
+        for name in os.listdir(cache_dir):
+            if re.fullmatch(rf"{INDEX_FOLDER}-\d+", name) and os.path.join(cache_dir, name) != index_dir:
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+    return TickIndex.load(index_dir)
+
+
+def matching_positions(cache_dir, tokens=None, start=None, end=None):
+    """Sorted positions of the rows passing the token and time filters, or None if neither is given"""
+    if tokens:
+        return load_index(cache_dir).rows_for_tokens(tokens, start, end)
+    if start is not None or end is not None:
+        return load_index(cache_dir).rows_in_window(start, end)
+    return None
+
+
+def iter_matching_ticks(cache_dir, chunk_rows, tokens=None, actions=None, sides=None, start=None, end=None):
+    """The cached ticks passing every filter, in file order, as frames read one chunk of at most chunk_rows rows at a time.
+
+    Token and time filters are looked up in the index, so only the matching
+    rows are read; action and side filters are applied to each chunk.
+    """
+    positions = matching_positions(cache_dir, tokens, start, end)
+    if positions is None:
+        chunks = iter_cached_ticks(cache_dir, chunk_rows)
+    else:
+        chunks = (take_cached_ticks(cache_dir, positions[first:first + chunk_rows])
+                  for first in range(0, len(positions), chunk_rows))
+    for ticks in chunks:
+        yield filter_ticks(ticks, actions=actions, sides=sides)
+
+
+def query_aggregates(file_path, bucket, **filters):
+    """The upload's aggregates at one bucket width over only the ticks passing the filters.
+
+    Without filters, or with a time window that falls on bucket boundaries,
+    this is read from the rollup pyramid. Otherwise the matching ticks are
+    aggregated on the spot, a chunk at a time, and T->N/M combos are counted
+    among them only.
+    """
+    start, end = filters.get("start"), filters.get("end")
+    if not any(filters.get(name) for name, _ in LIST_FILTERS) and all(
+            time_value is None or time_value == time_value.floor(bucket) for time_value in [start, end]):
+        aggregates = load_rollup(file_path, bucket)
+        return aggregates if start is None and end is None else aggregates.between(start, end)
+    cache_dir = cached_dir(file_path)
+    builder = RollupBuilder([bucket])
+    for ticks in iter_matching_ticks(cache_dir, CHUNK_ROWS, **filters):
+        builder.add(ticks)
+    rollups = builder.rollups()
+    return rollups[bucket] if rollups else TickAggregates.from_ticks(read_saved_ticks(cache_dir, slice(0, 0)), bucket)
@@ -0,0 +1,425 @@
+"""Persistent multi-day tick store, partitioned by trading date and token.
+
+Uploads come and go (and /reset clears them and their cache), while the
+store keeps every trading date ever stored:
+
+    store/<YYYY-MM-DD>/source.json         upload and contents the date came from
+    store/<YYYY-MM-DD>/rollups/<bucket>/   the date's rollup pyramid (TickAggregates.save)
+    store/<YYYY-MM-DD>/tokens/<token>.npz  one token's ticks that date, compressed columns
+    store/<YYYY-MM-DD>/breakdown/          the same by action and side (see below)
+
+A query over some dates reads, for each date, its rollup at the asked
+bucket width (no filters), just the partitions of the asked tokens, or,
+for action and side filters alone, its breakdown, and merges the per-date
+aggregates. A date is stored whole from one upload; storing another upload
+with ticks on the same date replaces it.
+
+The breakdown holds a rollup pyramid for each (action, side) pair, with
+the row each token was first seen at, plus the T->N/M combo counts per
+second among the ticks of each side and each set of actions a combo can
+be made of. Summing the pairs' cells and taking the trades and combos of
+the asked sides and actions gives the aggregates of any action and side
+filter without reading the partitions.
+
+An upload is stored a chunk of its cached ticks at a time: each chunk's
+rows are added to the rollups of their dates and written, uncompressed and
+grouped by token, as one piece per date. A token's slices of the pieces
+are joined and compressed into its partition once the upload is done, so
+only one token's ticks on one date are ever held at once.
+"""
+import json
+import os
+import shutil
+import uuid
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from aggregates import RollupBuilder, TickAggregates, CONTEXT_ROWS
+from patterns import match_pattern, T_TO_NM
+from tick_cache import (
+    cached_dir, cached_row_count, content_id, iter_cached_ticks, save_rollups, save_ticks,
+    CATEGORY_COLUMNS, CHUNK_ROWS, NUMERIC_COLUMNS
+)
+from tick_query import filter_ticks
+from timestamps import EXCHANGE_TIMEZONE
+
+STORE_FOLDER = "store"
+TOKEN_FOLDER = "tokens"
+STORE_ROLLUP_FOLDER = "rollups"
+PIECE_FOLDER = "pieces"
+BREAKDOWN_FOLDER = "breakdown"
+
+# Combo counts are kept among all the ticks ("all") and among T plus each set of these actions
+# that holds an N or an M; filters on other actions are answered from the partitions
+COMBO_ACTIONS = ["N", "M", "X"]
+COMBO_KEYS = {"all": None, **{
+    "T" + "".join(subset): ["T", *subset]
+    for subset in (
+        [action for bit, action in enumerate(COMBO_ACTIONS) if mask >> bit & 1]
+        for mask in range(1, 1 << len(COMBO_ACTIONS))
+    )
+    if "N" in subset or "M" in subset
+}}
+
+SECONDS_PER_DAY = 86400
+
+
+def _token_file(date_dir, token):
+    # Quoted, so any token name is a safe file name
+    return os.path.join(date_dir, TOKEN_FOLDER, f"{quote(str(token), safe='')}.npz")
+
+
+def _save_partition(columns, categories, path):
+    """One token's ticks of one date as a compressed .npz of columns (text columns as codes plus categories).
+
+    columns holds every column as an array, the text columns as codes into
+    the value arrays of categories.
+    """
+    partition = {}
+    for column in CATEGORY_COLUMNS:
+        codes, uniques = pd.factorize(columns[column])
+        partition[column] = codes.astype("int32")
+        partition[f"{column}_categories"] = np.asarray(categories[column][uniques].tolist(), dtype=str)
+    for column in NUMERIC_COLUMNS + ["adjusted_time"]:
+        partition[column] = columns[column]
+    np.savez_compressed(path, **partition)
+
+
+def _read_partition(path):
+    with np.load(path) as partition:
+        columns = {
+            column: pd.Categorical.from_codes(partition[column], partition[f"{column}_categories"].tolist())
+            for column in CATEGORY_COLUMNS
+        }
+        for column in NUMERIC_COLUMNS:
+            columns[column] = partition[column]
+        columns["adjusted_time"] = (
+            pd.DatetimeIndex(partition["adjusted_time"].view("datetime64[ns]")).tz_localize("UTC").tz_convert(EXCHANGE_TIMEZONE)
+        )
+    return pd.DataFrame(columns)
+
+
+def _open_piece(piece_dir):
+    """The columns of a piece written by save_ticks, memory-mapped, and the values of its text columns"""
+    with open(os.path.join(piece_dir, "categories.json")) as categories_file:
+        categories = json.load(categories_file)
+    columns = {column: np.load(os.path.join(piece_dir, f"{column}.npy"), mmap_mode="r")
+               for column in CATEGORY_COLUMNS + NUMERIC_COLUMNS + ["adjusted_time"]}
+    return columns, categories
+
+
+def _pair_dir(date_dir, action, side):
+    return os.path.join(date_dir, BREAKDOWN_FOLDER, quote(str(action), safe=""), quote(str(side), safe=""))
+
+
+class _Breakdown:
+    """The breakdown of one date's ticks, added a chunk at a time in file order"""
+
+    def __init__(self, date):
+        self.day_start = pd.Timestamp(date, tz=EXCHANGE_TIMEZONE).value
+        self.rows = 0
+        # (action, side) -> its RollupBuilder and {token: row first seen at}
+        self.pairs = {}
+        # (combo key, side or None for all) -> combos per second of the day, and the rows before the next chunk
+        self.combos = {}
+        self.context = {}
+
+    def add(self, ticks):
+        for (action, side), rows in ticks.groupby(["action", "side"], observed=True, sort=False).indices.items():
+            builder, first_rows = self.pairs.setdefault((str(action), str(side)), (RollupBuilder(), {}))
+            pair_ticks = ticks.iloc[rows].reset_index(drop=True)
+            builder.add(pair_ticks)
+            token_codes, tokens = pd.factorize(pair_ticks["token"])
+            for token, first in zip(tokens, np.unique(token_codes, return_index=True)[1]):
+                first_rows.setdefault(str(token), self.rows + int(rows[first]))
+
+        # Action codes over this chunk's actions and the carried ones, so each sequence is matched without recoding
+        carried = {action for context_actions, _ in self.context.values() for action in context_actions}
+        actions = pd.Categorical(ticks["action"].astype(str))
+        categories = actions.categories.union(pd.Index(sorted(carried), dtype=object))
+        codes = np.asarray(actions.set_categories(categories).codes)
+        sides = np.asarray(ticks["side"], dtype=str)
+        seconds = (ticks["adjusted_time"].array.asi8 - self.day_start) // 10 ** 9
+        for side in [None] + sorted(set(sides)):
+            side_rows = np.ones(len(ticks), dtype=bool) if side is None else sides == side
+            for combo_key, combo_actions in COMBO_KEYS.items():
+                rows = side_rows
+                if combo_actions is not None:
+                    combo_codes = categories.get_indexer(combo_actions)
+                    rows = side_rows & np.isin(codes, combo_codes[combo_codes >= 0])
+                context_actions, context_seconds = self.context.get((combo_key, side), ([], []))
+                sequence = np.concatenate([categories.get_indexer(context_actions), codes[rows]]).astype(codes.dtype)
+                sequence_seconds = np.concatenate([context_seconds, seconds[rows]]).astype("int64")
+                # A combo starting in the carried rows ends in this chunk, so it was not counted before
+                starts = match_pattern(pd.Categorical.from_codes(sequence, categories), T_TO_NM)
+                counts = self.combos.get((combo_key, side), np.zeros(SECONDS_PER_DAY, dtype="int64"))
+                self.combos[(combo_key, side)] = counts + np.bincount(sequence_seconds[starts], minlength=len(counts))
+                self.context[(combo_key, side)] = (list(categories[sequence[-CONTEXT_ROWS:]]), sequence_seconds[-CONTEXT_ROWS:])
+        self.rows += len(ticks)
+
+    def save(self, date_dir):
+        for (action, side), (builder, first_rows) in self.pairs.items():
+            pair_dir = _pair_dir(date_dir, action, side)
+            os.makedirs(pair_dir)
+            save_rollups(builder.rollups(), os.path.join(pair_dir, STORE_ROLLUP_FOLDER))
+            with open(os.path.join(pair_dir, "first_rows.json"), "w") as first_rows_file:
+                json.dump(first_rows, first_rows_file)
+        sides = self.sides()
+        np.savez_compressed(os.path.join(date_dir, BREAKDOWN_FOLDER, "combos.npz"), **{
+            f"{combo_key}_{'all' if side is None else sides.index(side)}": counts
+            for (combo_key, side), counts in self.combos.items()
+        })
+
+    def actions(self):
+        return sorted({action for action, _ in self.pairs})
+
+    def sides(self):
+        return sorted({side for _, side in self.pairs})
+
+
+class _DateWriter:
+    """Builds one date's directory from its ticks, added a chunk at a time in file order.
+
+    Each chunk is written as one uncompressed piece with its rows grouped by
+    token; finish() joins each token's slices of the pieces and compresses
+    them once, as the token's partition.
+    """
+
+    def __init__(self, date):
+        self.date_dir = os.path.join(STORE_FOLDER, date)
+        self.tmp_dir = f"{self.date_dir}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(os.path.join(self.tmp_dir, TOKEN_FOLDER))
+        os.makedirs(os.path.join(self.tmp_dir, PIECE_FOLDER))
+        self.date = date
+        self.rollups = RollupBuilder()
+        self.breakdown = _Breakdown(date)
+        self.rows = 0
+        self.pieces = 0
+        # Token -> its (piece, first row, last row) slices so far, in first-seen order
+        self.slices = {}
+
+    def _piece_dir(self, piece):
+        return os.path.join(self.tmp_dir, PIECE_FOLDER, f"{piece:06d}")
+
+    def add(self, ticks):
+        self.rollups.add(ticks)
+        self.breakdown.add(ticks)
+        self.rows += len(ticks)
+        # Grouped by token, each token's rows in time order
+        token_codes, tokens = pd.factorize(ticks["token"])
+        order = np.lexsort((ticks["adjusted_time"].array.asi8, token_codes))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(token_codes, minlength=len(tokens)))])
+        save_ticks(ticks.iloc[order].reset_index(drop=True), self._piece_dir(self.pieces))
+        for code, token in enumerate(tokens):
+            self.slices.setdefault(str(token), []).append((self.pieces, offsets[code], offsets[code + 1]))
+        self.pieces += 1
+
+    def finish(self, source):
+        save_rollups(self.rollups.rollups(), os.path.join(self.tmp_dir, STORE_ROLLUP_FOLDER))
+        self.breakdown.save(self.tmp_dir)
+        pieces = [_open_piece(self._piece_dir(piece)) for piece in range(self.pieces)]
+        # Text values of every piece, and each piece's codes renumbered against them
+        categories, recode = {}, [{} for _ in pieces]
+        for column in CATEGORY_COLUMNS:
+            values = pd.Index(sorted(set().union(*[piece_categories[column] for _, piece_categories in pieces])))
+            categories[column] = np.asarray(values, dtype=object)
+            for piece, (_, piece_categories) in enumerate(pieces):
+                recode[piece][column] = values.get_indexer(piece_categories[column])
+
+        for token, slices in self.slices.items():
+            columns = {}
+            for column in CATEGORY_COLUMNS + NUMERIC_COLUMNS + ["adjusted_time"]:
+                parts = [pieces[piece][0][column][first:last] for piece, first, last in slices]
+                if column in CATEGORY_COLUMNS:
+                    parts = [recode[piece][column][part] for (piece, _, _), part in zip(slices, parts)]
+                columns[column] = np.concatenate(parts)
+            if len(slices) > 1:
+                # Every slice is in time order already; a stable sort keeps equal times in file order
+                order = np.argsort(columns["adjusted_time"], kind="stable")
+                columns = {column: values[order] for column, values in columns.items()}
+            _save_partition(columns, categories, _token_file(self.tmp_dir, token))
+        del pieces
+        shutil.rmtree(os.path.join(self.tmp_dir, PIECE_FOLDER), ignore_errors=True)
+        with open(os.path.join(self.tmp_dir, "source.json"), "w") as source_file:
+            json.dump({**source, "date": self.date, "rows": self.rows, "tokens": list(self.slices),
+                       "actions": self.breakdown.actions(), "sides": self.breakdown.sides()}, source_file)
+
+        # Swapped in whole, so a query sees either the old date or the new one
+        old_dir = f"{self.date_dir}.{uuid.uuid4().hex}.old"
+        if os.path.isdir(self.date_dir):
+            os.replace(self.date_dir, old_dir)
+        os.replace(self.tmp_dir, self.date_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _read_source(date):
+    with open(os.path.join(STORE_FOLDER, date, "source.json")) as source_file:
+        return json.load(source_file)
+
+
+def store_upload(file_path, progress=None):
+    """Store every trading date in an upload, replacing those dates if already stored.
+
+    Dates already stored from these same upload contents are skipped.
+    progress, if given, is called as progress("storing", fraction done,
+    rows stored). Returns the dates written.
+    """
+    source = {"upload": os.path.basename(file_path), "content": content_id(file_path)}
+    cache_dir = cached_dir(file_path)
+    total_rows, rows = cached_row_count(cache_dir), 0
+    # Date -> its writer, or None if the date is skipped
+    writers = {}
+    for ticks in iter_cached_ticks(cache_dir, CHUNK_ROWS):
+        day_codes, days = pd.factorize(ticks["adjusted_time"].dt.floor("D"), sort=True)
+        for code, day in enumerate(days):
+            date = day.strftime("%Y-%m-%d")
+            if date not in writers:
+                if date in stored_dates() and _read_source(date)["content"] == source["content"]:
+                    writers[date] = None
+                else:
+                    os.makedirs(STORE_FOLDER, exist_ok=True)
+                    writers[date] = _DateWriter(date)
+            if writers[date] is not None:
+                writers[date].add(ticks[day_codes == code].reset_index(drop=True))
+        rows += len(ticks)
+        if progress:
+            progress("storing", rows / max(total_rows, 1), rows)
+
+    written = [date for date in sorted(writers) if writers[date] is not None]
+    for date in written:
+        writers[date].finish(source)
+    return written
+
+
+def stored_dates():
+    """Trading dates in the store, oldest first"""
+    if not os.path.isdir(STORE_FOLDER):
+        return []
+    return sorted(name for name in os.listdir(STORE_FOLDER)
+                  if len(name) == 10 and os.path.isfile(os.path.join(STORE_FOLDER, name, "source.json")))
+
+
+def stored_date_info():
+    """source.json of every stored date, oldest first: upload, content, date, rows, tokens, actions and sides"""
+    return [_read_source(date) for date in stored_dates()]
+
+
+def select_dates(sessions=None, start_date=None, end_date=None):
+    """Stored dates from start_date to end_date (inclusive, "YYYY-MM-DD"), then only the last sessions of them"""
+    dates = [date for date in stored_dates()
+             if (start_date is None or date >= start_date) and (end_date is None or date <= end_date)]
+    return dates[-sessions:] if sessions else dates
+
+
+def _breakdown_keys(source, actions=None, sides=None):
+    """The asked actions and sides the date has, and the combos key for them.
+
+    Returns None if the date has no breakdown or the combos of those actions
+    and sides were not kept; the key is "" if they cannot make a combo.
+    """
+    if "actions" not in source:
+        # Stored before dates kept a breakdown
+        return None
+    actions = [action for action in source["actions"] if not actions or action in actions]
+    sides = [side for side in source["sides"] if not sides or side in sides]
+    if len(actions) == len(source["actions"]):
+        combo_key = "all"
+    elif "T" not in actions or not {"N", "M"} & set(actions):
+        combo_key = ""
+    elif set(actions) <= {"T", *COMBO_ACTIONS}:
+        combo_key = "T" + "".join(action for action in COMBO_ACTIONS if action in actions)
+    else:
+        return None
+    if len(sides) == len(source["sides"]):
+        side_key = "all"
+    elif len(sides) == 1:
+        side_key = str(source["sides"].index(sides[0]))
+    else:
+        return None
+    return actions, sides, combo_key and f"{combo_key}_{side_key}"
+
+
+def _breakdown_aggregates(date_dir, bucket, actions, sides, combo_key):
+    """A date's aggregates over the ticks of the given actions and sides, from its breakdown (None if there are none)"""
+    pairs = [(action, side) for action in actions for side in sides
+             if os.path.isdir(_pair_dir(date_dir, action, side))]
+    if not pairs:
+        return None
+    parts = [TickAggregates.load(os.path.join(_pair_dir(date_dir, *pair), STORE_ROLLUP_FOLDER, bucket)) for pair in pairs]
+    cells = parts[0] if len(parts) == 1 else TickAggregates.merge(parts)
+
+    # Tokens rank by the first row they were seen at among the pairs' ticks, as they would among the ticks
+    first_rows = {}
+    for pair in pairs:
+        with open(os.path.join(_pair_dir(date_dir, *pair), "first_rows.json")) as first_rows_file:
+            for token, row in json.load(first_rows_file).items():
+                first_rows[token] = min(row, first_rows.get(token, row))
+    first_seen = pd.Series(first_rows).reindex([str(token) for token in cells.tokens]).rank(method="first")
+
+    # Trades are the T rows of the asked sides: one pair's, or with several sides asked all of them, the date's
+    trades = {name: np.asarray(values[:0]) for name, values in cells.trades.items()}
+    trade_parts = [part for (action, _), part in zip(pairs, parts) if action == "T"]
+    if trade_parts:
+        if len(trade_parts) == 1:
+            source = trade_parts[0]
+        else:
+            source = TickAggregates.load(os.path.join(date_dir, STORE_ROLLUP_FOLDER, bucket))
+        trades = {name: np.asarray(values) for name, values in source.trades.items()}
+        trades["bucket"] = cells.buckets.get_indexer(source.buckets[trades["bucket"]]).astype("int64")
+        trades["token"] = cells.tokens.get_indexer(source.tokens[trades["token"]]).astype("int64")
+
+    combos = pd.Series(0, index=cells.buckets)
+    if combo_key:
+        with np.load(os.path.join(date_dir, BREAKDOWN_FOLDER, "combos.npz")) as stored_combos:
+            per_second = stored_combos[combo_key]
+        seconds = np.flatnonzero(per_second)
+        times = pd.DatetimeIndex(
+            (pd.Timestamp(os.path.basename(date_dir), tz=EXCHANGE_TIMEZONE).value + seconds * 10 ** 9).view("datetime64[ns]")
+        ).tz_localize("UTC").tz_convert(EXCHANGE_TIMEZONE)
+        combos = pd.Series(per_second[seconds], index=times.floor(bucket)).groupby(level=0).sum().reindex(cells.buckets, fill_value=0)
+
+    return TickAggregates(
+        bucket, cells.buckets, cells.tokens, first_seen.to_numpy().astype("int64") - 1,
+        cells.cell_buckets, cells.cell_tokens, cells.cell_entries, cells.cell_quantity,
+        combos.to_numpy().astype("int64"), trades
+    )
+
+
+def _date_aggregates(date, bucket, tokens=None, actions=None, sides=None):
+    date_dir = os.path.join(STORE_FOLDER, date)
+    if not (tokens or actions or sides):
+        return TickAggregates.load(os.path.join(date_dir, STORE_ROLLUP_FOLDER, bucket))
+    if tokens is None:
+        source = _read_source(date)
+        keys = _breakdown_keys(source, actions, sides)
+        if keys is not None:
+            return _breakdown_aggregates(date_dir, bucket, *keys)
+        tokens = source["tokens"]
+    # Only the partitions of the asked tokens are read
+    frames = [_read_partition(_token_file(date_dir, token)) for token in tokens
+              if os.path.isfile(_token_file(date_dir, token))]
+    if not frames:
+        return None
+    ticks = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    if len(frames) > 1:
+        # Back in time order across the tokens, as in the upload
+        ticks = ticks.iloc[np.argsort(ticks["adjusted_time"].array.asi8, kind="stable")]
+    ticks = filter_ticks(ticks, actions=actions, sides=sides).reset_index(drop=True)
+    return TickAggregates.from_ticks(ticks, bucket) if len(ticks) else None
+
+
+def history_aggregates(bucket, dates, tokens=None, actions=None, sides=None):
+    """The aggregates of the given stored dates at one bucket width, over only the ticks passing the filters.
+
+    Without filters each date's rollup is read as is; with them, each
+    date's matching token partitions are aggregated (so T->N/M combos are
+    counted among the matching ticks only, as in tick_query). Returns None
+    if nothing matches.
+    """
+    parts = [aggregates for aggregates in (_date_aggregates(date, bucket, tokens, actions, sides) for date in dates)
+             if aggregates is not None]
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else TickAggregates.merge(parts)
@@ -0,0 +1,62 @@
+"""Conversion of raw exchange timestamps to timezone-aware pandas times."""
+import numpy as np
+import pandas as pd
+
+# Exchange timestamps count from 1980-01-01, which is this many seconds after the unix epoch
+EXCHANGE_EPOCH_OFFSET = 315532800
+EXCHANGE_TIMEZONE = "Asia/Calcutta"
+
+_INT64_MAX = np.iinfo("int64").max
+
+# Raw values above each bound are in a finer unit: (bound, nanoseconds per raw unit).
+# Anything at or below 1e12 is in seconds.
+_UNIT_BOUNDS = [
+    (10 ** 12, 10 ** 6),        # milliseconds
+    (10 ** 15, 10 ** 3),        # microseconds
+    (10 ** 18, 1),              # nanoseconds
+]
+
+
+def detect_units(raw_epoch_times):
+    """Return the nanoseconds-per-unit multiplier for every raw stamp"""
+    raw = np.asarray(raw_epoch_times, dtype="int64")
+    scale = np.full(raw.shape, 10 ** 9, dtype="int64")
+    for bound, ns_per_unit in _UNIT_BOUNDS:
+        scale[raw > bound] = ns_per_unit
+    return scale
+
+
+def to_epoch_ns(raw_epoch_times):
+    """Convert raw exchange stamps of mixed units to unix nanoseconds.
+
+    The 1980 offset is added in the stamp's own unit before scaling, all in
+    int64, so nanosecond stamps come through exactly. Stamps that would not
+    fit in int64 nanoseconds come back as NaT (int64 min).
+    """
+    raw = np.asarray(raw_epoch_times, dtype="int64")
+    scale = detect_units(raw)
+    offset = EXCHANGE_EPOCH_OFFSET * (10 ** 9 // scale)
+
+    # Largest raw value that stays inside int64 after the offset and scaling
+    limit = _INT64_MAX // scale - offset
+    valid = (raw < limit) & (raw > -limit)
+
+    epoch_ns = np.full(raw.shape, np.iinfo("int64").min, dtype="int64")
+    epoch_ns[valid] = (raw[valid] + offset[valid]) * scale[valid]
+    return epoch_ns
+
+
+def to_exchange_times(raw_epoch_times, tz=EXCHANGE_TIMEZONE):
+    """Convert an array of raw exchange stamps to a tz-aware DatetimeIndex"""
+    epoch_ns = to_epoch_ns(raw_epoch_times)
+    return pd.DatetimeIndex(epoch_ns.view("datetime64[ns]")).tz_localize("UTC").tz_convert(tz)
+
+
+def parse_exchange_time(value, tz=EXCHANGE_TIMEZONE):
+    """Parse a time given in a request; one without a UTC offset is taken as exchange time"""
+    time_value = pd.Timestamp(value)
+    if time_value is pd.NaT:
+        raise ValueError(f"Not a time: {value!r}")
+    if time_value.tzinfo is None:
+        time_value = time_value.tz_localize(tz)
+    return time_value.tz_convert(tz)
@@ -0,0 +1,96 @@
+"""Top-K tokens by order count or quantity, tracked one batch of ticks at a time.
+
+SpaceSaving takes batches of (token, weight) pairs through update and
+answers top(k) with the K largest running totals, ties going to the token
+seen first. It keeps at most `capacity` counters: a new token takes over the
+smallest one, inheriting its count as the most it can be overcounted by, so
+any token whose total exceeds (sum of weights) / capacity is kept. largest
+picks the top K of totals already computed in full, as the charts do.
+
+Within a batch the weights are summed per token first, so the per-row cost
+is one vectorised pass and the counters are touched once per distinct token.
+"""
+import heapq
+
+import numpy as np
+import pandas as pd
+
+# Tokens a bounded tracker keeps, comfortably more than the five the charts show
+DEFAULT_CAPACITY = 1000
+
+
+def batch_totals(keys, weights=None):
+    """Distinct keys of a batch in first-seen order, and the count (or weight sum) of each"""
+    codes, uniques = pd.factorize(np.asarray(keys, dtype=object))
+    totals = np.bincount(codes, weights=weights, minlength=len(uniques))
+    return list(uniques), totals.tolist()
+
+
+def largest(values, k, tie_order=None):
+    """Positions of the k largest values, largest first.
+
+    Equal values are ranked by tie_order (lowest first), or by position if it
+    is not given. Selection is linear in len(values), with only the values
+    tied with the k-th largest sorted.
+    """
+    values = np.asarray(values)
+    tie_order = np.arange(len(values)) if tie_order is None else np.asarray(tie_order)
+    if k <= 0 or not len(values):
+        return np.empty(0, dtype="int64")
+    if k < len(values):
+        threshold = np.partition(values, len(values) - k)[len(values) - k]
+        candidates = np.flatnonzero(values >= threshold)
+    else:
+        candidates = np.arange(len(values))
+    order = np.lexsort((tie_order[candidates], -values[candidates]))
+    return candidates[order[:k]]
+
+
+class SpaceSaving:
+    """Space-Saving heavy hitters: at most capacity counters, each with an overcount bound.
+
+    Counts are never below the true total and at most errors[token] above it.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.first_seen = {}
+        self.seen = 0
+        # (count, first seen, token) entries, stale once the token's count has moved on; skipped on pop
+        self.heap = []
+
+    def _push(self, key):
+        heapq.heappush(self.heap, (self.counts[key], self.first_seen[key], key))
+
+    def _pop_smallest(self):
+        while True:
+            count, _, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return key, count
+
+    def update(self, keys, weights=None):
+        for key, total in zip(*batch_totals(keys, weights)):
+            if key in self.counts:
+                self.counts[key] += total
+            elif len(self.counts) < self.capacity:
+                self.counts[key], self.errors[key] = total, 0
+            else:
+                evicted, floor = self._pop_smallest()
+                del self.counts[evicted], self.errors[evicted], self.first_seen[evicted]
+                self.counts[key], self.errors[key] = floor + total, floor
+            if key not in self.first_seen:
+                self.first_seen[key] = self.seen
+                self.seen += 1
+            self._push(key)
+        if len(self.heap) > 4 * self.capacity:
+            # Drop the stale entries before the heap outgrows the counters it tracks
+            self.heap = [(count, self.first_seen[key], key) for key, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def estimate(self, key):
+        return self.counts.get(key, 0)
+
+    def top(self, k):
+        return heapq.nlargest(k, self.counts.items(), key=lambda item: (item[1], -self.first_seen[item[0]]))
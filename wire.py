@@ -0,0 +1,67 @@
+"""Packed columnar encoding of aggregates for the browser.
+
+A response is a little-endian uint32 header length, a JSON header, then
+one raw little-endian buffer per column. The header lists each column's
+name, dtype, byte offset and length, plus any plain values (such as token
+names). Every buffer starts on an 8-byte boundary so the browser can wrap
+it in a typed array (Float64Array, Uint32Array) without copying.
+"""
+import json
+import struct
+
+import numpy as np
+
+PACKED_MIMETYPE = "application/vnd.tick-columns"
+
+ALIGNMENT = 8
+
+
+def _padding(length):
+    return -length % ALIGNMENT
+
+
+def pack_columns(columns, **meta):
+    """Encode named 1-d arrays (already in their wire dtype) plus JSON-able meta values"""
+    columns = {name: np.ascontiguousarray(values) for name, values in columns.items()}
+    layout, offset = [], 0
+    for name, values in columns.items():
+        layout.append({"name": name, "dtype": values.dtype.str, "offset": offset, "length": len(values)})
+        offset += values.nbytes + _padding(values.nbytes)
+
+    header = json.dumps({**meta, "columns": layout}).encode()
+    # Pad the header so that the first buffer, and so every one after it, is aligned
+    header += b" " * _padding(4 + len(header))
+    parts = [struct.pack("<I", len(header)), header]
+    for values in columns.values():
+        parts.append(values.tobytes())
+        parts.append(b"\0" * _padding(values.nbytes))
+    return b"".join(parts)
+
+
+def pack_aggregates(aggregates):
+    """Per-bucket and per-token totals plus every non-empty (bucket, token) cell and trade cell.
+
+    Buckets are epoch milliseconds (timezone names the exchange's zone to
+    show them in); cells and trade cells refer to buckets and tokens by
+    position in those columns and in the tokens list.
+    """
+    entries_per_token = aggregates.entries_per_token().reindex(aggregates.tokens)
+    trades = aggregates.trades
+    return pack_columns({
+        "bucket_epoch_ms": (aggregates.buckets.asi8 // 1_000_000).astype("<f8"),
+        "bucket_entries": aggregates.entries_per_bucket().to_numpy().astype("<u4"),
+        "bucket_quantity": aggregates.quantity_per_bucket().to_numpy().astype("<f8"),
+        "bucket_combos": np.asarray(aggregates.combos).astype("<u4"),
+        "token_entries": entries_per_token.to_numpy().astype("<u4"),
+        "token_quantity": aggregates.quantity_per_token().to_numpy().astype("<f8"),
+        "cell_bucket": np.asarray(aggregates.cell_buckets).astype("<u4"),
+        "cell_token": np.asarray(aggregates.cell_tokens).astype("<u4"),
+        "cell_entries": np.asarray(aggregates.cell_entries).astype("<u4"),
+        "cell_quantity": np.asarray(aggregates.cell_quantity).astype("<f8"),
+        "bucket_notional": aggregates.notional_per_bucket().to_numpy().astype("<f8"),
+        "token_notional": aggregates.notional_per_token().to_numpy().astype("<f8"),
+        "trade_bucket": np.asarray(trades["bucket"]).astype("<u4"),
+        "trade_token": np.asarray(trades["token"]).astype("<u4"),
+        **{f"trade_{name}": np.asarray(trades[name]).astype("<f8")
+           for name in ["open", "high", "low", "close", "quantity", "notional"]},
+    }, bucket=aggregates.bucket, timezone=str(aggregates.buckets.tz), tokens=[str(token) for token in aggregates.tokens])